@@ -0,0 +1,42 @@
+"""per-guild ranking indexes
+
+Guild feeds sorted by top or rising had no index to walk: ranks
+were only indexed across all guilds. post_stats_top is rebuilt
+with created_at, for ?t= windows.
+
+Built CONCURRENTLY, like f2b6d0a94c17.
+
+Revision ID: 3c8e1f5a7b20
+Revises: e7a35c0b8d16
+Create Date: 2026-10-20 10:12:47.203518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c8e1f5a7b20'
+down_revision: Union[str, None] = 'e7a35c0b8d16'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('post_stats_top', table_name='freak_post_stats', postgresql_concurrently=True, if_exists=True)
+        op.create_index('post_stats_top', 'freak_post_stats', ['score', 'post_id'], unique=False, postgresql_include=['created_at'], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('post_stats_topic_top', 'freak_post_stats', ['topic_id', 'score', 'post_id'], unique=False, postgresql_include=['created_at'], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('post_stats_topic_created', 'freak_post_stats', ['topic_id', 'created_at'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('post_stats_topic_created', table_name='freak_post_stats', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('post_stats_topic_top', table_name='freak_post_stats', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('post_stats_top', table_name='freak_post_stats', postgresql_concurrently=True, if_exists=True)
+        op.create_index('post_stats_top', 'freak_post_stats', ['score', 'post_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
@@ -0,0 +1,41 @@
+"""materialized home timeline
+
+Revision ID: 4558503ef484
+Revises: 6d418df3c72f
+Create Date: 2026-10-18 19:52:08.412210
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4558503ef484'
+down_revision: Union[str, None] = '6d418df3c72f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('freak_home_inbox',
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('post_id', sa.BigInteger(), nullable=False),
+    sa.Column('guild_id', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['guild_id'], ['freak_topic.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['post_id'], ['freak_post.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['freak_user.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('home_inbox_timeline', 'freak_home_inbox', ['user_id', 'created_at', 'post_id'], unique=False)
+    op.add_column('freak_topic', sa.Column('fanout_on_read', sa.Boolean(), server_default=sa.text('false'), nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('freak_topic', 'fanout_on_read')
+    op.drop_index('home_inbox_timeline', table_name='freak_home_inbox')
+    op.drop_table('freak_home_inbox')
@@ -0,0 +1,28 @@
+"""index blocks by target
+
+Revision ID: 5c1d7e9a2b84
+Revises: e3f0a8c6d215
+Create Date: 2026-10-18 23:02:51.807146
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1d7e9a2b84'
+down_revision: Union[str, None] = 'e3f0a8c6d215'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('user_block_target', 'freak_user_block', ['target_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('user_block_target', table_name='freak_user_block')
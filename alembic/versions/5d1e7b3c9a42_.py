@@ -0,0 +1,40 @@
+"""stored HTML of Markdown
+
+Existing rows are rendered on read until `python3 -m freak --rerender`.
+
+Revision ID: 5d1e7b3c9a42
+Revises: f2b6d0a94c17
+Create Date: 2026-10-19 15:40:12.093518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d1e7b3c9a42'
+down_revision: Union[str, None] = 'f2b6d0a94c17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('freak_post', sa.Column('text_html', sa.Text(), nullable=True))
+    op.add_column('freak_post', sa.Column('html_version', sa.SmallInteger(), nullable=True))
+    op.add_column('freak_comment', sa.Column('text_html', sa.Text(), nullable=True))
+    op.add_column('freak_comment', sa.Column('html_version', sa.SmallInteger(), nullable=True))
+    op.add_column('freak_topic', sa.Column('description_html', sa.Text(), nullable=True))
+    op.add_column('freak_topic', sa.Column('html_version', sa.SmallInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('freak_topic', 'html_version')
+    op.drop_column('freak_topic', 'description_html')
+    op.drop_column('freak_comment', 'html_version')
+    op.drop_column('freak_comment', 'text_html')
+    op.drop_column('freak_post', 'html_version')
+    op.drop_column('freak_post', 'text_html')
@@ -0,0 +1,35 @@
+"""post excerpts
+
+Existing posts get their first 180 characters as plain excerpt, as the
+REST feeds showed before, and are marked for `python3 -m freak --rerender`,
+which fills in the rest.
+
+Revision ID: 9b4c2e6f1a73
+Revises: 5d1e7b3c9a42
+Create Date: 2026-10-19 18:22:40.517302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b4c2e6f1a73'
+down_revision: Union[str, None] = '5d1e7b3c9a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('freak_post', sa.Column('excerpt', sa.String(length=256), nullable=True))
+    op.add_column('freak_post', sa.Column('excerpt_html', sa.Text(), nullable=True))
+    op.execute('UPDATE freak_post SET excerpt = left(text_content, 180), html_version = NULL')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('freak_post', 'excerpt_html')
+    op.drop_column('freak_post', 'excerpt')
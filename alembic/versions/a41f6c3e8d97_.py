@@ -0,0 +1,43 @@
+"""timeline indexes
+
+Built CONCURRENTLY, so that they can be added to a live instance;
+that cannot happen inside a transaction.
+
+Revision ID: a41f6c3e8d97
+Revises: 5c1d7e9a2b84
+Create Date: 2026-10-18 23:40:12.660381
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a41f6c3e8d97'
+down_revision: Union[str, None] = '5c1d7e9a2b84'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('post_topic_timeline', 'freak_post', ['topic_id', 'created_at', 'id'], unique=False, postgresql_where=sa.text('removed_at IS NULL'), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('post_author_timeline', 'freak_post', ['author_id', 'created_at', 'id'], unique=False, postgresql_where=sa.text('removed_at IS NULL'), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('post_public_timeline', 'freak_post', ['created_at', 'id'], unique=False, postgresql_where=sa.text('removed_at IS NULL AND privacy = 0'), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('comment_thread', 'freak_comment', ['parent_post_id', 'parent_comment_id', 'created_at'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('post_upvote_tally', 'freak_post_upvote', ['post_id', 'is_downvote'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('postreport_target_status', 'freak_postreport', ['target_id', 'update_status'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('postreport_target_status', table_name='freak_postreport', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('post_upvote_tally', table_name='freak_post_upvote', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('comment_thread', table_name='freak_comment', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('post_public_timeline', table_name='freak_post', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('post_author_timeline', table_name='freak_post', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('post_topic_timeline', table_name='freak_post', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,43 @@
+"""comment thread indexes in page order
+
+Threads are paged by (created_at, id), but comment_thread had no
+id, and cannot give top level comments in order at all, since
+IS NULL does not fix parent_comment_id the way = does: every page
+was sorted, and the planner could as well pick comment_path.
+The new comment_thread is built before the old one is dropped,
+so that threads are never left without one.
+
+Revision ID: b3e8d1f6a459
+Revises: d4a9b2e71c53
+Create Date: 2026-10-21 11:02:37.509114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3e8d1f6a459'
+down_revision: Union[str, None] = 'd4a9b2e71c53'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('comment_top_level', 'freak_comment', ['parent_post_id', 'created_at', 'id'], unique=False, postgresql_where=sa.text('parent_comment_id IS NULL'), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('comment_thread_new', 'freak_comment', ['parent_post_id', 'parent_comment_id', 'created_at', 'id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('comment_thread', table_name='freak_comment', postgresql_concurrently=True, if_exists=True)
+    op.execute('ALTER INDEX comment_thread_new RENAME TO comment_thread')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('comment_thread_old', 'freak_comment', ['parent_post_id', 'parent_comment_id', 'created_at'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('comment_thread', table_name='freak_comment', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('comment_top_level', table_name='freak_comment', postgresql_concurrently=True, if_exists=True)
+    op.execute('ALTER INDEX comment_thread_old RENAME TO comment_thread')
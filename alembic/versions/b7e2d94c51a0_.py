@@ -0,0 +1,59 @@
+"""post stats for ranked feeds
+
+Revision ID: b7e2d94c51a0
+Revises: 4558503ef484
+Create Date: 2026-10-18 21:07:44.190532
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2d94c51a0'
+down_revision: Union[str, None] = '4558503ef484'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('freak_post_stats',
+    sa.Column('post_id', sa.BigInteger(), nullable=False),
+    sa.Column('topic_id', sa.BigInteger(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('score', sa.Integer(), server_default=sa.text('0'), nullable=False),
+    sa.Column('comment_count', sa.Integer(), server_default=sa.text('0'), nullable=False),
+    sa.Column('hot_rank', sa.Double(), server_default=sa.text('0'), nullable=False),
+    sa.Column('rising_rank', sa.Double(), server_default=sa.text('0'), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['freak_post.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('post_id')
+    )
+    ## backfill; rank formulas are the same as freak.models.hot_rank_of() and rising_rank_of()
+    op.execute("""
+    INSERT INTO freak_post_stats (post_id, topic_id, created_at, score, comment_count, hot_rank, rising_rank)
+    SELECT p.id, p.topic_id, p.created_at, s.score, s.comment_count,
+        sign(s.score) * log(greatest(abs(s.score), 1)) + (extract(epoch FROM p.created_at) - 1577833200) / 45000,
+        log(greatest(s.score + s.comment_count, 1)) + (extract(epoch FROM p.created_at) - 1577833200) / 7200
+    FROM freak_post p, LATERAL (SELECT
+        (SELECT coalesce(sum(CASE WHEN v.is_downvote THEN -1 ELSE 1 END), 0) FROM freak_post_upvote v WHERE v.post_id = p.id)::integer AS score,
+        (SELECT count(*) FROM freak_comment c WHERE c.parent_post_id = p.id)::integer AS comment_count
+    ) s
+    """)
+    op.create_index('post_stats_created', 'freak_post_stats', ['created_at'], unique=False)
+    op.create_index('post_stats_hot', 'freak_post_stats', ['hot_rank', 'post_id'], unique=False)
+    op.create_index('post_stats_rising', 'freak_post_stats', ['rising_rank', 'post_id'], unique=False)
+    op.create_index('post_stats_top', 'freak_post_stats', ['score', 'post_id'], unique=False)
+    op.create_index('post_stats_topic_hot', 'freak_post_stats', ['topic_id', 'hot_rank', 'post_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('post_stats_topic_hot', table_name='freak_post_stats')
+    op.drop_index('post_stats_top', table_name='freak_post_stats')
+    op.drop_index('post_stats_rising', table_name='freak_post_stats')
+    op.drop_index('post_stats_hot', table_name='freak_post_stats')
+    op.drop_index('post_stats_created', table_name='freak_post_stats')
+    op.drop_table('freak_post_stats')
@@ -0,0 +1,36 @@
+"""post full text search
+
+Adding a stored generated column rewrites freak_post; the GIN index
+is then built CONCURRENTLY, outside the transaction.
+
+Revision ID: c83f5a1e9d20
+Revises: a41f6c3e8d97
+Create Date: 2026-10-19 10:12:47.209355
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c83f5a1e9d20'
+down_revision: Union[str, None] = 'a41f6c3e8d97'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('freak_post', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("setweight(to_tsvector('simple', coalesce(title, '')), 'A') || setweight(to_tsvector('simple', coalesce(text_content, '')), 'B')", persisted=True), nullable=True))
+    with op.get_context().autocommit_block():
+        op.create_index('post_search', 'freak_post', ['search_vector'], unique=False, postgresql_using='gin', postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('post_search', table_name='freak_post', postgresql_using='gin', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('freak_post', 'search_vector')
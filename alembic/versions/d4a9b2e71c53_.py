@@ -0,0 +1,36 @@
+"""comment full text search
+
+Same as c83f5a1e9d20, for comments: type:comment searches used
+to scan the whole table with ILIKE.
+
+Revision ID: d4a9b2e71c53
+Revises: 3c8e1f5a7b20
+Create Date: 2026-10-21 09:41:05.118264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4a9b2e71c53'
+down_revision: Union[str, None] = '3c8e1f5a7b20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('freak_comment', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("to_tsvector('simple', text_content)", persisted=True), nullable=True))
+    with op.get_context().autocommit_block():
+        op.create_index('comment_search', 'freak_comment', ['search_vector'], unique=False, postgresql_using='gin', postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('comment_search', table_name='freak_comment', postgresql_using='gin', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('freak_comment', 'search_vector')
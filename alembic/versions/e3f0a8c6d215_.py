@@ -0,0 +1,38 @@
+"""post vote counters
+
+Revision ID: e3f0a8c6d215
+Revises: b7e2d94c51a0
+Create Date: 2026-10-18 22:15:03.554817
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3f0a8c6d215'
+down_revision: Union[str, None] = 'b7e2d94c51a0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('freak_post_stats', sa.Column('upvote_count', sa.Integer(), server_default=sa.text('0'), nullable=False))
+    op.add_column('freak_post_stats', sa.Column('downvote_count', sa.Integer(), server_default=sa.text('0'), nullable=False))
+    op.execute("""
+    UPDATE freak_post_stats s SET upvote_count = v.upvotes, downvote_count = v.downvotes
+    FROM (SELECT post_id,
+        count(*) FILTER (WHERE NOT is_downvote) AS upvotes,
+        count(*) FILTER (WHERE is_downvote) AS downvotes
+        FROM freak_post_upvote GROUP BY post_id) v
+    WHERE s.post_id = v.post_id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('freak_post_stats', 'downvote_count')
+    op.drop_column('freak_post_stats', 'upvote_count')
@@ -0,0 +1,68 @@
+"""comment materialized paths
+
+Paths are filled in batches of ids, in order, one transaction each.
+Replies come after their parent, so a batch only has to be gone over
+once per level of nesting within it. Comments left over (replies older
+than their parent, if any) are then filled from the top level down, and
+the index is built CONCURRENTLY.
+
+Revision ID: e7a35c0b8d16
+Revises: 9b4c2e6f1a73
+Create Date: 2026-10-19 21:05:33.640198
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a35c0b8d16'
+down_revision: Union[str, None] = '9b4c2e6f1a73'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 5000
+
+
+## a comment, and its parent's path
+_FILL_PATHS = '''
+    UPDATE freak_comment AS c
+    SET path = coalesce(p.path, '') || lpad(to_hex(c.id), 16, '0')
+    FROM freak_comment AS c2 LEFT JOIN freak_comment AS p ON p.id = c2.parent_comment_id
+    WHERE c.id = c2.id AND c2.id IN ({})
+'''
+_READY = "x.path IS NULL AND (x.parent_comment_id IS NULL OR xp.path IS NOT NULL)"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('freak_comment', sa.Column('path', sa.Text(collation='C'), nullable=True))
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        after = -1
+        while (upto := conn.execute(sa.text('''
+            SELECT max(id) FROM (SELECT id FROM freak_comment WHERE id > :after ORDER BY id LIMIT :batch_size) AS batch
+        '''), dict(after=after, batch_size=BATCH_SIZE)).scalar()) is not None:
+            ## a level of nesting each time
+            while conn.execute(sa.text(_FILL_PATHS.format(f'''
+                SELECT x.id FROM freak_comment AS x LEFT JOIN freak_comment AS xp ON xp.id = x.parent_comment_id
+                WHERE x.id > :after AND x.id <= :upto AND {_READY}
+            ''')), dict(after=after, upto=upto)).rowcount:
+                pass
+            after = upto
+        ## leftovers, if any
+        while conn.execute(sa.text(_FILL_PATHS.format(f'''
+            SELECT x.id FROM freak_comment AS x LEFT JOIN freak_comment AS xp ON xp.id = x.parent_comment_id
+            WHERE {_READY} LIMIT :batch_size
+        ''')), dict(batch_size=BATCH_SIZE)).rowcount:
+            pass
+        op.create_index('comment_path', 'freak_comment', ['parent_post_id', 'path'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('comment_path', table_name='freak_comment', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('freak_comment', 'path')
@@ -0,0 +1,36 @@
+"""trigram indexes on names
+
+Built CONCURRENTLY, so that they can be added to a live instance;
+that cannot happen inside a transaction.
+
+Revision ID: f2b6d0a94c17
+Revises: c83f5a1e9d20
+Create Date: 2026-10-19 11:03:25.814770
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2b6d0a94c17'
+down_revision: Union[str, None] = 'c83f5a1e9d20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        op.create_index('user_username_trgm', 'freak_user', ['username'], unique=False, postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'}, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('topic_name_trgm', 'freak_topic', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('topic_name_trgm', table_name='freak_topic', postgresql_using='gin', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('user_username_trgm', table_name='freak_user', postgresql_using='gin', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,79 @@
+"""
+Latency of short renders while long posts are being rendered.
+
+Usage: python3 benchmarks/rendering.py [--size CHARS] [--rate N] [--seconds S] [--workers W]
+
+Short renders stand in for every other request of the worker: their
+p50/p99 shows how much long renders hold up the event loop. Without
+--workers, runs once in process (0) and once with a pool of 2.
+Needs the same environment as the app.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument('--size', type=int, default=100_000, help='characters of a long post')
+parser.add_argument('--rate', type=float, default=2, help='long posts per second')
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--workers', type=int, default=None, help='FREAK_MARKDOWN_WORKERS (0 = in process)')
+
+SHORT_TEXT = 'A **short** comment, with a [link](https://example.com).'
+## seconds between short renders; each is timed from when it was due,
+## so that a stalled event loop counts against all the renders it delays
+SHORT_INTERVAL = .01
+
+async def bench(args):
+    from freak.rendering import render_markdown_async, shutdown_markdown_pool, start_markdown_pool
+
+    await start_markdown_pool()
+    long_text = ('Some *Markdown* text, `code` and ~~struck~~ words. ' * 20 + '\n\n') * (args.size // 1000 + 1)
+    deadline = time.perf_counter() + args.seconds
+    long_renders = []
+    latencies = []
+
+    async def render_long():
+        start = time.perf_counter()
+        await render_markdown_async(long_text)
+        long_renders.append(time.perf_counter() - start)
+
+    async def post_long():
+        tasks = []
+        while time.perf_counter() < deadline:
+            tasks.append(asyncio.create_task(render_long()))
+            await asyncio.sleep(1 / args.rate)
+        await asyncio.gather(*tasks)
+
+    async def render_short():
+        due = time.perf_counter()
+        while due < deadline:
+            await asyncio.sleep(max(due - time.perf_counter(), 0))
+            await render_markdown_async(SHORT_TEXT)
+            latencies.append(time.perf_counter() - due)
+            due += SHORT_INTERVAL
+
+    try:
+        await asyncio.gather(render_short(), post_long())
+    finally:
+        shutdown_markdown_pool()
+    q = statistics.quantiles(latencies, n=100, method='inclusive')
+    print(f'workers={args.workers}: {len(latencies)} short renders, p50 {q[49] * 1000:.2f} ms, '
+        f'p99 {q[98] * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms; '
+        f'{len(long_renders)} long renders, {statistics.mean(long_renders) * 1000:.0f} ms each')
+
+def main():
+    args = parser.parse_args()
+    if args.workers is None:
+        for workers in (0, 2):
+            subprocess.run([sys.executable, __file__, *sys.argv[1:], '--workers', str(workers)], check=True)
+        return
+    os.environ['FREAK_MARKDOWN_WORKERS'] = str(args.workers)
+    asyncio.run(bench(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Votes per second on a single post, written right away or buffered.
+
+Usage: python3 benchmarks/votes.py [--voters N] [--seconds S] [--concurrency C] [--interval MS]
+
+Without --interval, runs once unbuffered and once with a 100 ms flush
+interval. Needs the same environment as the app (DATABASE_URL etc.);
+creates its own users and post, and deletes them afterwards.
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument('--voters', type=int, default=200)
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--concurrency', type=int, default=16)
+parser.add_argument('--interval', type=int, default=None, help='FREAK_VOTE_FLUSH_INTERVAL, in milliseconds (0 = unbuffered)')
+
+async def bench(args):
+    from sqlalchemy import delete, insert
+    from freak import app
+    from freak.models import Post, PostStats, PostUpvote, User, db
+    from freak.votes import vote_buffer
+
+    await app.startup()
+    voters, post_id = [], None
+    try:
+        async with db as session:
+            for i in range(args.voters):
+                ## snowflakes made in the same millisecond may collide
+                await asyncio.sleep(.002)
+                voters.append((await session.execute(insert(User).values(username=f'vb{os.getpid()}x{i}',
+                    display_name='bench', passhash='x', gdpr_birthday=datetime.date(2000, 1, 1),
+                    joined_ip='127.0.0.1').returning(User.id))).scalar())
+            post_id = (await session.execute(insert(Post).values(author_id=voters[0], title='bench',
+                text_content='bench', created_ip='127.0.0.1').returning(Post.id))).scalar()
+            await PostStats.create_for(session, post_id)
+
+        accepted = 0
+        deadline = time.perf_counter() + args.seconds
+        async def worker(seed):
+            nonlocal accepted
+            rnd = random.Random(seed)
+            while time.perf_counter() < deadline:
+                async with db as session:
+                    await vote_buffer.cast(session, post_id, rnd.choice(voters), rnd.choice((-1, 1)))
+                accepted += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        await vote_buffer.flush()
+        written = time.perf_counter() - start
+        print(f'interval={args.interval}ms: {accepted} votes, '
+            f'{accepted / elapsed:.0f}/s accepted, {accepted / written:.0f}/s written')
+    finally:
+        async with db as session:
+            await session.execute(delete(PostUpvote).where(PostUpvote.c.voter_id.in_(voters)))
+            await session.execute(delete(Post).where(Post.id == post_id))
+            await session.execute(delete(User).where(User.id.in_(voters)))
+        await app.shutdown()
+
+def main():
+    args = parser.parse_args()
+    if args.interval is None:
+        for interval in (0, 100):
+            subprocess.run([sys.executable, __file__, *sys.argv[1:], '--interval', str(interval)], check=True)
+        return
+    os.environ['FREAK_VOTE_FLUSH_INTERVAL'] = str(args.interval)
+    asyncio.run(bench(args))
+
+if __name__ == '__main__':
+    main()
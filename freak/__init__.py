@@ -43,6 +43,20 @@ class AppConfig(ConfigOptions):
     app_is_behind_proxy = ConfigValue(cast=int, default=0)
     impressum = ConfigValue(cast=twocolon_list, default='')
     create_guild_threshold = ConfigValue(cast=int, default=15, prefix='freak_')
+    home_inbox = ConfigValue(cast=yesno, default=False, prefix='freak_')
+    fanout_threshold = ConfigValue(cast=int, default=1000, prefix='freak_')
+    leaderboard_interval = ConfigValue(cast=int, default=300, prefix='freak_')
+    page_cache_ttl = ConfigValue(cast=int, default=30, prefix='freak_')
+    page_cache_stale = ConfigValue(cast=int, default=300, prefix='freak_')
+    page_cache_max_entries = ConfigValue(cast=int, default=1000, prefix='freak_')
+    password_method = ConfigValue(default='scrypt:32768:8:1', prefix='freak_')
+    password_workers = ConfigValue(cast=int, default=2, prefix='freak_')
+    vote_flush_interval = ConfigValue(cast=int, default=0, prefix='freak_')
+    vote_journal_dir = ConfigValue(default='', prefix='freak_')
+    cache_url = ConfigValue(default='memory://', prefix='freak_')
+    cache_max_entries = ConfigValue(cast=int, default=2000, prefix='freak_')
+    markdown_workers = ConfigValue(cast=int, default=2, prefix='freak_')
+    markdown_pool_threshold = ConfigValue(cast=int, default=8192, prefix='freak_')
     # v-- deprecated --v
     jquery_url = ConfigValue(default='https://ajax.googleapis.com/ajax/libs/jquery/3.7.1/jquery.min.js')
     # ^----------------^
@@ -139,6 +153,10 @@ async def _inject_variables():
         'impressum': '\n'.join(app_config.impressum).replace('_', ' ')
     }
 
+@app.before_request
+async def _begin_request():
+    await db.begin_request()
+
 @app.before_request
 async def _load_user():
     try:
@@ -156,6 +174,17 @@ async def _unload_user(resp):
         logger.error(f'{e}')
     return resp
 
+@app.after_request
+async def _end_request(resp):
+    ## commit before the response goes out, so that a failed commit is not a success
+    await db.end_request(commit=resp.status_code < 400)
+    return resp
+
+@app.teardown_request
+async def _teardown_request(exc):
+    ## not ended yet if the request failed
+    await db.end_request(commit=False)
+
 
 def redact_url_password(u: str | Any) -> str | Any:
     if not isinstance(u, str):
@@ -275,6 +304,57 @@ app.register_blueprint(bp)
 from .rest import bp
 app.register_blueprint(bp)
 
+from .algorithms import guild_leaderboard
+from .votes import vote_buffer
+
+@app.before_serving
+async def _start_guild_leaderboard():
+    guild_leaderboard.start()
+
+@app.before_serving
+async def _start_vote_buffer():
+    vote_buffer.start()
+
+@app.after_serving
+async def _stop_guild_leaderboard():
+    await guild_leaderboard.stop()
+
+from .names import guild_names, user_names
+
+@app.before_serving
+async def _start_name_indexes():
+    guild_names.start()
+    user_names.start()
+
+@app.after_serving
+async def _stop_name_indexes():
+    await guild_names.stop()
+    await user_names.stop()
+
+@app.after_serving
+async def _stop_vote_buffer():
+    ## writes the pending votes
+    await vote_buffer.stop()
+
+from .cache import cache
+
+from .pagecache import page_cache
+
+@app.after_serving
+async def _close_cache():
+    await cache.close()
+    await page_cache.close()
+
+from .rendering import shutdown_markdown_pool, start_markdown_pool
+
+@app.before_serving
+async def _start_markdown_pool():
+    await start_markdown_pool()
+
+@app.after_serving
+async def _stop_markdown_pool():
+    shutdown_markdown_pool()
+
 
 
 
@@ -1,17 +1,22 @@
 
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+from functools import lru_cache
 import logging
 import enum
 import re
 
 from pydantic import BaseModel
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import make_transient_to_detached, selectinload
 from suou import age_and_days
 from suou.sqlalchemy.asyncio import AsyncSession
-from werkzeug.security import generate_password_hash
-from .models import REPORT_REASONS, User, db
+from werkzeug.security import check_password_hash, generate_password_hash
+from . import app_config
+from .cache import cache
+from .models import REPORT_REASONS, BlockSet, User, block_set_of, db
 from quart_auth import AuthUser, Action as _Action
 from quart_wtf.utils import validate_csrf 
 
@@ -23,7 +28,54 @@ class LoginStatus(enum.Enum):
     SUSPENDED = 2
     PASS_EXPIRED = 3
 
-def check_login(user: User | None, password: str) -> LoginStatus:
+## Password hashing ##
+
+## Hashes take tens of milliseconds of CPU each: they run in a small thread pool,
+## and at most FREAK_PASSWORD_WORKERS of them are queued at once. Requests past
+## that wait on the semaphore, and are dropped there if the client goes away.
+_hash_pool = ThreadPoolExecutor(max_workers=app_config.password_workers, thread_name_prefix='freak-passwords')
+_hash_slots = asyncio.Semaphore(app_config.password_workers)
+
+async def _run_hash(func, *args):
+    async with _hash_slots:
+        return await asyncio.get_running_loop().run_in_executor(_hash_pool, func, *args)
+
+async def hash_password(password: str) -> str:
+    """
+    Hash a password with FREAK_PASSWORD_METHOD, off the event loop.
+
+    NEW 0.5.0
+    """
+    return await _run_hash(generate_password_hash, password, app_config.password_method)
+
+async def verify_password(passhash: str, password: str) -> bool:
+    """
+    Check a password against its hash, off the event loop.
+
+    NEW 0.5.0
+    """
+    return await _run_hash(check_password_hash, passhash, password)
+
+@lru_cache(maxsize=None)
+def _current_hash_params() -> str:
+    ## normalized, e.g. 'scrypt' -> 'scrypt:32768:8:1'
+    return generate_password_hash('', app_config.password_method).partition('$')[0]
+
+def needs_rehash(passhash: str) -> bool:
+    """
+    Whether a hash was made with other parameters than FREAK_PASSWORD_METHOD.
+    """
+    return passhash.partition('$')[0] != _current_hash_params()
+
+async def check_login(user: User | None, password: str) -> LoginStatus:
+    """
+    Check the credentials of a login attempt.
+
+    On success, a hash made with outdated parameters is replaced; the change
+    is committed along with the request.
+
+    *Changed in 0.5.0*: now async.
+    """
     try:
         if user is None:
             return LoginStatus.ERROR
@@ -31,7 +83,10 @@ def check_login(user: User | None, password: str) -> LoginStatus:
             return LoginStatus.PASS_EXPIRED
         if not user.is_active:
             return LoginStatus.SUSPENDED
-        if user.check_password(password):
+        if await verify_password(user.passhash, password):
+            if needs_rehash(user.passhash):
+                user.passhash = await hash_password(password)
+                await forget_principal(user.id)
             return LoginStatus.SUCCESS
     except Exception as e:
         logger.error(f'{e}')
@@ -77,7 +132,7 @@ async def validate_register(data: RegisterIn) -> RegisterStatus | dict:
 
     if not data.password or data.password != data.confirm_password:
         return RegisterStatus.PASSWORD_INVALID
-    f['passhash'] = generate_password_hash(data.password)
+    f['passhash'] = await hash_password(data.password)
 
     f['email'] = data.email
 
@@ -91,6 +146,45 @@ async def validate_register(data: RegisterIn) -> RegisterStatus | dict:
 
     return f
 
+## Principal cache ##
+
+PRINCIPAL_TTL = 60
+## credentials and personal data are not cached (the cache may be shared, see
+## FREAK_CACHE_URL); they are loaded when needed
+PRINCIPAL_UNCACHED = frozenset({'passhash', 'email', 'joined_ip', 'gdpr_birthday'})
+
+async def load_principal(user_id: int) -> User | None:
+    """
+    The user behind a session, cached for PRINCIPAL_TTL seconds.
+
+    Only column values are cached, save for PRINCIPAL_UNCACHED. The User is
+    rebuilt from them and attached to the current session, as if just fetched;
+    the others are left unloaded. With a per-process cache, other processes
+    see changes when their copy expires.
+
+    NEW 0.5.0
+    """
+    columns = await cache.get(f'principal:{user_id}')
+    async with db as session:
+        if columns is not None:
+            user = User(**columns)
+            make_transient_to_detached(user)
+            session.add(user)
+            return user
+        user = (await session.execute(select(User).where(User.id == user_id))).scalar()
+    if user is not None:
+        await cache.set(f'principal:{user_id}', {
+            attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs if attr.key not in PRINCIPAL_UNCACHED
+        }, ttl=PRINCIPAL_TTL)
+    return user
+
+async def forget_principal(*user_ids: int):
+    """
+    Drop cached principals. To be called after a change to a user row
+    (settings, bans) and at logout.
+    """
+    await cache.delete(*(f'principal:{uid}' for uid in user_ids))
+
 
 class UserLoader(AuthUser):
     """
@@ -104,6 +198,7 @@ class UserLoader(AuthUser):
         self._auth_id = auth_id
         self._auth_obj = None
         self._auth_sess: AsyncSession | None = None
+        self._block_set: BlockSet | None = None
         self.action = action
     
     @property
@@ -117,10 +212,10 @@ class UserLoader(AuthUser):
 
     async def _load(self):
         if self._auth_obj is None and self._auth_id is not None:
-            async with db as session:
-                self._auth_obj = (await session.execute(select(User).where(User.id == int(self._auth_id)))).scalar()
-                if self._auth_obj is None:
-                    raise RuntimeError('failed to fetch user')
+            self._auth_obj = await load_principal(int(self._auth_id))
+            if self._auth_obj is None:
+                raise RuntimeError('failed to fetch user')
+            self._block_set = await block_set_of(self._auth_obj.id)
 
     def __getattr__(self, key):
         if self._auth_obj is None:
@@ -143,6 +238,23 @@ class UserLoader(AuthUser):
     def user(self):
         return self._auth_obj
 
+    async def age(self) -> int:
+        """
+        Age of the current user. The birthday is not in the principal cache,
+        so it is loaded here if needed.
+        """
+        if 'gdpr_birthday' in inspect(self._auth_obj).unloaded:
+            async with db as session:
+                await session.refresh(self._auth_obj, ['gdpr_birthday'])
+        return self._auth_obj.age()
+
+    @property
+    def block_set(self) -> BlockSet:
+        """
+        Users blocked by, and blocking, the current user. Empty if logged out.
+        """
+        return self._block_set or BlockSet()
+
     id: int
     username: str
     display_name: str
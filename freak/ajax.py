@@ -15,7 +15,10 @@ from suou import deprecated
 
 from . import UserLoader
 from .utils import get_request_form
-from .models import Guild, Member, UserBlock, db, User, Post, PostUpvote, username_is_legal
+from . import app_config
+from .models import Guild, Member, UserBlock, db, User, Post, backfill_home_inbox, drop_home_inbox, forget_block_set, username_is_legal
+from .names import guild_names, user_names
+from .votes import vote_buffer
 
 
 current_user: UserLoader
@@ -29,10 +32,7 @@ async def username_availability(username: str):
     is_valid = username_is_legal(username)
 
     if is_valid:
-        async with db as session:
-            user = (await session.execute(select(User).where(User.username == username))).scalar()
-
-            is_available = user is None or user == current_user.user
+        is_available = not await user_names.exists(username) or (bool(current_user) and username == current_user.username)
     else:
         is_available = False
 
@@ -47,10 +47,7 @@ async def guild_name_availability(name: str):
     is_valid = username_is_legal(name)
 
     if is_valid:
-        async with db as session:
-            gd = (await session.execute(select(Guild).where(Guild.name == name))).scalar()
-
-            is_available = gd is None
+        is_available = not await guild_names.exists(name)
     else:
         is_available = False
 
@@ -65,31 +62,17 @@ async def guild_name_availability(name: str):
 async def post_upvote(id):
     form = await get_request_form()
     o = form['o']
+    if o not in ('1', '0', '-1'):
+        return { 'status': 'fail', 'message': 'Invalid score' }, 400
+
     async with db as session:
-        p: Post | None = (await session.execute(select(Post).where(Post.id == id))).scalar()
+        count = await vote_buffer.cast(session, id, current_user.id, int(o))
 
-        if p is None:
+        if count is None:
             return { 'status': 'fail', 'message': 'Post not found' }, 404
-        
-        cur_score = await p.upvoted_by(current_user.user)
-
-        match (o, cur_score):
-            case ('1', 0) | ('1', -1):
-                await session.execute(delete(PostUpvote).where(PostUpvote.c.post_id == p.id, PostUpvote.c.voter_id == current_user.id, PostUpvote.c.is_downvote == True))
-                await session.execute(insert(PostUpvote).values(post_id = p.id, voter_id = current_user.id, is_downvote = False))
-            case ('0', _):
-                await session.execute(delete(PostUpvote).where(PostUpvote.c.post_id == p.id, PostUpvote.c.voter_id == current_user.id))
-            case ('-1', 1) | ('-1', 0):
-                await session.execute(delete(PostUpvote).where(PostUpvote.c.post_id == p.id, PostUpvote.c.voter_id == current_user.id, PostUpvote.c.is_downvote == False))
-                await session.execute(insert(PostUpvote).values(post_id = p.id, voter_id = current_user.id, is_downvote = True))
-            case ('1', 1) | ('-1', -1):
-                pass
-            case _:
-                await session.rollback()
-                return { 'status': 'fail', 'message': 'Invalid score' }, 400
-        
+
         await session.commit()
-        return { 'status': 'ok', 'count': await p.upvotes() }
+        return { 'status': 'ok', 'count': count }
 
 @bp.route('/@<username>/block', methods=['POST'])
 @login_required
@@ -106,7 +89,7 @@ async def block_user(username):
         is_unblock = form.get('reverse') == '1'
 
         if is_block:
-            if current_user.has_blocked(u):
+            if u.id in current_user.block_set.blocked:
                 await flash(f'{u.handle()} is already blocked')
             else:
                 await session.execute(insert(UserBlock).values(
@@ -116,7 +99,7 @@ async def block_user(username):
                 await flash(f'{u.handle()} is now blocked')
 
         if is_unblock:
-            if not current_user.has_blocked(u):
+            if u.id not in current_user.block_set.blocked:
                 await flash('You didn\'t block this user')
             else:
                 await session.execute(delete(UserBlock).where(
@@ -124,7 +107,10 @@ async def block_user(username):
                     UserBlock.c.target_id == u.id
                 ))
                 await flash(f'Removed block on {u.handle()}')
-            
+
+        ## commit first: a request reading the block sets in between would cache the old ones
+        await session.commit()
+        await forget_block_set(current_user.id, u.id)
     return redirect(request.args.get('next', u.url())), 303
 
 @bp.route('/+<name>/subscribe', methods=['POST'])
@@ -155,6 +141,8 @@ async def subscribe_guild(name):
                 await session.add(membership)
             else:
                 return redirect(gu.url()), 303
+            if app_config.home_inbox:
+                await backfill_home_inbox(session, user_id=current_user.id, guild_id=gu.id)
             await flash(f"You are now subscribed to {gu.handle()}")
 
         if is_leave:
@@ -165,6 +153,7 @@ async def subscribe_guild(name):
                 await session.add(membership)
             else:
                 return redirect(gu.url()), 303
+            await drop_home_inbox(session, current_user.id, gu.id)
 
             await session.commit()
             await flash(f"Unsubscribed from {gu.handle()}.")
@@ -1,25 +1,67 @@
 
 from __future__ import annotations
 
+import asyncio
+import base64
+import binascii
+from collections import namedtuple
+import datetime
+import logging
+import struct
+from typing import Any, Callable, Iterable, NamedTuple
+from urllib.parse import urlencode
 from freak.accounts import UserLoader
+from quart import abort, request
 from quart_auth import current_user
-from sqlalchemy import and_, distinct, func, or_, select
-from suou import not_implemented
+from sqlalchemy import Select, and_, distinct, extract, func, or_, select, true, tuple_
+from suou import deprecated
+from suou.sqlalchemy.asyncio import AsyncSelectPagination
 
-from .models import Comment, Member, Post, Guild, User
+from . import app_config
+from .cache import cache
+from .search import SearchQuery
+from .models import FEED_CARD, Comment, FeedCounts, HomeInbox, Member, Post, Guild, PostStats, User, db
+from .rendering import render_stale_excerpts
 
 current_user: UserLoader
 
+logger = logging.getLogger(__name__)
+
 def cuser() -> User:
     return current_user.user if current_user else None
 
 def cuser_id() -> int:
     return current_user.id if current_user else None
 
+def not_blocked(author_id_col):
+    """
+    Filter out content whose author has blocked the current user.
+
+    The block set is loaded along with the current user, so this is a plain
+    NOT IN instead of a subquery per row.
+    """
+    blocked_by = current_user.block_set.blocked_by
+    return author_id_col.not_in(blocked_by) if blocked_by else true()
+
+class TimelineKey(NamedTuple):
+    """
+    Sort key of a timeline: the SQL columns (post id last, as a tie-break),
+    how to get the leading value back from a fetched post, and the sort
+    (one of SORTS) it stands for, which cursors are bound to.
+    """
+    columns: tuple
+    value_of: Callable[[Post], Any]
+    sort: str = 'new'
+
+## Timelines are sorted by (created_at, id), newest first.
+## The id tie-break makes the order total, as keyset pagination requires.
+TIMELINE_KEY = TimelineKey((Post.created_at, Post.id), lambda p: p.created_at)
+TIMELINE_ORDER = (Post.created_at.desc(), Post.id.desc())
+
 def public_timeline():
     return select(Post).join(User, User.id == Post.author_id).where(
-        Post.privacy == 0, User.not_suspended(), Post.not_removed(), User.has_not_blocked(Post.author_id, cuser_id())
-    ).order_by(Post.created_at.desc())
+        Post.privacy == 0, User.not_suspended(), Post.not_removed(), not_blocked(Post.author_id)
+    ).order_by(*TIMELINE_ORDER).options(*FEED_CARD)
 
 def private_timeline(cuser: User):
     return select(Post).join(User, User.id == Post.author_id).join(Guild, Guild.id == Post.topic_id
@@ -30,27 +72,51 @@ def private_timeline(cuser: User):
             Member.user_id == cuser_id(),
             ##Friendship.,
         ),
-        User.not_suspended(), Post.not_removed(), User.has_not_blocked(Post.author_id, cuser_id()),
+        User.not_suspended(), Post.not_removed(), not_blocked(Post.author_id),
         or_(Post.privacy == 0, Post.privacy == 1,
             ##and_(Post.privacy == 2, Friendsip.)
         )
-    ).order_by(Post.created_at.desc())
+    ).order_by(*TIMELINE_ORDER).options(*FEED_CARD)
 
-def topic_timeline(gname):
-    return select(Post).join(Guild, Guild.id == Post.topic_id).join(User, User.id == Post.author_id).where(
-        Post.privacy == 0, Guild.name == gname, User.not_suspended(), Post.not_removed(), User.has_not_blocked(Post.author_id, cuser_id())
-    ).order_by(Post.created_at.desc())
+## home timeline from the materialized inbox (FREAK_HOME_INBOX=1)
+INBOX_KEY = TimelineKey((HomeInbox.c.created_at, HomeInbox.c.post_id), lambda p: p.created_at)
 
-def user_timeline(user: User):
+def inbox_timeline(cuser: User):
+    return select(Post).join(HomeInbox, HomeInbox.c.post_id == Post.id).join(User, User.id == Post.author_id).where(
+        HomeInbox.c.user_id == cuser.id,
+        User.not_suspended(), Post.not_removed(), not_blocked(Post.author_id),
+        or_(Post.privacy == 0, Post.privacy == 1)
+    ).order_by(HomeInbox.c.created_at.desc(), HomeInbox.c.post_id.desc()).options(*FEED_CARD)
+
+def fanout_on_read_timeline(cuser: User):
+    """
+    Posts from subscribed guilds too big to be fanned out. Merged with inbox_timeline() on read.
+    """
+    return select(Post).join(User, User.id == Post.author_id).where(
+        Post.topic_id.in_(
+            select(Member.guild_id).join(Guild, Guild.id == Member.guild_id).where(
+                Member.user_id == cuser.id, Member.is_subscribed == True, Guild.fanout_on_read == True
+            )
+        ),
+        User.not_suspended(), Post.not_removed(), not_blocked(Post.author_id),
+        or_(Post.privacy == 0, Post.privacy == 1)
+    ).order_by(*TIMELINE_ORDER).options(*FEED_CARD)
+
+def topic_timeline(guild: Guild):
+    """
+    *Changed in 0.5.0*: takes the guild instead of its name. Pass topic_id=guild.id
+    to timeline_page() too, so that ranked sorts use the per-guild indexes.
+    """
     return select(Post).join(User, User.id == Post.author_id).where(
-        Post.visible_by(cuser_id()), Post.author_id == user.id, User.not_suspended(), Post.not_removed(), User.has_not_blocked(Post.author_id, cuser_id())
-    ).order_by(Post.created_at.desc())
+        Post.privacy == 0, Post.topic_id == guild.id, User.not_suspended(), Post.not_removed(), not_blocked(Post.author_id)
+    ).order_by(*TIMELINE_ORDER).options(*FEED_CARD)
 
-def new_comments(p: Post):
-    return select(Comment).join(Post, Post.id == Comment.parent_post_id).join(User, User.id == Comment.author_id
-        ).where(Comment.parent_post_id == p.id, Comment.parent_comment_id == None, Comment.not_removed(), User.has_not_blocked(Comment.author_id, cuser_id())
-        ).order_by(Comment.created_at.desc())
+def user_timeline(user: User):
+    return select(Post).join(User, User.id == Post.author_id).where(
+        Post.visible_by(cuser_id()), Post.author_id == user.id, User.not_suspended(), Post.not_removed(), not_blocked(Post.author_id)
+    ).order_by(*TIMELINE_ORDER).options(*FEED_CARD)
 
+@deprecated('use guild_leaderboard.get() instead')
 def top_guilds_query():
     q_post_count = func.count(distinct(Post.id)).label('post_count')
     q_sub_count = func.count(distinct(Member.id)).label('sub_count')
@@ -60,13 +126,379 @@ def top_guilds_query():
         .group_by(Guild).having(q_post_count > 5).order_by(q_post_count.desc(), q_sub_count.desc())
     return qr
 
+## Top guilds leaderboard ##
+
+TopGuild = namedtuple('TopGuild', 'id name display_name post_count sub_count trending')
+
+## trending: activity halves in weight every day, and is only looked at for a week
+TRENDING_HALF_LIFE = 86400
+TRENDING_WINDOW = datetime.timedelta(days=7)
+
+class GuildLeaderboard:
+    """
+    In-memory snapshot of the top guilds, refreshed in the background
+    every FREAK_LEADERBOARD_INTERVAL seconds.
+
+    Counts are read off the narrow tables (PostStats, Member), grouped once
+    for all guilds. Trending is recent activity (posts, their comments and
+    upvotes), decayed by age.
+
+    NEW 0.5.0
+    """
+    def __init__(self):
+        self.guilds: list[TopGuild] = []
+        self.refreshed_at: datetime.datetime | None = None
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self):
+        age = extract('epoch', func.now() - PostStats.created_at)
+        activity = 1 + PostStats.comment_count + func.greatest(PostStats.score, 0)
+        post_q = select(PostStats.topic_id, func.count()).where(PostStats.topic_id != None).group_by(PostStats.topic_id)
+        sub_q = select(Member.guild_id, func.count()).where(Member.is_subscribed == True).group_by(Member.guild_id)
+        trending_q = select(PostStats.topic_id, func.sum(activity * func.power(0.5, age / TRENDING_HALF_LIFE))
+            ).where(PostStats.topic_id != None, PostStats.created_at >= datetime.datetime.now() - TRENDING_WINDOW
+            ).group_by(PostStats.topic_id)
+
+        async with db as session:
+            post_counts = {gid: cnt for gid, cnt in await session.execute(post_q)}
+            ## same threshold as top_guilds_query()
+            gids = [gid for gid, cnt in post_counts.items() if cnt > 5]
+            sub_counts = {gid: cnt for gid, cnt in await session.execute(sub_q.where(Member.guild_id.in_(gids)))}
+            trending = {gid: score for gid, score in await session.execute(trending_q.where(PostStats.topic_id.in_(gids)))}
+            guilds = (await session.execute(select(Guild.id, Guild.name, Guild.display_name).where(Guild.id.in_(gids)))).all()
+
+        self.guilds = sorted((
+            TopGuild(gid, name, display_name, post_counts[gid], sub_counts.get(gid, 0), float(trending.get(gid) or 0))
+            for gid, name, display_name in guilds
+        ), key=lambda g: (g.post_count, g.sub_count), reverse=True)
+        self.refreshed_at = datetime.datetime.now()
+
+    async def get(self, limit: int = 10, *, by: str = 'posts') -> list[TopGuild]:
+        """
+        Top guilds, by post count (then subscribers) or by trending score.
+        """
+        if self.refreshed_at is None:
+            ## background task not running (e.g. CLI), or not done yet
+            async with self._lock:
+                if self.refreshed_at is None:
+                    await self.refresh()
+        guilds = self.guilds
+        if by == 'trending':
+            guilds = sorted(guilds, key=lambda g: g.trending, reverse=True)
+        return guilds[:limit]
+
+    async def _run(self):
+        while True:
+            try:
+                async with self._lock:
+                    await self.refresh()
+            except Exception as e:
+                logger.error(f'cannot refresh top guilds: {e}')
+            await asyncio.sleep(app_config.leaderboard_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+guild_leaderboard = GuildLeaderboard()
+
+## Ranking ##
+
+SORTS = ('new', 'hot', 'top', 'rising')
+
+TIME_WINDOWS = {
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(days=7),
+    'month': datetime.timedelta(days=30),
+    'year': datetime.timedelta(days=365),
+    'all': None
+}
+
+## rising only looks at posts this young
+RISING_WINDOW = datetime.timedelta(days=1)
 
-@not_implemented()
 class Algorithms:
     """
-    Return SQL queries for algorithms.
+    Ranked orderings of timelines.
+
+    Ranks are stored in PostStats and kept up to date on write,
+    so each ordering is an index walk.
+
+    NEW 0.5.0
     """
     def __init__(self, me: User | None):
         self.me = me
-    
-    
\ No newline at end of file
+
+    def sorted(self, q: Select, sort: str = 'new', window: datetime.timedelta | None = None, *,
+        topic_id: int | None = None) -> tuple[Select, TimelineKey]:
+        """
+        Reorder a timeline (as returned by *_timeline()) by sort.
+
+        window restricts 'top' to posts younger than it. topic_id must be
+        given for guild timelines: the filter goes on PostStats, whose
+        indexes lead with it.
+
+        Returns the new query and its TimelineKey, to be passed to keyset_page().
+        """
+        now = datetime.datetime.now()
+        match sort:
+            case 'new':
+                return q, TIMELINE_KEY
+            case 'hot':
+                col = PostStats.hot_rank
+            case 'top':
+                col = PostStats.score
+                if window:
+                    q = q.where(PostStats.created_at >= now - window)
+            case 'rising':
+                col = PostStats.rising_rank
+                q = q.where(PostStats.created_at >= now - RISING_WINDOW)
+            case _:
+                raise ValueError(f'unknown sort: {sort!r}')
+        q = q.join(PostStats, PostStats.post_id == Post.id).order_by(None).order_by(col.desc(), PostStats.post_id.desc())
+        if topic_id is not None:
+            q = q.where(PostStats.topic_id == topic_id)
+        return q, TimelineKey((col, PostStats.post_id), lambda p, name=col.key: getattr(p.stats, name), sort)
+
+class FeedPage:
+    """
+    A page of posts, already fetched, along with their feed counts.
+
+    Iterating it yields posts. Counts of a post are at .counts[p.id].
+
+    NEW 0.5.0
+    """
+    def __init__(self, items: list[Post], counts: dict[int, FeedCounts], *, page: int = 1, pages: int | None = None,
+        has_next: bool = False, next_cursor: str | None = None):
+        self.items = items
+        self.counts = counts
+        self.page = page
+        self.pages = pages
+        self.has_next = has_next
+        self.next_cursor = next_cursor
+        ## extra query args to carry over to the next page, e.g. sort
+        self.args: dict[str, str] = {}
+
+    @property
+    def next_href(self) -> str:
+        """
+        Query string of the next page.
+        """
+        if self.next_cursor:
+            args = dict(cursor=self.next_cursor, **self.args)
+        else:
+            args = dict(page=self.page + 1, **self.args)
+        return '?' + urlencode(args)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def feed_info(self) -> list[dict]:
+        """
+        REST representation of the whole page.
+        """
+        return [p.feed_info_with(self.counts[p.id]) for p in self.items]
+
+async def hydrate_page(pagination: AsyncSelectPagination) -> FeedPage:
+    """
+    Fetch a page of posts, then their comment counts and votes in bulk.
+    """
+    items = [p async for p in pagination]
+    counts = await Post.feed_counts([p.id for p in items], cuser())
+    await render_stale_excerpts(items)
+    return FeedPage(items, counts, page=pagination.page, pages=pagination.pages, has_next=pagination.has_next)
+
+## Keyset pagination ##
+
+FEED_PAGE_SIZE = 20
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+## (sort tag, value, post id, page) by sort; values of new are datetimes,
+## in µs since _EPOCH, hot and rising ranks are floats, top scores ints
+_CURSOR_FORMATS = {
+    'new': (b'n', '>cqqH'),
+    'hot': (b'h', '>cdqH'),
+    'top': (b't', '>cqqH'),
+    'rising': (b'r', '>cdqH'),
+}
+
+def encode_cursor(value: datetime.datetime | float | int, post_id: int, page: int, sort: str = 'new') -> str:
+    """
+    Opaque cursor pointing right after the post with key (value, post_id)
+    in a timeline sorted by sort. It carries the page number too, in order
+    not to lose track of scroll depth.
+    """
+    tag, fmt = _CURSOR_FORMATS[sort]
+    if sort == 'new':
+        value = (value - _EPOCH) // datetime.timedelta(microseconds=1)
+    raw = struct.pack(fmt, tag, value, post_id, min(page, 0xffff))
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def decode_cursor(cursor: str, sort: str = 'new') -> tuple[datetime.datetime | float | int, int, int]:
+    """
+    Inverse of encode_cursor(). Raises ValueError on malformed input, and
+    on cursors of timelines sorted otherwise (their values can't be compared).
+    """
+    tag, fmt = _CURSOR_FORMATS[sort]
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_tag, value, post_id, page = struct.unpack(fmt, raw)
+    except (binascii.Error, struct.error) as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
+    if cursor_tag != tag:
+        raise ValueError(f'cursor is not for sort={sort}: {cursor!r}')
+    if sort == 'new':
+        value = _EPOCH + datetime.timedelta(microseconds=value)
+    return value, post_id, page
+
+async def keyset_page(q: Select, cursor: str | None = None, *, per_page: int = FEED_PAGE_SIZE,
+    key: TimelineKey = TIMELINE_KEY, merge_with: Iterable[Select] = ()) -> FeedPage:
+    """
+    Fetch the page of a timeline following cursor (or the first one if None).
+
+    q must be ordered by key columns, descending. Every page costs the same
+    as the first one, and posts arriving mid-scroll do not shift the following pages.
+
+    Queries in merge_with (same key) are fetched the same way
+    and merged into the page.
+    """
+    page = 1
+    sources = [(q, key), *((mq, TIMELINE_KEY) for mq in merge_with)]
+    if cursor:
+        value, post_id, page = decode_cursor(cursor, key.sort)
+        sources = [(sq.where(tuple_(*skey.columns) < tuple_(value, post_id)), skey) for sq, skey in sources]
+
+    items: dict[int, Post] = {}
+    async with db as session:
+        for sq, _ in sources:
+            for p in (await session.execute(sq.limit(per_page + 1))).scalars():
+                items[p.id] = p
+        items: list[Post] = sorted(items.values(), key=lambda p: (key.value_of(p), p.id), reverse=True)
+
+    has_next = len(items) > per_page
+    items = items[:per_page]
+    next_cursor = encode_cursor(key.value_of(items[-1]), items[-1].id, page + 1, key.sort) if has_next else None
+    counts = await Post.feed_counts([p.id for p in items], cuser())
+    await render_stale_excerpts(items)
+    return FeedPage(items, counts, page=page, has_next=has_next, next_cursor=next_cursor)
+
+async def timeline_page(q: Select, *, topic_id: int | None = None, **kwargs) -> FeedPage:
+    """
+    Fetch the page of a timeline requested by the current request.
+
+    Pages are keyed by ?cursor= ; ?page= (OFFSET pagination) is still honored
+    for old links. ?sort= (one of SORTS) and ?t= (one of TIME_WINDOWS,
+    for sort=top) select the ordering.
+
+    topic_id is the guild of a topic_timeline(). Other keyword arguments
+    are passed to keyset_page().
+    """
+    sort = request.args.get('sort', 'new')
+    window = request.args.get('t', 'all')
+    if sort not in SORTS or window not in TIME_WINDOWS:
+        abort(400, 'Invalid sort')
+    args = {}
+    if sort != 'new':
+        q, kwargs['key'] = Algorithms(cuser()).sorted(q, sort, TIME_WINDOWS[window], topic_id=topic_id)
+        args['sort'] = sort
+        if sort == 'top' and window != 'all':
+            args['t'] = window
+
+    if 'page' in request.args:
+        page = await hydrate_page(await db.paginate(q))
+    else:
+        try:
+            page = await keyset_page(q, request.args.get('cursor'), **kwargs)
+        except ValueError:
+            abort(400, 'Invalid cursor')
+    page.args = args
+    return page
+
+async def home_page(cuser: User) -> FeedPage:
+    """
+    Page of the home timeline. Reads from the materialized inbox if enabled
+    (FREAK_HOME_INBOX=1), merging in the posts from big guilds.
+
+    Ranked sorts always read from the guilds.
+    """
+    if not app_config.home_inbox or 'page' in request.args or request.args.get('sort', 'new') != 'new':
+        return await timeline_page(private_timeline(cuser))
+    return await timeline_page(inbox_timeline(cuser), key=INBOX_KEY, merge_with=[fanout_on_read_timeline(cuser)])
+
+
+## Search ##
+
+## seconds the results of a query are cached for
+SEARCH_CACHE_TTL = 60
+## results past this many are not shown; refine the query
+SEARCH_MAX_RESULTS = 500
+
+async def search_ids(sq: SearchQuery) -> list[int]:
+    """
+    Ids of the results of a search, best first.
+
+    Guild and user names are looked up first, so that the search filters
+    on topic_id and author_id. Cached per normalized query, hence shared by
+    all users: only public, not removed content by users not suspended is
+    found here, and blocks are applied by search_page().
+
+    NEW 0.5.0
+    """
+    key = f'search:{sq.normalized()}'
+    if (ids := await cache.get(key)) is not None:
+        return ids
+    table = Comment if sq.kind == 'comment' else Post
+    async with db as session:
+        q = sq.select(table, [Comment.text_content] if table is Comment else [Post.title, Post.text_content])
+        q = q.with_only_columns(table.id)
+        if sq.guilds:
+            guild_ids = list((await session.execute(select(Guild.id).where(Guild.name.in_(sq.guilds)))).scalars())
+            if table is Comment:
+                q = q.where(Comment.parent_post_id.in_(select(Post.id).where(Post.topic_id.in_(guild_ids))))
+            else:
+                q = q.where(Post.topic_id.in_(guild_ids))
+        if sq.users:
+            user_ids = list((await session.execute(select(User.id).where(User.username.in_(sq.users)))).scalars())
+            q = q.where(table.author_id.in_(user_ids))
+        if table is Comment:
+            q = q.join(Post, Post.id == Comment.parent_post_id).outerjoin(User, User.id == Comment.author_id
+                ).where(Comment.removed_at == None)
+        else:
+            q = q.join(User, User.id == Post.author_id)
+        q = q.where(Post.privacy == 0, Post.not_removed(), User.not_suspended())
+        ids = list((await session.execute(q.limit(SEARCH_MAX_RESULTS))).scalars())
+    await cache.set(key, ids, ttl=SEARCH_CACHE_TTL)
+    return ids
+
+async def search_page(sq: SearchQuery, page: int = 1, *, per_page: int = FEED_PAGE_SIZE) -> FeedPage:
+    """
+    A page of search results: posts (with their feed counts) or comments,
+    depending on the query.
+    Results by users who blocked the current user are left out.
+
+    NEW 0.5.0
+    """
+    ids = await search_ids(sq)
+    page_ids = ids[(page - 1) * per_page:page * per_page]
+    async with db as session:
+        if sq.kind == 'comment':
+            found = {c.id: c for c in (await session.execute(select(Comment).where(Comment.id.in_(page_ids),
+                or_(Comment.author_id == None, not_blocked(Comment.author_id))))).scalars()}
+        else:
+            found = {p.id: p for p in (await session.execute(select(Post).where(Post.id.in_(page_ids),
+                not_blocked(Post.author_id)).options(*FEED_CARD))).scalars()}
+    items = [found[i] for i in page_ids if i in found]
+    counts = {}
+    if sq.kind == 'post':
+        counts = await Post.feed_counts([p.id for p in items], cuser())
+        await render_stale_excerpts(items)
+    return FeedPage(items, counts, page=page, pages=-(-len(ids) // per_page), has_next=len(ids) > page * per_page)
@@ -0,0 +1,391 @@
+"""
+Cache shared by the whole app, configured with FREAK_CACHE_URL:
+
+- memory:// (default) is an LRU private to each worker process,
+  bounded at FREAK_CACHE_MAX_ENTRIES entries;
+- redis://[[user]:password@]host[:port][/db] (or rediss:// for TLS) is
+  shared by all workers, and talks to any Redis-compatible server
+  (Redis 7+, Valkey...).
+
+Entries have an optional TTL and tags; purge() drops every entry with
+a given tag. None is never cached, since get() returns it for a miss.
+
+Stores may be bounded (see open_cache()), so that a kind of entries
+that comes in large numbers (e.g. pages) can't push the others out.
+
+NEW 0.5.0
+"""
+
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+import asyncio
+from collections import OrderedDict, defaultdict
+from functools import wraps
+import logging
+import pickle
+import ssl
+import time
+from typing import Any, Callable, Iterable
+from urllib.parse import unquote, urlsplit
+
+from . import app_config
+
+logger = logging.getLogger(__name__)
+
+class CacheError(Exception):
+    """
+    The cache server could not be reached, or answered with an error.
+    """
+
+class Cache(ABC):
+    """
+    Interface of cache backends. Keys and tags are strings.
+    """
+    async def get(self, key: str) -> Any | None:
+        return (await self.get_many([key])).get(key)
+
+    async def set(self, key: str, value: Any, *, ttl: int | None = None, tags: Iterable[str] = ()):
+        await self.set_many({key: value}, ttl=ttl, tags=tags)
+
+    @abstractmethod
+    async def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        """
+        Return the found keys with their values. Missing keys are left out.
+        """
+
+    @abstractmethod
+    async def set_many(self, mapping: dict[str, Any], *, ttl: int | None = None, tags: Iterable[str] = ()):
+        """
+        Store many values, all with the same TTL (in seconds) and tags.
+        """
+
+    @abstractmethod
+    async def delete(self, *keys: str):
+        ...
+
+    @abstractmethod
+    async def purge(self, *tags: str):
+        """
+        Drop every entry tagged with any of tags.
+        """
+
+    async def close(self):
+        pass
+
+class MemoryCache(Cache):
+    """
+    In-process LRU cache.
+    """
+    def __init__(self, max_entries: int = 2000):
+        self.max_entries = max_entries
+        ## key -> (expires at or None, value, tags)
+        self._entries: OrderedDict[str, tuple[float | None, Any, frozenset[str]]] = OrderedDict()
+        self._tagged: dict[str, set[str]] = defaultdict(set)
+
+    def _drop(self, key: str):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tagged[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tagged[tag]
+
+    async def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            if (entry := self._entries.get(key)) is None:
+                continue
+            if entry[0] is not None and entry[0] <= now:
+                self._drop(key)
+                continue
+            self._entries.move_to_end(key)
+            found[key] = entry[1]
+        return found
+
+    async def set_many(self, mapping: dict[str, Any], *, ttl: int | None = None, tags: Iterable[str] = ()):
+        expires_at = time.monotonic() + ttl if ttl else None
+        tags = frozenset(tags)
+        for key, value in mapping.items():
+            if key in self._entries:
+                self._drop(key)
+            if value is None:
+                continue
+            self._entries[key] = (expires_at, value, tags)
+            for tag in tags:
+                self._tagged[tag].add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            if key in self._entries:
+                self._drop(key)
+
+    async def purge(self, *tags: str):
+        for tag in tags:
+            for key in list(self._tagged.get(tag, ())):
+                self._drop(key)
+
+## RESP (REdis Serialization Protocol) ##
+
+def _encode_command(args: tuple) -> bytes:
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = (await reader.readuntil(b'\r\n'))[:-2]
+    kind, rest = line[:1], line[1:]
+    match kind:
+        case b'+':
+            return rest.decode()
+        case b'-':
+            ## returned, not raised, so that the rest of a pipeline is still read
+            return CacheError(rest.decode())
+        case b':':
+            return int(rest)
+        case b'$':
+            if int(rest) < 0:
+                return None
+            return (await reader.readexactly(int(rest) + 2))[:-2]
+        case b'*':
+            if int(rest) < 0:
+                return None
+            return [await _read_reply(reader) for _ in range(int(rest))]
+        case _:
+            raise CacheError(f'unexpected reply: {line[:50]!r}')
+
+## seconds to wait for the server before giving up
+REDIS_TIMEOUT = 2
+## seconds to leave the server alone after a connection failure
+REDIS_RETRY_AFTER = 5
+## connections per worker and event loop
+REDIS_POOL_SIZE = 4
+
+class _RedisConnection:
+    """
+    A connection to the server. Commands are pipelined: all of them
+    are sent, then all the replies are read.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, commands: list[tuple]) -> list:
+        self.writer.write(b''.join(_encode_command(c) for c in commands))
+        await self.writer.drain()
+        replies = [await _read_reply(self.reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, CacheError):
+                raise reply
+        return replies
+
+    def close(self):
+        try:
+            self.writer.close()
+        except RuntimeError:
+            ## its event loop is gone
+            pass
+
+class RedisCache(Cache):
+    """
+    Cache on a Redis-compatible server, over a small pool of pipelined
+    connections.
+
+    Values are pickled. Keys live under prefix, and each tag is a set
+    of keys. If the server is unreachable, reads miss and writes are
+    dropped (with a log line), so that the site stays up.
+
+    With max_entries, keys are also listed in a sorted set by expiry time,
+    and the ones closest to expiry are dropped past max_entries. Otherwise,
+    the server's own eviction policy applies.
+    """
+    def __init__(self, url: str, *, prefix: str = 'freak:', max_entries: int | None = None,
+            pool_size: int = REDIS_POOL_SIZE):
+        u = urlsplit(url)
+        self.host = u.hostname or 'localhost'
+        self.port = u.port or 6379
+        self.username = unquote(u.username) if u.username else None
+        self.password = unquote(u.password) if u.password else None
+        self.db = int(u.path.strip('/') or 0)
+        self.tls = u.scheme == 'rediss'
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.pool_size = pool_size
+        self._idle: list[_RedisConnection] = []
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._down_until = 0.0
+
+    async def _connect(self) -> _RedisConnection:
+        conn = _RedisConnection(*await asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context() if self.tls else None))
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.username, self.password) if self.username else ('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            try:
+                await conn.send(setup)
+            except BaseException:
+                conn.close()
+                raise
+        return conn
+
+    def _close_idle(self):
+        while self._idle:
+            self._idle.pop().close()
+
+    async def execute(self, *commands: tuple) -> list:
+        """
+        Send commands in one pipeline, on one connection, and return
+        their replies. Raises CacheError.
+        """
+        ## connections can't be shared between event loops (e.g. CLI runs)
+        if self._loop is not asyncio.get_running_loop():
+            self._close_idle()
+            self._loop = asyncio.get_running_loop()
+            self._slots = asyncio.Semaphore(self.pool_size)
+        async with self._slots:
+            conn = self._idle.pop() if self._idle else None
+            try:
+                if conn is None:
+                    if self._down_until > time.monotonic():
+                        raise CacheError('server down, retrying later')
+                    try:
+                        conn = await asyncio.wait_for(self._connect(), REDIS_TIMEOUT)
+                    except (OSError, asyncio.TimeoutError):
+                        self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+                        raise
+                replies = await asyncio.wait_for(conn.send(list(commands)), REDIS_TIMEOUT)
+            except BaseException as e:
+                ## an error reply, or cancelled halfway: the stream may be out of sync
+                if conn is not None:
+                    conn.close()
+                if isinstance(e, (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError)):
+                    raise CacheError(f'{e.__class__.__name__}: {e}') from e
+                raise
+            self._idle.append(conn)
+            return replies
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _tag_key(self, tag: str) -> str:
+        return self.prefix + 'tag:' + tag
+
+    @property
+    def _index_key(self) -> str:
+        return self.prefix + 'index'
+
+    async def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            values, = await self.execute(('MGET', *map(self._key, keys)))
+        except CacheError as e:
+            logger.warning(f'cache read failed: {e}')
+            return {}
+        return {key: pickle.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    async def set_many(self, mapping: dict[str, Any], *, ttl: int | None = None, tags: Iterable[str] = ()):
+        commands = []
+        for key, value in mapping.items():
+            if value is None:
+                commands.append(('DEL', self._key(key)))
+            elif ttl:
+                commands.append(('SET', self._key(key), pickle.dumps(value), 'EX', ttl))
+            else:
+                commands.append(('SET', self._key(key), pickle.dumps(value)))
+        keys = [self._key(key) for key, value in mapping.items() if value is not None]
+        for tag in (tags if keys else ()):
+            commands.append(('SADD', self._tag_key(tag), *keys))
+            if ttl:
+                ## a tag lives as long as its longest lived key
+                commands.append(('EXPIRE', self._tag_key(tag), ttl, 'NX'))
+                commands.append(('EXPIRE', self._tag_key(tag), ttl, 'GT'))
+        if self.max_entries and keys:
+            expires_at = time.time() + ttl if ttl else '+inf'
+            commands.append(('ZADD', self._index_key, *(x for key in keys for x in (expires_at, key))))
+            commands.append(('ZREMRANGEBYSCORE', self._index_key, '-inf', time.time()))
+            ## all but the max_entries latest to expire
+            commands.append(('ZRANGE', self._index_key, 0, -self.max_entries - 1))
+            commands.append(('ZREMRANGEBYRANK', self._index_key, 0, -self.max_entries - 1))
+        if not commands:
+            return
+        try:
+            replies = await self.execute(*commands)
+            if self.max_entries and keys and (evicted := replies[-2]):
+                await self.execute(('DEL', *evicted))
+        except CacheError as e:
+            logger.warning(f'cache write failed: {e}')
+
+    async def delete(self, *keys: str):
+        if not keys:
+            return
+        try:
+            commands = [('DEL', *map(self._key, keys))]
+            if self.max_entries:
+                commands.append(('ZREM', self._index_key, *map(self._key, keys)))
+            await self.execute(*commands)
+        except CacheError as e:
+            logger.warning(f'cache delete failed: {e}')
+
+    async def purge(self, *tags: str):
+        if not tags:
+            return
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        try:
+            members = await self.execute(*(('SMEMBERS', tk) for tk in tag_keys))
+            keys = {k for keys in members for k in keys}
+            commands = [('DEL', *tag_keys, *keys)]
+            if self.max_entries and keys:
+                commands.append(('ZREM', self._index_key, *keys))
+            await self.execute(*commands)
+        except CacheError as e:
+            logger.warning(f'cache purge failed: {e}')
+
+    async def close(self):
+        self._close_idle()
+
+def open_cache(url: str, *, namespace: str | None = None, max_entries: int | None = None) -> Cache:
+    """
+    Open the store at url. A namespace gets a store of its own: a separate
+    LRU in memory, or separate keys (bounded at max_entries) on Redis.
+    """
+    scheme = urlsplit(url).scheme
+    if scheme == 'memory':
+        return MemoryCache(max_entries or app_config.cache_max_entries)
+    if scheme in ('redis', 'rediss'):
+        if namespace is None:
+            return RedisCache(url)
+        return RedisCache(url, prefix=f'freak:{namespace}:', max_entries=max_entries)
+    raise ValueError(f'unsupported cache URL: {url!r}')
+
+cache = open_cache(app_config.cache_url)
+
+def cached(ttl: int, key: str, *, tags: Iterable[str] = ()):
+    """
+    Cache the result of an async function.
+
+    key and tags are format strings, filled with the call arguments:
+    e.g. 'strike_count:{0.id}' for a method of a User.
+    """
+    def decorator(func: Callable):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = key.format(*args, **kwargs)
+            if (value := await cache.get(k)) is not None:
+                return value
+            value = await func(*args, **kwargs)
+            await cache.set(k, value, ttl=ttl, tags=[t.format(*args, **kwargs) for t in tags])
+            return value
+        return wrapper
+    return decorator
@@ -7,13 +7,17 @@ import subprocess
 from sqlalchemy import create_engine, select
 from sqlalchemy.orm import Session
 from . import __version__ as version, app_config
-from .models import User, db
+from .models import PostStats, User, backfill_home_inbox, db
+from .rendering import RENDERER_VERSION, rerender_all
 
 def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', '-v', action='version', version=version)
     parser.add_argument('--upgrade', '-U', action='store_true', help='create or upgrade schema')
     parser.add_argument('--flush',   '-H', action='store_true', help='recompute karma for all users')
+    parser.add_argument('--backfill-inbox', action='store_true', help='fill home timeline inboxes of existing users')
+    parser.add_argument('--reconcile', action='store_true', help='recount post votes and comments')
+    parser.add_argument('--rerender', action='store_true', help='render Markdown of posts, comments and guilds again')
     return parser
 
 async def main():
@@ -40,5 +44,22 @@ async def main():
             session.commit()
         print(f'Recomputed karma of {cnt} users')
 
+    if args.backfill_inbox:
+        async with db as session:
+            await backfill_home_inbox(session)
+            await session.commit()
+        print('Home inboxes backfilled')
+
+    if args.reconcile:
+        async with db as session:
+            cnt = await PostStats.reconcile(session)
+            await session.commit()
+        print(f'Fixed counters of {cnt} posts')
+
+    if args.rerender:
+        async with db as session:
+            cnt = await rerender_all(session)
+        print(f'Rendered {cnt} rows (renderer version {RENDERER_VERSION})')
+
     print(f'Visit <https://{app_config.server_name}>')
 
@@ -1,28 +1,38 @@
 
-import markdown
 from markupsafe import Markup
 
 from suou import Siq, Snowflake
-from suou.markdown import StrikethroughExtension, SpoilerExtension, PingExtension
 
 from . import app
-
-# make spoilers prevail over blockquotes
-SpoilerExtension.patch_blockquote_processor()
+from .rendering import render_markdown, render_markdown_async, stored_excerpt_html, stored_html
 
 @app.template_filter()
 def to_markdown(text, toc = False):
-    extensions = [
-        'tables', 'footnotes', 'fenced_code', 'sane_lists',
-        StrikethroughExtension(), SpoilerExtension(),
-        PingExtension({'@': '/@', '+': '/+'})
-    ]
-    if toc:
-        extensions.append('toc')
-    return Markup(markdown.Markdown(extensions=extensions).convert(text))
+    return Markup(render_markdown(text, toc))
 
 app.template_filter('markdown')(to_markdown)
 
+@app.template_filter()
+async def to_markdown_async(text, toc = False):
+    """
+    Same as to_markdown, but long texts are rendered off the event loop. NEW 0.5.0
+    """
+    return Markup(await render_markdown_async(text, toc))
+
+@app.template_filter()
+async def rendered(obj):
+    """
+    Stored HTML of a post, comment or guild description. NEW 0.5.0
+    """
+    return Markup(await stored_html(obj))
+
+@app.template_filter()
+async def excerpt(post):
+    """
+    Stored HTML excerpt of a post, for feeds. NEW 0.5.0
+    """
+    return Markup(await stored_excerpt_html(post))
+
 @app.template_filter()
 def to_b32l(n):
     return Snowflake(n).to_b32l()
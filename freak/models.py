@@ -4,23 +4,30 @@ from __future__ import annotations
 
 import asyncio
 from collections import namedtuple
+from contextvars import ContextVar
 import datetime
-from functools import partial
+from functools import partial, wraps
+import inspect
 from operator import or_
 import re
 from threading import Lock
-from typing import Any, Callable
+import time
+from typing import Any, Callable, Iterable
 from quart_auth import current_user
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, and_, insert, text, \
+from sqlalchemy import Column, Computed, Double, Index, Integer, String, ForeignKey, UniqueConstraint, and_, case, delete, insert, text, \
     CheckConstraint, Date, DateTime, Boolean, func, BigInteger, \
-    SmallInteger, select, update, Table
-from sqlalchemy.orm import Relationship, relationship
-from suou.sqlalchemy.asyncio import SQLAlchemy
+    Select, SmallInteger, Text, extract, literal, literal_column, select, update, Table
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Relationship, aliased, defer, deferred, raiseload, relationship, selectinload
+from suou.sqlalchemy.asyncio import SQLAlchemy, SessionWrapper
 from suou import SiqType, Snowflake, Wanted, deprecated, makelist, not_implemented, want_isodate
 from suou.sqlalchemy import create_session, declarative_base, id_column, parent_children, snowflake_column
 from werkzeug.security import check_password_hash
 
 from . import app_config
+from .cache import cache, cached
+from .search import TS_CONFIG
 from .utils import get_remote_addr
 
 from suou import timed_cache, age_and_days
@@ -115,7 +122,121 @@ def want_User(o: User | Any | None, *, prefix: str = '', var_name: str = '') ->
 
 Base = declarative_base(app_config.server_name, app_config.secret_key, 
     snowflake_epoch=1577833200)
-db = SQLAlchemy(model_class=Base)
+
+class RequestSession(SessionWrapper):
+    """
+    The session of a request, shared by every `async with db` block run while serving it.
+
+    Statements are serialized (concurrent helpers wait for their turn), so that
+    a request never holds more than one pooled connection: every coroutine
+    method of the session (execute(), refresh(), delete()...) takes the lock.
+
+    NEW 0.5.0
+    """
+    def __init__(self, session):
+        super().__init__(session)
+        self._lock = asyncio.Lock()
+
+    def __getattr__(self, key):
+        attr = getattr(self._session, key)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+        @wraps(attr)
+        async def locked(*args, **kwargs):
+            async with self._lock:
+                return await attr(*args, **kwargs)
+        return locked
+
+    async def recover(self):
+        """
+        Roll back after a failed statement, so that the request can go on
+        (e.g. to show an error page).
+
+        Rolling back expires every object, so the current user, which
+        templates read, is loaded again.
+        """
+        await self.rollback()
+        if current_user and (user := current_user.user) is not None and user in self._session:
+            await self.refresh(user)
+
+    ## these go straight to the session in SessionWrapper
+
+    async def get_one(self, query: Select):
+        return (await self.execute(query)).scalar()
+
+    async def get_list(self, query: Select, limit: int | None = None):
+        if limit:
+            query = query.limit(limit)
+        return list((await self.execute(query)).scalars())
+
+    def __del__(self):
+        ## closed by end_request()
+        pass
+
+class FreakSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy() with a unit of work per request.
+
+    Between begin_request() and end_request(), `async with db as session` hands out
+    the request session, and leaves committing to end_request(); a block exiting
+    with an exception rolls the request session back. Elsewhere (CLI,
+    background tasks) each block gets its own session, committed on exit.
+
+    NEW 0.5.0
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._request_session: ContextVar[RequestSession | None] = ContextVar('request_session', default=None)
+        ## sessions opened by the `async with` blocks of the current context, innermost last
+        self._open_sessions: ContextVar[tuple] = ContextVar('open_sessions', default=())
+
+    async def begin_request(self):
+        self._ensure_engine()
+        session = RequestSession(AsyncSession(self.engine, expire_on_commit=self._xocommit))
+        self._request_session.set(session)
+        return session
+
+    async def end_request(self, commit: bool):
+        """
+        Commit (or roll back) and close the request session. Safe to call more than once.
+        """
+        session = self._request_session.get()
+        if session is None:
+            return
+        self._request_session.set(None)
+        try:
+            if commit:
+                await session.commit()
+            else:
+                await session.rollback()
+        finally:
+            await session.close()
+
+    async def __aenter__(self):
+        if (session := self._request_session.get()) is not None:
+            return session
+        session = await self.begin()
+        self._open_sessions.set(self._open_sessions.get() + (session,))
+        return session
+
+    async def __aexit__(self, e1, e2, e3):
+        if (request_session := self._request_session.get()) is not None:
+            if e1:
+                ## the transaction may be aborted (e.g. by an IntegrityError); the
+                ## request may still go on, with a usable session, if the error is caught
+                await request_session.recover()
+            return
+        *outer, session = self._open_sessions.get()
+        self._open_sessions.set(tuple(outer))
+        try:
+            if e1:
+                await session.rollback()
+            else:
+                await session.commit()
+        finally:
+            await session.close()
+
+db = FreakSQLAlchemy(model_class=Base)
 
 CSI = create_session_interactively = partial(create_session, app_config.database_url)
 
@@ -133,14 +254,29 @@ PostUpvote = Table(
     Base.metadata,
     Column('post_id', BigInteger, ForeignKey('freak_post.id'), primary_key=True),
     Column('voter_id', BigInteger, ForeignKey('freak_user.id'), primary_key=True),
-    Column('is_downvote', Boolean, server_default=text('false'))
+    Column('is_downvote', Boolean, server_default=text('false')),
+    Index('post_upvote_tally', 'post_id', 'is_downvote')
 )
 
 UserBlock = Table(
     'freak_user_block',
     Base.metadata,
     Column('actor_id', BigInteger, ForeignKey('freak_user.id'), primary_key=True),
-    Column('target_id', BigInteger, ForeignKey('freak_user.id'), primary_key=True)
+    Column('target_id', BigInteger, ForeignKey('freak_user.id'), primary_key=True),
+    Index('user_block_target', 'target_id')
+)
+
+## Materialized home timeline (fan-out on write). NEW 0.5.0
+## created_at is copied from the post, so that the home feed
+## is a range scan over (user_id, created_at, post_id).
+HomeInbox = Table(
+    'freak_home_inbox',
+    Base.metadata,
+    Column('user_id', BigInteger, ForeignKey('freak_user.id', ondelete='cascade'), primary_key=True),
+    Column('post_id', BigInteger, ForeignKey('freak_post.id', ondelete='cascade'), primary_key=True),
+    Column('guild_id', BigInteger, ForeignKey('freak_topic.id', ondelete='cascade'), nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Index('home_inbox_timeline', 'user_id', 'created_at', 'post_id')
 )
 
 
@@ -149,6 +285,8 @@ class User(Base):
     __table_args__ = (
         ## XXX this constraint (and the other three at Post, Guild and Comment) cannot be removed!!
         UniqueConstraint('id', name='user_id_uniq'),
+        ## name lookups when the in-memory index is cold (see freak.names)
+        Index('user_username_trgm', 'username', postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'}),
     )
 
     id = snowflake_column()
@@ -186,7 +324,7 @@ class User(Base):
     ## SQLAlchemy fail initialization of models — bricking the app.
     ## Posts are queried manually anyway
     #posts = relationship("Post", primaryjoin=lambda: #back_populates='author', pr)
-    upvoted_posts = relationship("Post", secondary=PostUpvote, back_populates='upvoters', lazy='selectin')
+    upvoted_posts = relationship("Post", secondary=PostUpvote, back_populates='upvoters', lazy='raise')
     #comments = relationship("Comment", back_populates='author', lazy='selectin')
     
     @property
@@ -264,7 +402,7 @@ class User(Base):
         return check_password_hash(self.passhash, password)
 
     @classmethod
-    @timed_cache(1800, async_=True)
+    @cached(1800, 'active_user_count')
     async def active_count(cls) -> int:
         active_th = datetime.datetime.now() - datetime.timedelta(days=30)
         async with db as session:
@@ -339,8 +477,7 @@ class User(Base):
 
         return c
 
-    ## TODO are coroutines cacheable?
-    @timed_cache(60, async_=True)
+    @cached(60, 'strike_count:{0.id}', tags=('strikes:{0.id}',))
     async def strike_count(self) -> int:
         async with db as session:
             return (await session.execute(select(func.count('*')).select_from(UserStrike).where(UserStrike.user_id == self.id))).scalar()
@@ -375,8 +512,8 @@ class User(Base):
         """
         user_q = select(User).where(User.username == name)
         try:
-            if current_user:
-                user_q = user_q.where(~select(UserBlock).where(UserBlock.c.target_id == current_user.id).exists())
+            if current_user and current_user.block_set.blocked_by:
+                user_q = user_q.where(User.id.not_in(current_user.block_set.blocked_by))
         except Exception as e:
             logger.error(f'{e}')
 
@@ -384,6 +521,40 @@ class User(Base):
             user = (await session.execute(user_q)).scalar()
         return user
 
+## Block sets ##
+
+## blocked: ids of users blocked by the user; blocked_by: ids of users who blocked them
+BlockSet = namedtuple('BlockSet', 'blocked blocked_by', defaults=(frozenset(), frozenset()))
+
+## seconds; block_user() invalidates the cache anyway
+BLOCK_SET_TTL = 300
+
+async def block_set_of(user_id: int) -> BlockSet:
+    """
+    Blocks from and to a user, in one query, cached for BLOCK_SET_TTL seconds.
+
+    NEW 0.5.0
+    """
+    if (bs := await cache.get(f'block_set:{user_id}')) is not None:
+        return bs
+    async with db as session:
+        rows = (await session.execute(select(UserBlock.c.actor_id, UserBlock.c.target_id).where(
+            (UserBlock.c.actor_id == user_id) | (UserBlock.c.target_id == user_id)
+        ))).all()
+    bs = BlockSet(
+        frozenset(target for actor, target in rows if actor == user_id),
+        frozenset(actor for actor, target in rows if target == user_id)
+    )
+    await cache.set(f'block_set:{user_id}', bs, ttl=BLOCK_SET_TTL)
+    return bs
+
+async def forget_block_set(*user_ids: int):
+    """
+    Drop cached block sets. To be called after a block or unblock is
+    committed, for both users.
+    """
+    await cache.delete(*(f'block_set:{uid}' for uid in user_ids))
+
 # TODO add table UserInvite [planned for 0.6]
 
 # UserBlock table is at the top !!
@@ -396,6 +567,7 @@ class Guild(Base):
     __tablename__ = 'freak_topic'
     __table_args__ = (
         UniqueConstraint('id', name='topic_id_uniq'),
+        Index('topic_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
     )
 
     id = snowflake_column()
@@ -403,6 +575,9 @@ class Guild(Base):
     name = Column(String(32), CheckConstraint(text("name = lower(name) AND name ~ '^[a-z0-9_-]+$'"), name='topic_name_valid'), unique=True, nullable=False)
     display_name = Column(String(64), nullable=False)
     description = Column(String(4096), nullable=True)
+    ## rendered on write, see freak.rendering. NEW 0.5.0
+    description_html = Column(Text, nullable=True)
+    html_version = Column(SmallInteger, nullable=True)
     created_at = Column(DateTime, server_default=func.current_timestamp(), index=True, nullable=False)
     owner_id = Column(BigInteger, ForeignKey('freak_user.id', name='topic_owner_id'), nullable=True)
     language = Column(String(16), server_default=text("'en-US'"))
@@ -410,6 +585,9 @@ class Guild(Base):
     is_restricted = Column(Boolean, server_default=text('false'), nullable=False)
     # false: make the guild invite-only
     is_public = Column(Boolean, server_default=text('true'), nullable=False)
+    # true: too many subscribers to fan out its posts; home feeds merge them on read.
+    # Once set, it stays set (see fan_out_post())
+    fanout_on_read = Column(Boolean, server_default=text('false'), nullable=False)
 
     # MUST NOT be filled in on post-0.2 instances
     legacy_id = Column(BigInteger, nullable=True)
@@ -426,8 +604,8 @@ class Guild(Base):
         return count
 
     # utilities
-    owner = relationship(User, foreign_keys=owner_id, lazy='selectin')
-    posts = relationship('Post', back_populates='guild', lazy='selectin')
+    owner = relationship(User, foreign_keys=owner_id, lazy='raise')
+    posts = relationship('Post', back_populates='guild', lazy='raise')
 
     async def post_count(self):
         async with db as session:
@@ -447,21 +625,43 @@ class Guild(Base):
             u = (await session.execute(select(Member).where(Member.user_id == other.id, Member.guild_id == self.id))).scalar()
         return u.is_banned if u else False
 
+    def _allows_posting_as(self, other: User, mem: Member | None) -> bool:
+        # control owner_id instead of owner: the latter causes MissingGreenletError
+        if self.owner_id is None:
+            return False
+        if other.is_disabled:
+            return False
+        if mem and mem.is_banned:
+            return False
+        ## same as other.moderates(self)
+        if self.owner_id == other.id or other.is_administrator or (mem and mem.is_moderator):
+            return True
+        if self.is_restricted:
+            return bool(mem and mem.is_approved)
+        return True
+
     async def allows_posting(self, other: User) -> bool:
+        if self.owner_id is None or other.is_disabled:
+            return False
         async with db as session:
-            # control owner_id instead of owner: the latter causes MissingGreenletError
-            if self.owner_id is None:
-                return False
-            if other.is_disabled:
-                return False
             mem: Member | None = (await session.execute(select(Member).where(Member.user_id == other.id, Member.guild_id == self.id))).scalar()
-            if mem and mem.is_banned:
-                return False
-            if await other.moderates(self):
-                return True
-            if self.is_restricted:
-                return (mem and mem.is_approved)
-            return True
+        return self._allows_posting_as(other, mem)
+
+    @classmethod
+    async def allows_posting_many(cls, guilds: Iterable[Guild], other: User | None) -> dict[int, bool]:
+        """
+        allows_posting() for many guilds at once, in one query.
+
+        NEW 0.5.0
+        """
+        guilds = list(guilds)
+        if other is None:
+            return {gu.id: False for gu in guilds}
+        async with db as session:
+            mems = {mem.guild_id: mem for mem in (await session.execute(select(Member).where(
+                Member.user_id == other.id, Member.guild_id.in_([gu.id for gu in guilds])
+            ))).scalars()}
+        return {gu.id: gu._allows_posting_as(other, mems.get(gu.id)) for gu in guilds}
 
     async def moderators(self):
         async with db as session:
@@ -469,7 +669,7 @@ class Guild(Base):
                 owner = (await session.execute(select(User).where(User.id == self.owner_id))).scalar()
                 yield ModeratorInfo(owner, True)
             for mem in (await session.execute(select(Member).where(Member.guild_id == self.id, Member.is_moderator == True))).scalars():
-                if mem.user != self.owner and not mem.is_banned:
+                if mem.user_id != self.owner_id and not mem.is_banned:
                     yield ModeratorInfo(mem.user, False)
     
     async def update_member(self, u: User | Member, /, **values):
@@ -489,7 +689,9 @@ class Guild(Base):
             m = u
         if len(values):
             async with db as session:
-                session.execute(update(Member).where(Member.user_id == u.id, Member.guild_id == self.id).values(**values))
+                await session.execute(update(Member).where(Member.user_id == m.user_id, Member.guild_id == self.id).values(**values))
+            for k, v in values.items():
+                setattr(m, k, v)
         return m
 
     def simple_info(self, *, typed=False):
@@ -547,7 +749,7 @@ class Member(Base):
 
     user = relationship(User, primaryjoin = lambda: User.id == Member.user_id, lazy='selectin')
     guild = relationship(Guild, lazy='selectin')
-    banned_by = relationship(User, primaryjoin = lambda: User.id == Member.banned_by_id, lazy='selectin')
+    banned_by = relationship(User, primaryjoin = lambda: User.id == Member.banned_by_id, lazy='raise')
 
     @property
     def is_banned(self):
@@ -556,11 +758,18 @@ class Member(Base):
 
 POST_TYPE_DEFAULT = 0
 POST_TYPE_LINK = 1
+
+FeedCounts = namedtuple('FeedCounts', 'comment_count upvotes downvotes my_vote', defaults=(0, 0, 0, 0))
     
 class Post(Base):
     __tablename__ = 'freak_post'
     __table_args__ = (
         UniqueConstraint('id', name='post_id_uniq'),
+        ## timelines; they all skip removed posts, and are sorted by (created_at, id)
+        Index('post_topic_timeline', 'topic_id', 'created_at', 'id', postgresql_where=text('removed_at IS NULL')),
+        Index('post_author_timeline', 'author_id', 'created_at', 'id', postgresql_where=text('removed_at IS NULL')),
+        Index('post_public_timeline', 'created_at', 'id', postgresql_where=text('removed_at IS NULL AND privacy = 0')),
+        Index('post_search', 'search_vector', postgresql_using='gin'),
     )
 
     id = snowflake_column()
@@ -578,6 +787,12 @@ class Post(Base):
 
     source_url = Column(String(1024), nullable=True)
     text_content = Column(String(65536), nullable=True)
+    ## rendered on write, see freak.rendering. NEW 0.5.0
+    text_html = Column(Text, nullable=True)
+    html_version = Column(SmallInteger, nullable=True)
+    ## what feeds show instead of the full text. NEW 0.5.0
+    excerpt = Column(String(256), nullable=True)
+    excerpt_html = Column(Text, nullable=True)
 
     legacy_id = Column(BigInteger, nullable=True)
 
@@ -585,15 +800,23 @@ class Post(Base):
     removed_by_id = Column(BigInteger, ForeignKey('freak_user.id', name='user_banner_id'), nullable=True)
     removed_reason = Column(SmallInteger, nullable=True)
 
+    ## for SearchQuery; kept up to date by Postgres. NEW 0.5.0
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        f"setweight(to_tsvector('{TS_CONFIG}', coalesce(title, '')), 'A') || "
+        f"setweight(to_tsvector('{TS_CONFIG}', coalesce(text_content, '')), 'B')",
+        persisted=True
+    )))
+
     # utilities
     author: Relationship[User] = relationship("User", foreign_keys=[author_id], lazy='selectin')#, back_populates="posts")
     guild: Relationship[Guild] = relationship("Guild", back_populates="posts", lazy='selectin')
-    comments = relationship("Comment", back_populates="parent_post", lazy='selectin')
-    upvoters = relationship("User", secondary=PostUpvote, back_populates='upvoted_posts', lazy='selectin')
+    comments = relationship("Comment", back_populates="parent_post", lazy='raise')
+    upvoters = relationship("User", secondary=PostUpvote, back_populates='upvoted_posts', lazy='raise')
+    stats = relationship("PostStats", uselist=False, viewonly=True, lazy='raise')
 
     async def comment_count(self):
         async with db as session:
-            return (await session.execute(select(func.count('*')).select_from(Comment).where(Comment.parent_post == self))).scalar()
+            return (await session.execute(select(PostStats.comment_count).where(PostStats.post_id == self.id))).scalar() or 0
 
     def topic_or_user(self) -> Guild | User:
         return self.guild or self.author
@@ -607,9 +830,7 @@ class Post(Base):
 
     async def upvotes(self) -> int:
         async with db as session:
-            upv = (await session.execute(select(func.count('*')).select_from(PostUpvote).where(PostUpvote.c.post_id == self.id, PostUpvote.c.is_downvote == False))).scalar()
-            dwv = (await session.execute(select(func.count('*')).select_from(PostUpvote).where(PostUpvote.c.post_id == self.id, PostUpvote.c.is_downvote == True))).scalar()
-        return upv - dwv
+            return (await session.execute(select(PostStats.score).where(PostStats.post_id == self.id))).scalar() or 0
 
     async def upvoted_by(self, user: User | None):
         if not want_User(user, var_name='user', prefix='Post.upvoted_by()'):
@@ -636,7 +857,7 @@ class Post(Base):
         async with db as session: return (await session.execute(select(func.count('*')).select_from(PostReport).where(PostReport.target_id == self.id, ~PostReport.update_status.in_((1, 2))))).scalar()
 
     @classmethod
-    @timed_cache(1800, async_=True)
+    @cached(1800, 'post_count')
     async def count(cls):
         async with db as session:
             return (await session.execute(select(func.count('*')).select_from(cls))).scalar()
@@ -667,21 +888,343 @@ class Post(Base):
             created_at = self.created_at
         )
 
-    async def feed_info_counts(self):
+    def feed_info_with(self, counts: FeedCounts):
         pj = self.feed_info()
         if self.is_text_post():
-            pj['content'] = self.text_content[:181]
-        (pj['comment_count'], pj['votes'], pj['my_vote']) = await asyncio.gather(
-            self.comment_count(), 
-            self.upvotes(),
-            self.upvoted_by(current_user.user)
-        )
+            pj['content'] = self.excerpt or ''
+        pj['comment_count'] = counts.comment_count
+        pj['votes'] = counts.upvotes - counts.downvotes
+        pj['my_vote'] = counts.my_vote
         return pj
 
+    async def feed_info_counts(self):
+        counts = await Post.feed_counts([self.id], current_user.user)
+        return self.feed_info_with(counts[self.id])
+
+    @classmethod
+    async def feed_counts(cls, ids: Iterable[int], user: User | None = None) -> dict[int, FeedCounts]:
+        """
+        Comment count, vote tallies and the vote of user for a whole page of posts,
+        read from PostStats, plus one query for the votes of user.
+
+        Every id passed is present in the result.
+
+        NEW 0.5.0
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+        user = want_User(user, var_name='user', prefix='Post.feed_counts()')
+
+        stats_q = select(PostStats.post_id, PostStats.comment_count, PostStats.upvote_count, PostStats.downvote_count
+            ).where(PostStats.post_id.in_(ids))
+
+        async with db as session:
+            stats = {pid: (cnt, upv, dwv) for pid, cnt, upv, dwv in await session.execute(stats_q)}
+            if user:
+                mine = {pid: (-1 if is_downvote else 1) for pid, is_downvote in await session.execute(
+                    select(PostUpvote.c.post_id, PostUpvote.c.is_downvote).where(PostUpvote.c.voter_id == user.id, PostUpvote.c.post_id.in_(ids))
+                )}
+            else:
+                mine = {}
+
+        return {
+            pid: FeedCounts(*stats.get(pid, (0, 0, 0)), mine.get(pid, 0))
+            for pid in ids
+        }
+
+## Ranking ##
+
+## Reference point of ranks; same as the Snowflake epoch
+RANK_EPOCH = 1577833200
+## hot: 10x the score makes up for 12.5 hours of age
+HOT_DECAY = 45000
+## rising: 10x the activity makes up for 2 hours of age
+RISING_DECAY = 7200
+
+def hot_rank_of(score, created_at):
+    """
+    SQL expression for the hot rank (time-decayed score) given score and created_at.
+    """
+    return (
+        func.sign(score) * func.log(func.greatest(func.abs(score), 1)) +
+        (extract('epoch', created_at) - RANK_EPOCH) / HOT_DECAY
+    )
+
+def rising_rank_of(score, comment_count, created_at):
+    """
+    SQL expression for the rising rank (activity, steeply decayed).
+    """
+    return (
+        func.log(func.greatest(score + comment_count, 1)) +
+        (extract('epoch', created_at) - RANK_EPOCH) / RISING_DECAY
+    )
+
+class PostStats(Base):
+    """
+    Per-post counters and ranking data, kept apart from the (wide) post row.
+
+    Counters and ranks are stored, and updated in the same transaction as
+    votes and comments, so that neither feeds nor ranked feeds need to count rows.
+    Drift, if any, is repaired by reconcile() (python3 -m freak --reconcile).
+
+    NEW 0.5.0
+    """
+    __tablename__ = 'freak_post_stats'
+    __table_args__ = (
+        Index('post_stats_hot', 'hot_rank', 'post_id'),
+        Index('post_stats_rising', 'rising_rank', 'post_id'),
+        ## created_at is there for the ?t= windows, checked without visiting the table
+        Index('post_stats_top', 'score', 'post_id', postgresql_include=['created_at']),
+        Index('post_stats_created', 'created_at'),
+        Index('post_stats_topic_hot', 'topic_id', 'hot_rank', 'post_id'),
+        Index('post_stats_topic_top', 'topic_id', 'score', 'post_id', postgresql_include=['created_at']),
+        ## rising and windowed top in a guild: the few recent posts, then sorted
+        Index('post_stats_topic_created', 'topic_id', 'created_at'),
+    )
+
+    post_id = Column(BigInteger, ForeignKey('freak_post.id', ondelete='cascade'), primary_key=True)
+    ## copied from the post
+    topic_id = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+    score = Column(Integer, server_default=text('0'), nullable=False)
+    upvote_count = Column(Integer, server_default=text('0'), nullable=False)
+    downvote_count = Column(Integer, server_default=text('0'), nullable=False)
+    comment_count = Column(Integer, server_default=text('0'), nullable=False)
+    hot_rank = Column(Double, server_default=text('0'), nullable=False)
+    rising_rank = Column(Double, server_default=text('0'), nullable=False)
+
+    @classmethod
+    async def create_for(cls, session, post_id: int):
+        """
+        Insert the stats row of a new post.
+        """
+        q = select(Post.id, Post.topic_id, Post.created_at, hot_rank_of(0, Post.created_at), rising_rank_of(0, 0, Post.created_at)
+            ).where(Post.id == post_id)
+        await session.execute(pg_insert(PostStats).from_select(
+            ['post_id', 'topic_id', 'created_at', 'hot_rank', 'rising_rank'], q
+        ).on_conflict_do_nothing())
+
+    @classmethod
+    async def add_comment(cls, session, post_id: int, delta: int = 1):
+        """
+        Count a new comment and update ranks.
+        """
+        new_count = PostStats.comment_count + delta
+        await session.execute(update(PostStats).where(PostStats.post_id == post_id).values(
+            comment_count = new_count,
+            rising_rank = rising_rank_of(PostStats.score, new_count, PostStats.created_at)
+        ))
+
+    @classmethod
+    async def reconcile(cls, session) -> int:
+        """
+        Recount votes and comments of every post, and fix the rows that drifted
+        (creating the missing ones).
+
+        Returns the number of rows fixed.
+        """
+        await session.execute(pg_insert(PostStats).from_select(
+            ['post_id', 'topic_id', 'created_at'],
+            select(Post.id, Post.topic_id, Post.created_at).where(~Post.stats.has())
+        ).on_conflict_do_nothing())
+
+        votes = select(
+            PostUpvote.c.post_id,
+            func.count().filter(PostUpvote.c.is_downvote == False).label('upvotes'),
+            func.count().filter(PostUpvote.c.is_downvote == True).label('downvotes')
+        ).group_by(PostUpvote.c.post_id).subquery()
+        comments = select(
+            Comment.parent_post_id.label('post_id'), func.count().label('comments')
+        ).group_by(Comment.parent_post_id).subquery()
+        actual = select(
+            Post.id.label('post_id'),
+            func.coalesce(votes.c.upvotes, 0).label('upvotes'),
+            func.coalesce(votes.c.downvotes, 0).label('downvotes'),
+            func.coalesce(comments.c.comments, 0).label('comments')
+        ).join(votes, votes.c.post_id == Post.id, isouter=True
+        ).join(comments, comments.c.post_id == Post.id, isouter=True).subquery()
+
+        score = actual.c.upvotes - actual.c.downvotes
+        result = await session.execute(update(PostStats).where(
+            PostStats.post_id == actual.c.post_id,
+            (PostStats.upvote_count != actual.c.upvotes) | (PostStats.downvote_count != actual.c.downvotes) |
+            (PostStats.comment_count != actual.c.comments) | (PostStats.score != score)
+        ).values(
+            score = score,
+            upvote_count = actual.c.upvotes,
+            downvote_count = actual.c.downvotes,
+            comment_count = actual.c.comments,
+            hot_rank = hot_rank_of(score, PostStats.created_at),
+            rising_rank = rising_rank_of(score, actual.c.comments, PostStats.created_at)
+        ).execution_options(synchronize_session=False))
+        return result.rowcount
+
+async def post_created(session, post_id: int):
+    """
+    Bookkeeping after a post has been inserted: stats row and home inboxes.
+
+    NEW 0.5.0
+    """
+    await PostStats.create_for(session, post_id)
+    await fan_out_post(session, post_id)
+
+## Comments ##
+
+COMMENT_PATH_DIGITS = 16
+## levels of replies a thread can have: paths (and the comment_path index
+## entries) grow by COMMENT_PATH_DIGITS bytes a level, and must stay well
+## under the btree row size limit (about 2.7 kB)
+MAX_COMMENT_DEPTH = 100
+
+def comment_path_ids(path: str) -> list[int]:
+    """
+    Ids in a materialized path (see Comment.path).
+    """
+    return [int(path[i:i + COMMENT_PATH_DIGITS], 16) for i in range(0, len(path), COMMENT_PATH_DIGITS)]
+
+def comment_path_of(comment_id, parent_path = None):
+    """
+    SQL expression for the materialized path of a comment, given the one
+    of its parent (NULL for top level comments).
+    """
+    return func.coalesce(parent_path, '') + func.lpad(func.to_hex(comment_id), COMMENT_PATH_DIGITS, '0')
+
+async def comment_created(session, comment_id: int):
+    """
+    Bookkeeping after a comment has been inserted: its path and the stats
+    of its post.
+
+    NEW 0.5.0
+    """
+    Parent = aliased(Comment)
+    post_id = (await session.execute(update(Comment).where(Comment.id == comment_id).values(
+        path = comment_path_of(Comment.id, select(Parent.path).where(Parent.id == Comment.parent_comment_id).scalar_subquery())
+    ).returning(Comment.parent_post_id))).scalar()
+    await PostStats.add_comment(session, post_id)
+
+## Votes ##
+
+async def cast_vote(session, post_id: int, voter_id: int, vote: int) -> int | None:
+    """
+    Set the vote (-1, 0 or 1) of a user on a post. Return the new score,
+    or None if there is no such post.
+
+    This is a single statement: the vote is upserted (or deleted), returning
+    the previous one, and the stats row is updated from it in the same query.
+    Casting the same vote again changes nothing.
+
+    NEW 0.5.0
+    """
+    if vote not in (-1, 0, 1):
+        raise ValueError(f'invalid vote: {vote!r}')
+    if vote:
+        ins = pg_insert(PostUpvote).from_select(
+            ['post_id', 'voter_id', 'is_downvote'],
+            select(Post.id, literal(voter_id, BigInteger), literal(vote < 0)).where(Post.id == post_id)
+        )
+        ## xmax is 0 on inserted rows; an update can only be a flip
+        change = ins.on_conflict_do_update(
+            index_elements=[PostUpvote.c.post_id, PostUpvote.c.voter_id],
+            set_={'is_downvote': ins.excluded.is_downvote},
+            where=PostUpvote.c.is_downvote.is_distinct_from(ins.excluded.is_downvote)
+        ).returning(PostUpvote.c.post_id, case((literal_column('xmax') == literal_column('0'), 0), else_=-vote).label('old_vote'))
+    else:
+        change = delete(PostUpvote).where(PostUpvote.c.post_id == post_id, PostUpvote.c.voter_id == voter_id
+            ).returning(PostUpvote.c.post_id, case((PostUpvote.c.is_downvote, -1), else_=1).label('old_vote'))
+    change = change.cte('vote_change')
+    new_score = PostStats.score + vote - change.c.old_vote
+    stats = update(PostStats).where(PostStats.post_id == change.c.post_id).values(
+        score = new_score,
+        upvote_count = PostStats.upvote_count + int(vote == 1) - case((change.c.old_vote == 1, 1), else_=0),
+        downvote_count = PostStats.downvote_count + int(vote == -1) - case((change.c.old_vote == -1, 1), else_=0),
+        hot_rank = hot_rank_of(new_score, PostStats.created_at),
+        rising_rank = rising_rank_of(new_score, PostStats.comment_count, PostStats.created_at)
+    ).returning(PostStats.post_id, PostStats.score).cte('stats_change')
+    ## the main query sees the stats from before the statement, hence the coalesce()
+    q = (select(func.coalesce(stats.c.score, PostStats.score, 0))
+        .select_from(Post)
+        .outerjoin(PostStats, PostStats.post_id == Post.id)
+        .outerjoin(stats, stats.c.post_id == Post.id)
+        .where(Post.id == post_id))
+    return (await session.execute(q)).scalar()
+
+## Home inbox maintenance ##
+
+HOME_INBOX_BACKFILL_DAYS = 30
+
+async def fan_out_post(session, post_id: int):
+    """
+    Copy a newly created post into the home inbox of every subscriber of its guild.
+
+    Guilds with more than FREAK_FANOUT_THRESHOLD subscribers are flagged
+    fanout_on_read instead, and their posts are merged into home feeds on read.
+
+    NEW 0.5.0
+    """
+    if not app_config.home_inbox:
+        return
+    post = (await session.execute(select(Post.topic_id, Post.created_at).where(Post.id == post_id))).first()
+    if post is None or post.topic_id is None:
+        return
+    guild = (await session.execute(select(Guild).where(Guild.id == post.topic_id))).scalar()
+    if guild.fanout_on_read:
+        return
+    sub_count = (await session.execute(select(func.count('*')).select_from(Member).where(Member.guild_id == guild.id, Member.is_subscribed == True))).scalar()
+    if sub_count > app_config.fanout_threshold:
+        await session.execute(update(Guild).where(Guild.id == guild.id).values(fanout_on_read = True))
+        return
+    await session.execute(pg_insert(HomeInbox).from_select(
+        ['user_id', 'post_id', 'guild_id', 'created_at'],
+        select(Member.user_id, literal(post_id, BigInteger), literal(guild.id, BigInteger), literal(post.created_at, DateTime)
+            ).where(Member.guild_id == guild.id, Member.is_subscribed == True)
+    ).on_conflict_do_nothing())
+
+async def backfill_home_inbox(session, *, user_id: int | None = None, guild_id: int | None = None):
+    """
+    Fill home inboxes with the last HOME_INBOX_BACKFILL_DAYS days of posts from subscribed guilds.
+    Used on subscription, and for existing users by `python -m freak --backfill-inbox`.
+
+    NEW 0.5.0
+    """
+    big_guilds = select(Member.guild_id).where(Member.is_subscribed == True
+        ).group_by(Member.guild_id).having(func.count('*') > app_config.fanout_threshold)
+    if guild_id is not None:
+        big_guilds = big_guilds.where(Member.guild_id == guild_id)
+    await session.execute(update(Guild).where(Guild.id.in_(big_guilds)).values(fanout_on_read = True))
+
+    since = datetime.datetime.now() - datetime.timedelta(days=HOME_INBOX_BACKFILL_DAYS)
+    q = select(Member.user_id, Post.id, Post.topic_id, Post.created_at
+        ).join(Post, Post.topic_id == Member.guild_id).join(Guild, Guild.id == Member.guild_id
+        ).where(Member.is_subscribed == True, Guild.fanout_on_read == False, Post.created_at >= since)
+    if user_id is not None:
+        q = q.where(Member.user_id == user_id)
+    if guild_id is not None:
+        q = q.where(Member.guild_id == guild_id)
+    await session.execute(pg_insert(HomeInbox).from_select(
+        ['user_id', 'post_id', 'guild_id', 'created_at'], q
+    ).on_conflict_do_nothing())
+
+async def drop_home_inbox(session, user_id: int, guild_id: int):
+    """
+    Remove posts of a guild from a home inbox, i.e. on unsubscribe.
+
+    NEW 0.5.0
+    """
+    await session.execute(delete(HomeInbox).where(HomeInbox.c.user_id == user_id, HomeInbox.c.guild_id == guild_id))
+
 class Comment(Base):
     __tablename__ = 'freak_comment'
     __table_args__ = (
         UniqueConstraint('id', name='comment_id_uniq'),
+        ## pages of replies, in (created_at, id) order; IS NULL does not
+        ## fix parent_comment_id for ordering, so top level has its own
+        Index('comment_thread', 'parent_post_id', 'parent_comment_id', 'created_at', 'id'),
+        Index('comment_top_level', 'parent_post_id', 'created_at', 'id', postgresql_where=text('parent_comment_id IS NULL')),
+        ## subtrees and whole threads in depth-first order
+        Index('comment_path', 'parent_post_id', 'path'),
+        Index('comment_search', 'search_vector', postgresql_using='gin'),
     )
 
     id = snowflake_column()
@@ -690,10 +1233,17 @@ class Comment(Base):
     parent_post_id = Column(BigInteger, ForeignKey('freak_post.id', name='comment_parent_post_id', ondelete='cascade'), nullable=False)
     parent_comment_id = Column(BigInteger, ForeignKey('freak_comment.id', name='comment_parent_comment_id'), nullable=True)
     text_content = Column(String(16384), nullable=False)
+    ## rendered on write, see freak.rendering. NEW 0.5.0
+    text_html = Column(Text, nullable=True)
+    html_version = Column(SmallInteger, nullable=True)
     created_at = Column(DateTime, server_default=func.current_timestamp(), index=True)
     created_ip = Column(String(64), default=get_remote_addr, nullable=False)
     updated_at = Column(DateTime, nullable=True)
     is_locked = Column(Boolean, server_default=text('false'))
+    ## materialized path: ids of the ancestors, then of the comment itself, in
+    ## COMMENT_PATH_DIGITS hex digits each; sorting by it gives depth-first order.
+    ## Bytewise collation, so that subtrees are ranges. Set by comment_created(). NEW 0.5.0
+    path = Column(Text(collation='C'), nullable=True)
 
     ## DO NOT FILL IN! intended for 0.2 or earlier
     legacy_id = Column(BigInteger, nullable=True)
@@ -702,24 +1252,48 @@ class Comment(Base):
     removed_by_id = Column(BigInteger, ForeignKey('freak_user.id', name='user_banner_id'), nullable=True)
     removed_reason = Column(SmallInteger, nullable=True)
 
+    ## for SearchQuery (type:comment); kept up to date by Postgres. NEW 0.5.0
+    search_vector = deferred(Column(TSVECTOR, Computed(f"to_tsvector('{TS_CONFIG}', text_content)", persisted=True)))
+
     author = relationship('User', foreign_keys=[author_id], lazy='selectin')#, back_populates='comments')
     parent_post: Relationship[Post] = relationship("Post", back_populates="comments", foreign_keys=[parent_post_id], lazy='selectin')
-    parent_comment, child_comments = parent_children('comment', parent_remote_side=Wanted('id'))
+    parent_comment, child_comments = parent_children('comment', parent_remote_side=Wanted('id'), lazy='raise')
 
     def url(self):
         return self.parent_post.url() + f'/comment/{Snowflake(self.id):l}'
 
     async def is_parent_locked(self):
+        """
+        *Changed in 0.5.0*: one query, on the ids in path
+        """
         if self.is_locked:
             return True
         if self.parent_comment_id == None:
             return False
         async with db as session:
-            parent = (await session.execute(select(Comment).where(Comment.id == self.parent_comment_id))).scalar()
-            try:
-                return parent.is_parent_locked()
-            except RecursionError:
-                return True
+            if self.path is None:
+                ## not backfilled yet: walk up
+                parent = (await session.execute(select(Comment).where(Comment.id == self.parent_comment_id))).scalar()
+                try:
+                    return await parent.is_parent_locked()
+                except RecursionError:
+                    return True
+            return bool((await session.execute(select(func.bool_or(Comment.is_locked)).where(Comment.id.in_(self.ancestor_ids)))).scalar())
+
+    @property
+    def ancestor_ids(self) -> list[int]:
+        """
+        Ids of the parents of the comment, top level first. NEW 0.5.0
+        """
+        return comment_path_ids(self.path)[:-1]
+
+    @classmethod
+    def in_subtree(cls, path: str):
+        """
+        Filter for the replies (at any depth) to the comment with path. NEW 0.5.0
+        """
+        ## 'g' comes right after the hex digits
+        return and_(cls.path > path, cls.path < path + 'g')
 
     def report_url(self) -> str:
         return f'/report/comment/{Snowflake(self.id):l}' 
@@ -737,15 +1311,25 @@ class Comment(Base):
         return Post.removed_at == None
 
     async def section_info(self):
+        return self.section_info_with(await self.is_parent_locked())
+
+    def section_info_with(self, locked: bool):
+        """
+        Same as section_info(), given whether the comment or any of its
+        parents is locked (e.g. as computed by load_thread_page()).
+
+        NEW 0.5.0
+        """
         obj = dict(
             id = Snowflake(self.id).to_b32l(),
-            parent = dict(id=Snowflake(self.parent_comment_id)) if self.parent_comment_id else None,
-            locked = await self.is_parent_locked(),
+            parent = dict(id=Snowflake(self.parent_comment_id).to_b32l()) if self.parent_comment_id else None,
+            locked = locked,
             created_at = want_isodate(self.created_at)
         )
         if self.is_removed:
             obj['removed'] = self.removed_reason
         else:
+            obj['author'] = self.author.simple_info() if self.author else None
             obj['content'] = self.text_content
 
         return obj
@@ -753,6 +1337,9 @@ class Comment(Base):
 
 class PostReport(Base):
     __tablename__ = 'freak_postreport'
+    __table_args__ = (
+        Index('postreport_target_status', 'target_id', 'update_status'),
+    )
 
     id = snowflake_column()
     
@@ -769,7 +1356,7 @@ class PostReport(Base):
     async def target(self):
         async with db as session:
             if self.target_type == REPORT_TARGET_POST:
-                return (await session.execute(select(Post).where(Post.id == self.target_id))).scalar()
+                return (await session.execute(select(Post).where(Post.id == self.target_id).options(*ADMIN_VIEW))).scalar()
             elif self.target_type == REPORT_TARGET_COMMENT:
                 return (await session.execute(select(Comment).where(Comment.id == self.target_id))).scalar()
             else:
@@ -794,7 +1381,23 @@ class UserStrike(Base):
     issued_by_id = Column(BigInteger, ForeignKey('freak_user.id'), nullable=True)
 
     user = relationship(User, primaryjoin= lambda: User.id == UserStrike.user_id, lazy='selectin')
-    issued_by = relationship(User, primaryjoin= lambda: User.id == UserStrike.issued_by_id, lazy='selectin')
+    issued_by = relationship(User, primaryjoin= lambda: User.id == UserStrike.issued_by_id, lazy='raise')
+
+## Loading profiles ##
+
+## Only the relationships shown on (almost) every page load by default:
+## authors, guilds, members' users. Collections and the rest are lazy='raise',
+## and endpoints opt into them with .options(*PROFILE).
+## raiseload('*') makes a profile strict: anything not listed is not loaded.
+
+## feed entries: stats are needed to sort ranked timelines; the full text is
+## left out, as feeds show the excerpt
+FEED_CARD = (selectinload(Post.author), selectinload(Post.guild), selectinload(Post.stats),
+    defer(Post.text_content, raiseload=True), defer(Post.text_html, raiseload=True), raiseload('*'))
+## post page: counts come from Post.feed_counts(), comments from their own query
+POST_DETAIL = (selectinload(Post.author), selectinload(Post.guild), raiseload('*'))
+## admin and report pages
+ADMIN_VIEW = (selectinload(Post.author), selectinload(Post.guild), selectinload(Post.stats))
 
 # PostUpvote table is at the top !!
 
@@ -0,0 +1,122 @@
+"""
+In-memory indexes of guild and user names, for autocompletion
+and availability checks.
+
+NEW 0.5.0
+"""
+
+from __future__ import annotations
+
+import asyncio
+from bisect import bisect_left, insort
+from itertools import islice, takewhile
+import logging
+import time
+
+from sqlalchemy import Column, func, select
+
+from .models import Guild, User, db
+
+logger = logging.getLogger(__name__)
+
+## seconds between refreshes, which pick up names added by other processes
+NAME_INDEX_REFRESH = 30
+## seconds between rebuilds, which also drop names freed since
+NAME_INDEX_REBUILD = 600
+
+class NameIndex:
+    """
+    Sorted list of the names in a column, answering prefix and existence
+    lookups without a round trip to the database.
+
+    Warmed at startup, then refreshed every NAME_INDEX_REFRESH seconds with
+    the rows added since (ids are Snowflakes, which grow over time).
+    The process adding a name adds it here right away. Every
+    NAME_INDEX_REBUILD seconds the whole index is read again, so that names
+    of deleted or renamed rows are freed.
+
+    Until warmed (e.g. in CLI), lookups go to the database, where trigram
+    indexes serve them.
+    """
+    def __init__(self, column: Column, id_column: Column):
+        self.column = column
+        self.id_column = id_column
+        self.names: list[str] = []
+        self._members: set[str] = set()
+        self.loaded = False
+        ## the refresh before the last one; rows are read from there, so that
+        ## ones committed late (with a smaller id) are not missed
+        self._since: int | None = None
+        self._last_id: int | None = None
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self, *, rebuild: bool = False):
+        """
+        Add the names of the rows added since the last refresh or, if
+        rebuild (or not loaded yet), replace the index with all names.
+        """
+        rebuild = rebuild or not self.loaded
+        q = select(self.id_column, self.column)
+        if self._since is not None and not rebuild:
+            q = q.where(self.id_column > self._since)
+        async with db as session:
+            rows = (await session.execute(q)).all()
+        if rebuild:
+            self._members = {name for _, name in rows}
+            self.names = sorted(self._members)
+        else:
+            for _, name in rows:
+                self.add(name)
+        self._since, self._last_id = self._last_id, max((i for i, _ in rows), default=self._last_id)
+        self.loaded = True
+
+    def add(self, name: str):
+        if name not in self._members:
+            self._members.add(name)
+            insort(self.names, name)
+
+    async def prefixed(self, prefix: str, limit: int = 10) -> list[str]:
+        """
+        Names starting with prefix, in alphabetical order.
+        """
+        if not self.loaded:
+            async with db as session:
+                return list((await session.execute(select(self.column)
+                    .where(self.column.startswith(prefix, autoescape=True))
+                    .order_by(self.column).limit(limit))).scalars())
+        i = bisect_left(self.names, prefix)
+        return list(takewhile(lambda n: n.startswith(prefix), islice(self.names, i, i + limit)))
+
+    async def exists(self, name: str) -> bool:
+        """
+        Whether the name is taken. Names taken by other processes since the
+        last refresh are missed: the unique constraint has the last word.
+        """
+        if not self.loaded:
+            async with db as session:
+                return bool((await session.execute(select(func.count()).where(self.column == name))).scalar())
+        return name in self._members
+
+    async def _run(self):
+        rebuilt_at = time.monotonic()
+        while True:
+            rebuild = time.monotonic() - rebuilt_at >= NAME_INDEX_REBUILD
+            try:
+                await self.refresh(rebuild=rebuild)
+                if rebuild:
+                    rebuilt_at = time.monotonic()
+            except Exception as e:
+                logger.error(f'cannot refresh names of {self.column}: {e}')
+            await asyncio.sleep(NAME_INDEX_REFRESH)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+guild_names = NameIndex(Guild.name, Guild.id)
+user_names = NameIndex(User.username, User.id)
@@ -0,0 +1,145 @@
+"""
+Full-page cache for logged-out visitors.
+
+Pages are served from memory for FREAK_PAGE_CACHE_TTL seconds, then
+stale for up to FREAK_PAGE_CACHE_STALE more seconds while a single request
+renders them again. Writes purge the pages they affect (see purge_pages()).
+Pages are kept on the app cache server (see freak.cache), in a store of
+their own bounded at FREAK_PAGE_CACHE_MAX_ENTRIES pages: crawlers asking
+for many URLs push out old pages, not logged in users or block sets.
+
+NEW 0.5.0
+"""
+
+from __future__ import annotations
+
+import time
+from typing import NamedTuple
+
+from quart import Blueprint, Response, g, request, session
+from quart_auth import current_user
+from quart_wtf.utils import generate_csrf
+
+from . import app_config
+from .cache import open_cache
+
+## Tokens are per session; cached bodies hold this in place of the token
+## of whoever rendered them.
+CSRF_PLACEHOLDER = b'\x00csrf_token\x00'
+
+## after this many seconds, a revalidating request is assumed to have failed
+REVALIDATE_TIMEOUT = 10
+
+class CachedPage(NamedTuple):
+    body: bytes
+    status: int
+    content_type: str
+    ## wall clock, as pages may be shared between processes
+    fresh_until: float
+    stale_until: float
+
+class PageCache:
+    """
+    Page store, keyed by full path, with tags for purging.
+    """
+    def __init__(self):
+        self.store = open_cache(app_config.cache_url, namespace='page', max_entries=app_config.page_cache_max_entries)
+        ## key -> since when a request of this process is rendering it again
+        self.revalidating: dict[str, float] = {}
+
+    async def get(self, key: str) -> CachedPage | None:
+        """
+        Return the page, or None if the caller has to render it.
+
+        A stale page is handed out to everyone but one request (per process),
+        which is let through to render it again.
+        """
+        page = await self.store.get(key)
+        now = time.time()
+        if page is None or page.stale_until <= now:
+            return None
+        if page.fresh_until > now:
+            return page
+        if self.revalidating.get(key, 0) + REVALIDATE_TIMEOUT > now:
+            return page
+        self.revalidating[key] = now
+        return None
+
+    async def set(self, key: str, body: bytes, status: int, content_type: str, tags: set[str]):
+        now = time.time()
+        ttl = app_config.page_cache_ttl + app_config.page_cache_stale
+        await self.store.set(key, CachedPage(body, status, content_type, now + app_config.page_cache_ttl, now + ttl),
+            ttl=ttl, tags=tags)
+        self.revalidating.pop(key, None)
+
+    async def purge(self, tags: set[str]):
+        await self.store.purge(*tags)
+
+    async def close(self):
+        await self.store.close()
+
+page_cache = PageCache()
+
+async def purge_pages(*, guild: str | None = None, user: str | None = None, post: int | None = None):
+    """
+    Drop cached pages showing content of a guild, a user or a post.
+    The front page timelines are always purged.
+    """
+    tags = {'timeline'}
+    if guild:
+        tags.add(f'guild:{guild}')
+    if user:
+        tags.add(f'user:{user}')
+    if post:
+        tags.add(f'post:{post}')
+    await page_cache.purge(tags)
+
+def _request_tags() -> set[str]:
+    tags = set()
+    args = request.view_args or {}
+    if request.endpoint in ('frontpage.homepage', 'frontpage.explore'):
+        tags.add('timeline')
+    if gname := args.get('name') or args.get('gname'):
+        tags.add(f'guild:{gname}')
+    if username := args.get('username'):
+        tags.add(f'user:{username}')
+    if post_id := args.get('id'):
+        tags.add(f'post:{int(post_id)}')
+    return tags
+
+def _is_cacheable() -> bool:
+    return (
+        app_config.page_cache_ttl > 0 and
+        request.method == 'GET' and
+        not current_user and
+        ## someone has to see the flashed messages
+        '_flashes' not in session
+    )
+
+async def _serve_cached():
+    if not _is_cacheable():
+        return None
+    page = await page_cache.get(request.full_path)
+    if page is None:
+        g.page_cache_key = request.full_path
+        return None
+    body = page.body.replace(CSRF_PLACEHOLDER, generate_csrf().encode('ascii'))
+    return Response(body, status=page.status, content_type=page.content_type)
+
+async def _store(resp: Response):
+    key = g.pop('page_cache_key', None)
+    if key is None or resp.status_code != 200 or not _is_cacheable():
+        return resp
+    body = await resp.get_data()
+    if 'csrf_token' in g:
+        body = body.replace(g.csrf_token.encode('ascii'), CSRF_PLACEHOLDER)
+    await page_cache.set(key, body, resp.status_code, resp.content_type, _request_tags())
+    return resp
+
+def cache_pages(bp: Blueprint):
+    """
+    Serve the GET views of bp from the page cache to logged-out visitors.
+    """
+    bp.before_request(_serve_cached)
+    bp.after_request(_store)
+    return bp
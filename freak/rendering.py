@@ -0,0 +1,281 @@
+"""
+Markdown rendering.
+
+Post and comment text, and guild descriptions, are rendered once, when
+written, and stored as HTML next to their source along with the
+RENDERER_VERSION that produced it. Templates read the stored HTML.
+
+Bump RENDERER_VERSION whenever the output changes (e.g. extensions are
+added or configured differently), then run `python3 -m freak --rerender`.
+Meanwhile, outdated rows are rendered on read.
+
+Markdown lets raw HTML through, so the output is sanitized (with nh3)
+before being stored and marked safe: only the tags, attributes and
+classes that Markdown and its extensions write are kept.
+
+Posts also store an excerpt, as plain text (for REST) and HTML (for feeds),
+so that timelines don't need to load their full text.
+
+Texts longer than FREAK_MARKDOWN_POOL_THRESHOLD characters are rendered
+in a pool of FREAK_MARKDOWN_WORKERS processes (0 disables it), so that
+a huge post does not stall every other request of the worker. The pool
+is started with the app; elsewhere (e.g. CLI), everything is rendered
+in process.
+
+NEW 0.5.0
+"""
+
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import re
+from typing import Iterable
+
+import markdown
+from markupsafe import Markup
+import nh3
+from sqlalchemy import bindparam, select, update
+from suou.markdown import StrikethroughExtension, SpoilerExtension, PingExtension
+
+from . import app_config
+from .models import Comment, Guild, Post, db
+
+logger = logging.getLogger(__name__)
+
+## 2: sanitized; 3: long paragraphs in excerpts cut at a word
+RENDERER_VERSION = 3
+
+## model -> (source attribute, HTML attribute)
+RENDERED_COLUMNS = {
+    Post: ('text_content', 'text_html'),
+    Comment: ('text_content', 'text_html'),
+    Guild: ('description', 'description_html'),
+}
+
+## characters of plain text excerpts
+EXCERPT_LENGTH = 180
+## at most this much of the source of a post makes its HTML excerpt;
+## feeds clip it to a few lines anyway
+EXCERPT_SOURCE_LENGTH = 1024
+
+## rows per transaction of rerender_all()
+RERENDER_BATCH = 500
+
+# make spoilers prevail over blockquotes
+SpoilerExtension.patch_blockquote_processor()
+
+def _make_markdown(toc: bool = False) -> markdown.Markdown:
+    extensions = [
+        'tables', 'footnotes', 'fenced_code', 'sane_lists',
+        StrikethroughExtension(), SpoilerExtension(),
+        PingExtension({'@': '/@', '+': '/+'})
+    ]
+    if toc:
+        extensions.append('toc')
+    return markdown.Markdown(extensions=extensions)
+
+## converters are reused (they are not thread safe, but renders never await)
+_converters: dict[bool, markdown.Markdown] = {}
+
+## classes written by the extensions, plus language-* on code blocks
+ALLOWED_CLASSES = frozenset({'spoiler', 'footnote', 'footnote-ref', 'footnote-backref', 'toc', 'toclink'})
+## ids of footnotes; headings get theirs from the toc extension
+_footnote_id_re = re.compile(r'fn(ref)?:[\w-]+')
+
+def _filter_attribute(tag: str, attr: str, value: str) -> str | None:
+    if attr == 'class':
+        value = ' '.join(c for c in value.split()
+            if c in ALLOWED_CLASSES or (tag == 'code' and c.startswith('language-')))
+        return value or None
+    if attr == 'id' and tag in ('sup', 'li') and not _footnote_id_re.fullmatch(value):
+        return None
+    return value
+
+_sanitizer = nh3.Cleaner(
+    tags=nh3.ALLOWED_TAGS,
+    attributes={
+        **nh3.ALLOWED_ATTRIBUTES,
+        'a': {'href', 'hreflang', 'title', 'class'},
+        'span': {'class'},
+        'div': {'class'},
+        'code': {'class'},
+        'sup': {'id'},
+        'li': {'id'},
+        **{f'h{i}': {'id'} for i in range(1, 7)},
+        ## table column alignment
+        'th': nh3.ALLOWED_ATTRIBUTES['th'] | {'style'},
+        'td': nh3.ALLOWED_ATTRIBUTES['td'] | {'style'},
+    },
+    attribute_filter=_filter_attribute,
+    filter_style_properties={'text-align'},
+    url_schemes={'http', 'https', 'mailto'},
+)
+
+def render_markdown(text: str, toc: bool = False) -> str:
+    """
+    Render text to HTML, safe to mark as such.
+    """
+    if (md := _converters.get(toc)) is None:
+        md = _converters[toc] = _make_markdown(toc)
+    try:
+        return _sanitizer.clean(md.convert(text))
+    finally:
+        md.reset()
+
+_markdown_pool: ProcessPoolExecutor | None = None
+
+def _pool_context():
+    ## not fork: children would inherit the event loop, open sockets and
+    ## DB connections of the worker, from whichever thread is running
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+async def start_markdown_pool():
+    """
+    Start the Markdown worker processes, unless disabled.
+
+    Workers are warmed up (i.e. have imported the renderer) before this
+    returns, so that the first long post does not wait for them.
+    """
+    global _markdown_pool
+    if app_config.markdown_workers <= 0 or _markdown_pool is not None:
+        return
+    _markdown_pool = ProcessPoolExecutor(max_workers=app_config.markdown_workers, mp_context=_pool_context())
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(_markdown_pool, render_markdown, '')
+        for _ in range(app_config.markdown_workers)))
+
+async def render_markdown_async(text: str, toc: bool = False) -> str:
+    """
+    Same as render_markdown(), in the process pool if text is long enough.
+    """
+    if (pool := _markdown_pool) is None or len(text) < app_config.markdown_pool_threshold:
+        return render_markdown(text, toc)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, render_markdown, text, toc)
+    except BrokenProcessPool:
+        ## a worker died (e.g. killed by the OOM killer); unless another
+        ## request did already, start over
+        if pool is _markdown_pool:
+            logger.error('Markdown worker pool is broken, restarting it')
+            shutdown_markdown_pool()
+            await start_markdown_pool()
+        return render_markdown(text, toc)
+
+def shutdown_markdown_pool():
+    global _markdown_pool
+    if _markdown_pool is not None:
+        _markdown_pool.shutdown(wait=False, cancel_futures=True)
+        _markdown_pool = None
+
+def _truncate(text: str, length: int) -> str:
+    if len(text) <= length:
+        return text
+    text = text[:length]
+    if ' ' in text:
+        text = text.rsplit(' ', 1)[0]
+    return text.rstrip() + '…'
+
+def excerpt_source(text: str) -> str:
+    """
+    The leading paragraphs of text, up to EXCERPT_SOURCE_LENGTH characters.
+    """
+    if len(text) <= EXCERPT_SOURCE_LENGTH:
+        return text
+    paragraphs = text[:EXCERPT_SOURCE_LENGTH].split('\n\n')
+    if len(paragraphs) > 1:
+        ## the last one is cut
+        return '\n\n'.join(paragraphs[:-1])
+    ## the first one is too long: cut it at a word
+    return _truncate(text, EXCERPT_SOURCE_LENGTH)
+
+async def html_values(model: type, text: str | None) -> dict:
+    """
+    Values of the HTML columns of model (and excerpts of posts) for source
+    text, to pass to insert().values() or update().values() along with
+    the text itself.
+    """
+    _, target = RENDERED_COLUMNS[model]
+    values = {target: await render_markdown_async(text) if text else None, 'html_version': RENDERER_VERSION}
+    if model is Post:
+        values['excerpt_html'] = excerpt_html = render_markdown(excerpt_source(text)) if text else None
+        values['excerpt'] = _truncate(Markup(excerpt_html).striptags(), EXCERPT_LENGTH) if text else None
+    return values
+
+async def stored_html(obj) -> str:
+    """
+    HTML of a post, comment or guild description. Rendered now if missing
+    or outdated.
+    """
+    source, target = RENDERED_COLUMNS[type(obj)]
+    if obj.html_version == RENDERER_VERSION and (html := getattr(obj, target)) is not None:
+        return html
+    text = getattr(obj, source)
+    return await render_markdown_async(text) if text else ''
+
+async def render_stale_excerpts(posts: Iterable[Post]):
+    """
+    Render now the HTML excerpts of posts whose stored ones are missing or
+    outdated, loading their texts (feeds leave them out) in one query.
+    stored_excerpt_html() picks them up.
+    """
+    stale = [p for p in posts if p.html_version != RENDERER_VERSION or p.excerpt_html is None]
+    if not stale:
+        return
+    async with db as session:
+        texts = dict((await session.execute(select(Post.id, Post.text_content).where(Post.id.in_([p.id for p in stale])))).all())
+    for p in stale:
+        ## not a column: the outdated stored one is left alone
+        p.fresh_excerpt_html = render_markdown(excerpt_source(text)) if (text := texts.get(p.id)) else ''
+
+async def stored_excerpt_html(post: Post) -> str:
+    """
+    HTML excerpt of a post. If missing or outdated, the one rendered by
+    render_stale_excerpts() is used; otherwise, the text of the post is
+    loaded and rendered now.
+    """
+    if post.html_version == RENDERER_VERSION and post.excerpt_html is not None:
+        return post.excerpt_html
+    if (html := getattr(post, 'fresh_excerpt_html', None)) is not None:
+        return html
+    async with db as session:
+        text = (await session.execute(select(Post.text_content).where(Post.id == post.id))).scalar()
+    return render_markdown(excerpt_source(text)) if text else ''
+
+async def rerender_all(session) -> int:
+    """
+    Render again every row whose HTML is missing or outdated, committing
+    every RERENDER_BATCH rows. Rows edited meanwhile are left alone.
+
+    Returns the number of rows rendered.
+    """
+    count = 0
+    for model, (source, target) in RENDERED_COLUMNS.items():
+        table = model.__table__
+        src = table.c[getattr(model, source).property.columns[0].name]
+        columns = list(await html_values(model, None))
+        upd = update(table).where(table.c.id == bindparam('row_id'), src.is_not_distinct_from(bindparam('row_source'))).values({
+            c: bindparam(f'row_{c}') for c in columns
+        })
+        last_id = -1
+        while True:
+            rows = (await session.execute(select(table.c.id, src)
+                .where(table.c.id > last_id, table.c.html_version.is_distinct_from(RENDERER_VERSION))
+                .order_by(table.c.id).limit(RERENDER_BATCH))).all()
+            if not rows:
+                break
+            values = await asyncio.gather(*(html_values(model, text) for _, text in rows))
+            await session.execute(upd, [
+                dict(row_id=row_id, row_source=text, **{f'row_{c}': v for c, v in row_values.items()})
+                for (row_id, text), row_values in zip(rows, values)
+            ])
+            await session.commit()
+            last_id = rows[-1][0]
+            count += len(rows)
+        logger.info(f'rendered {table.name} again')
+    return count
@@ -13,21 +13,25 @@ from pydantic import BaseModel, Field
 from quart_auth import current_user, login_required, login_user, logout_user
 from quart_schema import validate_request
 from quart_wtf.csrf import generate_csrf
-from sqlalchemy import delete, insert, select, __version__ as sa_version
+from sqlalchemy import insert, select, __version__ as sa_version
 from suou import Snowflake, age_and_days, deprecated, makelist, not_implemented, want_isodate
 
 from suou.classtools import MISSING, MissingType
-from werkzeug.security import check_password_hash, generate_password_hash
 from suou.quart import add_rest
 
 # quart does not define __version__
 quart_version = version('quart')
 
 from freak.accounts import LoginStatus, check_login
-from freak.algorithms import private_timeline, public_timeline, top_guilds_query, topic_timeline, user_timeline
+from freak.algorithms import guild_leaderboard, home_page, public_timeline, search_page, timeline_page, topic_timeline, user_timeline
 from freak.search import SearchQuery
 
-from ..models import REPORT_REASONS, Comment, Guild, Post, PostUpvote, User, db, username_is_legal
+from ..pagecache import purge_pages
+from ..rendering import html_values
+from ..threads import load_thread_page
+from ..models import POST_DETAIL, REPORT_REASONS, Comment, Guild, Post, User, db, post_created, username_is_legal
+from ..names import guild_names, user_names
+from ..votes import vote_buffer
 from .. import UserLoader, app, app_config,  __version__ as freak_version, csrf
 
 logger = logging.getLogger(__name__)
@@ -126,13 +130,11 @@ async def user_feed_get(id: int):
             return dict(error='User not found'), 404
         uj = _user_info(u)
 
-        feed = []
         algo = user_timeline(u)
-        posts = await db.paginate(algo)
-        async for p in posts:
-            feed.append(await p.feed_info_counts())
+        posts = await timeline_page(algo)
+        feed = posts.feed_info()
 
-    return dict(users={f'{Snowflake(id):l}': uj}, feed=feed)
+    return dict(users={f'{Snowflake(id):l}': uj}, feed=feed, next=posts.next_cursor)
 
 @bp.get('/user/@<username>')
 async def resolve_user(username: str):
@@ -155,7 +157,7 @@ async def resolve_user_feed(username: str):
 @bp.get('/post/<b32l:id>')
 async def get_post(id: int):
     async with db as session:
-        p: Post | None = (await session.execute(select(Post).where(Post.id == id))).scalar()
+        p: Post | None = (await session.execute(select(Post).where(Post.id == id).options(*POST_DETAIL))).scalar()
         if p is None:
             return dict(error='Not found'), 404
         pj = dict(
@@ -181,31 +183,17 @@ class VoteIn(BaseModel):
 @bp.post('/post/<b32l:id>/upvote')
 @validate_request(VoteIn)
 async def upvote_post(id: int, data: VoteIn):
+    if data.vote not in (-1, 0, 1):
+        return { 'status': 400, 'error': 'Invalid score' }, 400
+
     async with db as session:
-        p: Post | None = (await session.execute(select(Post).where(Post.id == id))).scalar()
+        votes = await vote_buffer.cast(session, id, current_user.id, data.vote)
 
-        if p is None:
+        if votes is None:
             return { 'status': 404, 'error': 'Post not found' }, 404
-        
-        cur_score = await p.upvoted_by(current_user.user)
-
-        match (data.vote, cur_score):
-            case (1, 0) | (1, -1):
-                await session.execute(delete(PostUpvote).where(PostUpvote.c.post_id == p.id, PostUpvote.c.voter_id == current_user.id, PostUpvote.c.is_downvote == True))
-                await session.execute(insert(PostUpvote).values(post_id = p.id, voter_id = current_user.id, is_downvote = False))
-            case (0, _):
-                await session.execute(delete(PostUpvote).where(PostUpvote.c.post_id == p.id, PostUpvote.c.voter_id == current_user.id))
-            case (-1, 1) | (-1, 0):
-                await session.execute(delete(PostUpvote).where(PostUpvote.c.post_id == p.id, PostUpvote.c.voter_id == current_user.id, PostUpvote.c.is_downvote == False))
-                await session.execute(insert(PostUpvote).values(post_id = p.id, voter_id = current_user.id, is_downvote = True))
-            case (1, 1) | (1, -1):
-                pass
-            case _:
-                await session.rollback()
-                return { 'status': 400, 'error': 'Invalid score' }, 400
-        
+
         await session.commit()
-        return { 'votes': await p.upvotes() }
+        return { 'votes': votes }
 
 ## COMMENTS ##
 
@@ -216,13 +204,12 @@ async def post_comments (id: int):
 
         if p is None:
             return { 'status': 404, 'error': 'Post not found' }, 404
-        
-        l = []
-        for com in await p.top_level_comments():
-            com: Comment
-            l.append(await com.section_info())
-        
-        return dict(has=l)
+
+    try:
+        thread = await load_thread_page(p, request.args.get('cursor'))
+    except ValueError:
+        return { 'status': 400, 'error': 'Invalid cursor' }, 400
+    return dict(has=thread.section_info(), next=thread.next_cursor)
 
 
 
@@ -269,13 +256,11 @@ async def guild_feed(gname: str):
         if gu is None:
             return dict(error='Not found'), 404
         gj = await _guild_info(gu)
-        feed = []
-        algo = topic_timeline(gname)
-        posts = await db.paginate(algo)
-        async for p in posts:
-            feed.append(await p.feed_info_counts())
+        algo = topic_timeline(gu)
+        posts = await timeline_page(algo, topic_id=gu.id)
+        feed = posts.feed_info()
 
-    return dict(guilds={f'{Snowflake(gu.id):l}': gj}, feed=feed)
+    return dict(guilds={f'{Snowflake(gu.id):l}': gj}, feed=feed, next=posts.next_cursor)
 
 @bp.get('/guild/@<gname>/mods')
 @login_required
@@ -334,10 +319,13 @@ async def guild_post(data: CreateIn, gname: str):
                 topic_id = gu.id,
                 privacy = data.privacy,
                 title = data.title,
-                text_content = data.text
+                text_content = data.content,
+                **await html_values(Post, data.content)
             ).returning(Post.id))).scalar()
+            await post_created(session, new_post_id)
 
-            session.commit()
+            await session.commit()
+            await purge_pages(guild=gu.name, user=user.username)
             return dict(id=Snowflake(new_post_id).to_b32l()), 200
         except Exception:
             sys.excepthook(*sys.exc_info())
@@ -355,7 +343,7 @@ class LoginIn(BaseModel):
 async def login(data: LoginIn):
     async with db as session:
         u = (await session.execute(select(User).where(User.username == data.username))).scalar()
-        match check_login(u, data.password):
+        match await check_login(u, data.password):
             case LoginStatus.SUCCESS:
                 remember_for = int(data.remember)
                 if remember_for > 0:
@@ -374,10 +362,11 @@ async def login(data: LoginIn):
 @bp.post('/logout')
 @login_required
 async def logout():
+    await forget_principal(current_user.id)
     logout_user()
     return '', 204
 
-from ..accounts import RegisterIn, RegisterStatus, validate_register
+from ..accounts import RegisterIn, RegisterStatus, forget_principal, validate_register
 
 
 @bp.post('/register')
@@ -401,7 +390,8 @@ async def register(data: RegisterIn):
             async with db as session:
                 new_user_id: int = (await session.execute(insert(User).values(**user_data).returning(User.id))).scalar()
                 
-                session.commit()
+                await session.commit()
+                user_names.add(user_data['username'])
                 return dict(id=Snowflake(new_user_id).to_b32l()), 200
 
 
@@ -410,10 +400,7 @@ async def username_availability(username):
     is_valid = username_is_legal(username)
 
     if is_valid:
-        async with db as session:
-            user = (await session.execute(select(User).where(User.username == username))).scalar()
-
-            is_available = user is None or user == current_user.user
+        is_available = not await user_names.exists(username) or (bool(current_user) and username == current_user.username)
     else:
         is_available = False
 
@@ -429,34 +416,31 @@ async def username_availability(username):
 async def home_feed():
     async with db as session:
         me = current_user.user
-        posts = await db.paginate(private_timeline(me))
-        feed = []
-        async for post in posts:
-            post: Post
-            feed.append(await post.feed_info_counts())
+        posts = await home_page(me)
 
-        return dict(feed=feed)
+        return dict(feed=posts.feed_info(), next=posts.next_cursor)
 
 @bp.get('/explore/feed')
 @login_required
 async def explore_feed():
     async with db as session:
-        posts = await db.paginate(public_timeline())
-        feed = []
-        async for post in posts:
-            post: Post
-            feed.append(await post.feed_info_counts())
-        
-        return dict(feed=feed)
+        posts = await timeline_page(public_timeline())
+
+        return dict(feed=posts.feed_info(), next=posts.next_cursor)
 
 
 @bp.get('/top/guilds')
 async def top_guilds():
-    async with db as session:
-        top_g = [await x.sub_info() for x in 
-            (await session.execute(top_guilds_query().limit(10))).scalars()]
+    by = request.args.get('sort', 'posts')
+    if by not in ('posts', 'trending'):
+        return dict(error='Invalid sort'), 400
+    top_g = [
+        dict(id=Snowflake(g.id).to_b32l(), name=g.name, display_name=g.display_name, badges=[],
+            subscriber_count=g.sub_count, post_count=g.post_count, trending=round(g.trending, 3))
+        for g in await guild_leaderboard.get(10, by=by)
+    ]
 
-        return dict(has=top_g)
+    return dict(has=top_g)
 
 ## SEARCH ##
 
@@ -466,12 +450,17 @@ class QueryIn(BaseModel):
 @bp.post('/search/top')
 @validate_request(QueryIn)
 async def search_top(data: QueryIn):
-    async with db as session:
-        sq = SearchQuery(data.query)
-
-        result = (await session.execute(sq.select(Post, [Post.title]).limit(20))).scalars()
-        
-        return dict(has = [p.feed_info() for p in result])
+    sq = SearchQuery(data.query)
+    results = await search_page(sq)
+    if sq.kind == 'comment':
+        return dict(has = [dict(
+            id = Snowflake(c.id).to_b32l(),
+            post = dict(id=Snowflake(c.parent_post_id).to_b32l(), title=c.parent_post.title),
+            author = c.author.simple_info() if c.author else None,
+            content = c.text_content,
+            created_at = want_isodate(c.created_at)
+        ) for c in results])
+    return dict(has = results.feed_info())
     
 
 ## SUGGEST
@@ -482,12 +471,14 @@ async def search_top(data: QueryIn):
 async def suggest_guild(data: QueryIn):
     if not data.query.isidentifier():
         return dict(has=[])
+    names = await guild_names.prefixed(data.query, 10)
+    if not names:
+        return dict(has=[])
     async with db as session:
-        sq = select(Guild).where(Guild.name.like(data.query + "%"))
-
-        result: Iterable[Guild] = (await session.execute(sq.limit(10))).scalars()
+        result: list[Guild] = list((await session.execute(select(Guild).where(Guild.name.in_(names)).order_by(Guild.name))).scalars())
 
-        return dict(has = [g.simple_info() for g in result if await g.allows_posting(current_user.user)])
+    allowed = await Guild.allows_posting_many(result, current_user.user)
+    return dict(has = [g.simple_info() for g in result if allowed[g.id]])
 
 
 ## SETTINGS
@@ -522,8 +513,10 @@ async def patch_settings_appearance(data: SettingsIn):
         _missing_or(data.color_theme, u.color_theme % (1 << 8)) % 256 +
         _missing_or(data.color_scheme, u.color_theme >> 8) << 8
     )
-    current_user.session.add(u)
-    await current_user.session.commit()
+    async with db as session:
+        session.add(u)
+        await session.commit()
+    await forget_principal(u.id)
 
     return '', 204
 
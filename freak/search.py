@@ -1,25 +1,145 @@
+import datetime
+import re
+from typing import Iterable
+from sqlalchemy import Column, Select, and_, func, literal_column, select, or_
 
+## text search configuration of search vectors (see Post.search_vector);
+## no stemming nor stop words, since posts come in any language.
+## Changing it takes a migration.
+TS_CONFIG = 'simple'
 
+## a term, optionally negated; quoted terms are phrases
+_TERM_RE = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
 
-from typing import Iterable
-from sqlalchemy import Column, Select, select, or_
+SEARCH_KINDS = ('post', 'comment')
+
+def snowflake_at(when: datetime.datetime, epoch: int) -> int:
+    """
+    The smallest Snowflake generated at when (UTC if naive) or later.
+
+    Snowflakes start with the milliseconds since epoch, so id ranges
+    stand for time ranges, and are served by the primary key.
+
+    NEW 0.5.0
+    """
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0, int((when.timestamp() - epoch) * 1000)) << 22
+
+def _escape_like(s: str) -> str:
+    return s.replace('\\', r'\\').replace('%', r'\%').replace('_', r'\_')
 
 class SearchQuery:
-    keywords: Iterable[str]
+    """
+    Keyword search; results contain all of the keywords.
+
+    Tables with a search_vector column (a tsvector with a GIN index) are
+    searched with it, and results are ranked with ts_rank(). Other tables
+    fall back to ILIKE on attrs.
+
+    Besides keywords, queries understand:
+
+    - "quoted phrases";
+    - -word and -"phrase", which must not appear;
+    - +guild and @user, to search only in those guilds or by those users
+      (any of them, if more than one);
+    - after:YYYY-MM-DD and before:YYYY-MM-DD (UTC, after is inclusive);
+    - type:post (default) or type:comment.
+
+    Dates become ranges on ids, guilds and users are left to the caller
+    (they need a lookup).
+
+    *Changed in 0.5.0*: full text search, query syntax
+    """
+    keywords: list[str]
+    phrases: list[str]
+    excluded: list[str]
+    guilds: list[str]
+    users: list[str]
+    after: datetime.date | None = None
+    before: datetime.date | None = None
+    kind: str = 'post'
 
     def __init__(self, keywords: str | Iterable[str]):
         if isinstance(keywords, str):
-            keywords = keywords.split()
-        self.keywords = keywords
+            keywords = [keywords]
+        self.keywords, self.phrases, self.excluded = [], [], []
+        self.guilds, self.users = [], []
+        for chunk in keywords:
+            for m in _TERM_RE.finditer(chunk.lower()):
+                self._add_term(m.group(2) if m.group(2) is not None else m.group(3), negated=bool(m.group(1)), quoted=m.group(2) is not None)
+
+    def _add_term(self, term: str, *, negated: bool, quoted: bool):
+        if quoted:
+            term = ' '.join(term.split())
+            if term:
+                (self.excluded if negated else self.phrases).append(term)
+            return
+        if negated:
+            if term:
+                self.excluded.append(term)
+            return
+        if term.startswith('+') and len(term) > 1:
+            self.guilds.append(term[1:])
+        elif term.startswith('@') and len(term) > 1:
+            self.users.append(term[1:])
+        elif term.startswith(('after:', 'before:')):
+            key, _, value = term.partition(':')
+            try:
+                setattr(self, key, datetime.date.fromisoformat(value))
+            except ValueError:
+                self.keywords.append(term)
+        elif term.startswith('type:') and term[5:] in SEARCH_KINDS:
+            self.kind = term[5:]
+        else:
+            self.keywords.append(term)
+
+    def normalized(self) -> str:
+        """
+        Canonical form of the query: queries which differ only in the order
+        of unordered terms (or in spacing, case...) give the same string.
+        """
+        parts = [f'type:{self.kind}']
+        parts.extend(sorted(set(self.keywords)))
+        parts.extend(f'"{p}"' for p in sorted(set(self.phrases)))
+        parts.extend(f'-"{e}"' for e in sorted(set(self.excluded)))
+        parts.extend(f'+{g}' for g in sorted(set(self.guilds)))
+        parts.extend(f'@{u}' for u in sorted(set(self.users)))
+        if self.after:
+            parts.append(f'after:{self.after.isoformat()}')
+        if self.before:
+            parts.append(f'before:{self.before.isoformat()}')
+        return ' '.join(parts)
+
+    def has_text(self) -> bool:
+        return bool(self.keywords or self.phrases or self.excluded)
+
+    def tsquery(self):
+        ## websearch_to_tsquery() never fails on user input
+        text = ' '.join([*self.keywords, *(f'"{p}"' for p in self.phrases), *(f'-"{e}"' for e in self.excluded)])
+        return func.websearch_to_tsquery(literal_column(f"'{TS_CONFIG}'"), text)
+
+    def id_range(self, id_column: Column) -> list:
+        epoch = id_column.table.metadata.info['snowflake_epoch']
+        conds = []
+        if self.after:
+            conds.append(id_column >= snowflake_at(datetime.datetime.combine(self.after, datetime.time()), epoch))
+        if self.before:
+            conds.append(id_column < snowflake_at(datetime.datetime.combine(self.before, datetime.time()), epoch))
+        return conds
+
     def select(self, table: type, attrs: Iterable[Column]) -> Select:
         if not attrs:
             raise TypeError
-        sq: Select = select(table)
-        for kw in self.keywords:
-            or_cond = []
-            for attr in attrs:
-                or_cond.append(attr.ilike(f"%{kw.replace('%', r'\%')}%"))
-            sq = sq.where(or_(*or_cond) if len(or_cond) > 1 else or_cond[0])
-        return sq
-
+        sq: Select = select(table).where(*self.id_range(table.id))
+        if not self.has_text():
+            return sq.order_by(table.id.desc())
+        if (vector := getattr(table, 'search_vector', None)) is not None:
+            tsq = self.tsquery()
+            return sq.where(vector.op('@@')(tsq)).order_by(func.ts_rank(vector, tsq).desc(), table.id.desc())
+        for kw in [*self.keywords, *self.phrases]:
+            sq = sq.where(or_(*(attr.ilike(f"%{_escape_like(kw)}%") for attr in attrs)))
+        for kw in self.excluded:
+            sq = sq.where(and_(*(func.coalesce(attr, '').not_ilike(f"%{_escape_like(kw)}%") for attr in attrs)))
+        return sq.order_by(table.id.desc())
 
@@ -0,0 +1,359 @@
+"""
+Comment threads.
+
+Post pages and REST show threads a page at a time, with load_thread_page():
+COMMENT_PAGE_SIZE comments, each with up to REPLY_PAGE_SIZE replies, down
+to THREAD_PAGE_DEPTH levels. Whatever is left out gets a continuation
+cursor, so a page costs the same however big the thread is.
+
+Deeper down ("Continue this thread"), pages are SUBTREE_PAGE_SIZE comments
+of a subtree, depth first: one range scan on Comment.path, put together
+in memory by build_thread().
+
+NEW 0.5.0
+"""
+
+from __future__ import annotations
+
+import base64
+import binascii
+from collections import defaultdict
+import datetime
+import struct
+from typing import Iterator
+
+from quart_auth import current_user
+from sqlalchemy import BigInteger, and_, column, false, func, or_, select, true, tuple_, values
+from sqlalchemy.orm import raiseload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .accounts import UserLoader
+from .models import COMMENT_PATH_DIGITS, Comment, Post, comment_path_ids, db
+
+current_user: UserLoader
+
+## top level comments in a page, or replies in a continuation
+COMMENT_PAGE_SIZE = 20
+## replies shown under each comment
+REPLY_PAGE_SIZE = 5
+## levels of comments in a page
+THREAD_PAGE_DEPTH = 3
+## comments in a page of a subtree
+SUBTREE_PAGE_SIZE = 50
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+## (parent comment id, or 0 for top level; created_at in µs, or -1 from the start; comment id)
+_CURSOR_FORMAT = '>qqq'
+## (subtree root id; id of the last comment shown, or 0 from the start)
+_SUBTREE_CURSOR_FORMAT = '>qq'
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(cursor: str) -> bytes:
+    try:
+        return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
+
+def encode_thread_cursor(parent_id: int | None, after: Comment | None = None) -> str:
+    """
+    Opaque cursor pointing to the replies to parent_id (None for top level
+    comments) that come after the comment after, or all of them.
+    """
+    if after is None:
+        raw = struct.pack(_CURSOR_FORMAT, parent_id or 0, -1, 0)
+    else:
+        raw = struct.pack(_CURSOR_FORMAT, parent_id or 0, (after.created_at - _EPOCH) // datetime.timedelta(microseconds=1), after.id)
+    return _b64encode(raw)
+
+def decode_thread_cursor(cursor: str) -> tuple[int | None, tuple[datetime.datetime, int] | None]:
+    """
+    Inverse of encode_thread_cursor(): (parent id, (created_at, id) or None).
+    Raises ValueError on malformed input.
+    """
+    try:
+        parent_id, created_at, comment_id = struct.unpack(_CURSOR_FORMAT, _b64decode(cursor))
+    except struct.error as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
+    after = None if created_at < 0 else (_EPOCH + datetime.timedelta(microseconds=created_at), comment_id)
+    return parent_id or None, after
+
+def encode_subtree_cursor(root_id: int, after_id: int | None = None) -> str:
+    """
+    Opaque cursor pointing to the replies (at any depth) to root_id,
+    depth first, that come after the comment after_id, or all of them.
+    """
+    return _b64encode(struct.pack(_SUBTREE_CURSOR_FORMAT, root_id, after_id or 0))
+
+def decode_subtree_cursor(cursor: str) -> tuple[int, int | None]:
+    """
+    Inverse of encode_subtree_cursor(): (root id, after id or None).
+    Raises ValueError on malformed input.
+    """
+    try:
+        root_id, after_id = struct.unpack(_SUBTREE_CURSOR_FORMAT, _b64decode(cursor))
+    except struct.error as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
+    return root_id, after_id or None
+
+def is_subtree_cursor(cursor: str) -> bool:
+    return len(_b64decode(cursor)) == struct.calcsize(_SUBTREE_CURSOR_FORMAT)
+
+class CommentNode:
+    """
+    A comment in a thread, with its replies (oldest first).
+
+    more is the cursor of the replies left out, if any.
+    """
+    __slots__ = ('comment', 'children', 'depth', 'locked', 'more')
+
+    def __init__(self, comment: Comment, depth: int = 0, locked: bool = False):
+        self.comment = comment
+        self.children: list[CommentNode] = []
+        self.depth = depth
+        self.locked = locked
+        self.more: str | None = None
+
+    @property
+    def id(self) -> int:
+        return self.comment.id
+
+    def walk(self) -> Iterator[CommentNode]:
+        """
+        This node and every node under it, depth first.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def section_info(self) -> dict:
+        """
+        REST representation of the comment and its replies.
+        """
+        return dict(self.comment.section_info_with(self.locked), depth=self.depth,
+            replies=[child.section_info() for child in self.children], more=self.more)
+
+class CommentThread:
+    """
+    The comments of a post, as a tree. Iterating it yields the top level
+    comments (newest first) as CommentNode's.
+
+    A page of a thread (see load_thread_page()) may start from the replies
+    to parent_id instead, and has next_cursor if there are more.
+    Top level comments of a subtree page are the oldest first, and may be
+    at different depths when the page resumes halfway through a branch.
+    """
+    def __init__(self, post: Post, roots: list[CommentNode], nodes: dict[int, CommentNode], *,
+        parent_id: int | None = None, next_cursor: str | None = None):
+        self.post = post
+        self.roots = roots
+        self.nodes = nodes
+        self.parent_id = parent_id
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.roots)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def __getitem__(self, comment_id: int) -> CommentNode:
+        return self.nodes[comment_id]
+
+    def walk(self) -> Iterator[CommentNode]:
+        for root in self.roots:
+            yield from root.walk()
+
+    def section_info(self) -> list[dict]:
+        return [root.section_info() for root in self.roots]
+
+def build_thread(post: Post, comments: list[Comment], *, hidden_authors: set[int] = frozenset(),
+    locked_paths: set[str] = frozenset(), locked: bool = False, **kwargs) -> CommentThread:
+    """
+    Put comments, in path order (i.e. depth first), together into a tree.
+    Comments whose parent is not among them are the top level of the
+    tree, in order; depths are taken from paths.
+
+    Comments by hidden_authors are left out along with their replies.
+    Comments are locked if locked is true (i.e. from above), if they are,
+    or if any of their parents is; parents which are not among comments
+    are known by their path, in locked_paths.
+
+    Other keyword arguments go to CommentThread.
+    """
+    nodes: dict[int, CommentNode] = {}
+    roots: list[CommentNode] = []
+    hidden: set[int] = set()
+    for c in comments:
+        if c.author_id in hidden_authors or c.parent_comment_id in hidden:
+            hidden.add(c.id)
+            continue
+        depth = len(comment_path_ids(c.path)) - 1
+        if (parent := nodes.get(c.parent_comment_id)) is not None:
+            node = CommentNode(c, depth, parent.locked or bool(c.is_locked))
+            parent.children.append(node)
+        else:
+            path_locked = any(c.path[:n] in locked_paths for n in range(COMMENT_PATH_DIGITS, len(c.path) + 1, COMMENT_PATH_DIGITS))
+            node = CommentNode(c, depth, locked or path_locked or bool(c.is_locked))
+            roots.append(node)
+        nodes[c.id] = node
+    return CommentThread(post, roots, nodes, **kwargs)
+
+def _visible(hidden_authors):
+    if not hidden_authors:
+        return true()
+    return or_(Comment.author_id == None, Comment.author_id.not_in(hidden_authors))
+
+def _comment_options():
+    return (selectinload(Comment.author), raiseload('*'))
+
+async def _ancestry(session, post: Post, comment_id: int) -> tuple[int, bool] | None:
+    """
+    Depth of a comment of post, and whether it or any of its parents is
+    locked; None if there is no such comment.
+    """
+    row = (await session.execute(select(Comment.path, Comment.parent_comment_id, Comment.is_locked
+        ).where(Comment.id == comment_id, Comment.parent_post_id == post.id))).first()
+    if row is None:
+        return None
+    if row.path is None:
+        ## not backfilled yet: walk up
+        depth, locked, seen = 0, bool(row.is_locked), {comment_id}
+        parent_id = row.parent_comment_id
+        while parent_id is not None and parent_id not in seen:
+            seen.add(parent_id)
+            parent = (await session.execute(select(Comment.parent_comment_id, Comment.is_locked).where(Comment.id == parent_id))).first()
+            if parent is None:
+                break
+            depth += 1
+            locked = locked or bool(parent.is_locked)
+            parent_id = parent.parent_comment_id
+        return depth, locked
+    ancestor_ids = comment_path_ids(row.path)[:-1]
+    if row.is_locked or not ancestor_ids:
+        return len(ancestor_ids), bool(row.is_locked)
+    return len(ancestor_ids), bool((await session.execute(select(func.bool_or(Comment.is_locked)).where(Comment.id.in_(ancestor_ids)))).scalar())
+
+async def _replies_to(session, post: Post, parent_ids: list[int], limit: int, hidden_authors) -> dict[int, list[Comment]]:
+    """
+    The first limit replies to each of parent_ids, in one query.
+    """
+    parents = values(column('id', BigInteger), name='parents').data([(i,) for i in parent_ids])
+    firsts = select(Comment.id).where(
+        Comment.parent_post_id == post.id, Comment.parent_comment_id == parents.c.id, _visible(hidden_authors)
+    ).order_by(Comment.created_at, Comment.id).limit(limit).lateral('firsts')
+    comments = (await session.execute(select(Comment).where(
+        Comment.id.in_(select(firsts.c.id).select_from(parents).join(firsts, true()))
+    ).order_by(Comment.created_at, Comment.id).options(*_comment_options()))).scalars()
+    replies = defaultdict(list)
+    for c in comments:
+        replies[c.parent_comment_id].append(c)
+    return replies
+
+async def load_thread_page(post: Post, cursor: str | None = None) -> CommentThread:
+    """
+    A page of the thread of post, as seen by the current user, starting
+    from cursor: the first page if None, otherwise a next_cursor of a
+    thread or the more cursor of a CommentNode.
+
+    Takes one query per level, regardless of the size of the thread;
+    pages of subtrees take a few.
+    Raises ValueError if cursor is invalid.
+    """
+    if cursor and is_subtree_cursor(cursor):
+        return await _load_subtree_page(post, *decode_subtree_cursor(cursor))
+    parent_id, after = decode_thread_cursor(cursor) if cursor else (None, None)
+    hidden_authors = current_user.block_set.blocked_by
+    async with db as session:
+        depth, locked = 0, False
+        if parent_id is not None:
+            if (ancestry := await _ancestry(session, post, parent_id)) is None:
+                raise ValueError(f'invalid cursor: {cursor!r}')
+            depth, locked = ancestry[0] + 1, ancestry[1]
+
+        q = select(Comment).where(Comment.parent_post_id == post.id, Comment.parent_comment_id == parent_id, _visible(hidden_authors))
+        key = tuple_(Comment.created_at, Comment.id)
+        if parent_id is None:
+            ## top level: newest first
+            if after:
+                q = q.where(key < tuple_(*after))
+            q = q.order_by(Comment.created_at.desc(), Comment.id.desc())
+        else:
+            if after:
+                q = q.where(key > tuple_(*after))
+            q = q.order_by(Comment.created_at, Comment.id)
+        page = list((await session.execute(q.limit(COMMENT_PAGE_SIZE + 1).options(*_comment_options()))).scalars())
+
+        next_cursor = encode_thread_cursor(parent_id, page[COMMENT_PAGE_SIZE - 1]) if len(page) > COMMENT_PAGE_SIZE else None
+        roots = [CommentNode(c, depth, locked or bool(c.is_locked)) for c in page[:COMMENT_PAGE_SIZE]]
+        nodes = {node.id: node for node in roots}
+
+        level = roots
+        for n in range(1, THREAD_PAGE_DEPTH + 1):
+            if not level:
+                break
+            last = n == THREAD_PAGE_DEPTH
+            ## past the last level, just see whether there are replies at all
+            replies = await _replies_to(session, post, [node.id for node in level], 1 if last else REPLY_PAGE_SIZE + 1, hidden_authors)
+            next_level = []
+            for node in level:
+                children = replies.get(node.id, ())
+                if last:
+                    if children:
+                        node.more = encode_subtree_cursor(node.id)
+                    continue
+                if len(children) > REPLY_PAGE_SIZE:
+                    node.more = encode_thread_cursor(node.id, children[REPLY_PAGE_SIZE - 1])
+                for c in children[:REPLY_PAGE_SIZE]:
+                    child = CommentNode(c, node.depth + 1, node.locked or bool(c.is_locked))
+                    node.children.append(child)
+                    nodes[child.id] = child
+                next_level.extend(node.children)
+            level = next_level
+
+    for node in nodes.values():
+        set_committed_value(node.comment, 'parent_post', post)
+    return CommentThread(post, roots, nodes, parent_id=parent_id, next_cursor=next_cursor)
+
+async def _load_subtree_page(post: Post, root_id: int, after_id: int | None) -> CommentThread:
+    """
+    A page of the replies to root_id, at any depth, in path order.
+    """
+    async with db as session:
+        root_path = (await session.execute(select(Comment.path).where(Comment.id == root_id, Comment.parent_post_id == post.id))).scalar()
+        ancestry = await _ancestry(session, post, root_id)
+        after_path = None
+        if after_id is not None:
+            after_path = (await session.execute(select(Comment.path).where(Comment.id == after_id, Comment.parent_post_id == post.id))).scalar()
+    if ancestry is None:
+        raise ValueError(f'invalid cursor: no comment {root_id}')
+    if root_path is None:
+        ## not backfilled yet: a level at a time
+        return await load_thread_page(post, encode_thread_cursor(root_id))
+    if after_id is not None and (after_path is None or not after_path.startswith(root_path)):
+        ## e.g. deleted since the previous page
+        raise ValueError(f'invalid cursor: no comment {after_id} under {root_id}')
+
+    hidden_authors = current_user.block_set.blocked_by
+    in_root = and_(Comment.parent_post_id == post.id, Comment.in_subtree(root_path))
+    async with db as session:
+        ## subtrees left out (by hidden authors), or locked from above a page
+        marked = (await session.execute(select(Comment.path, Comment.author_id, Comment.is_locked).where(
+            in_root, or_(Comment.is_locked, Comment.author_id.in_(hidden_authors) if hidden_authors else false())
+        ))).all()
+        hidden_paths = [m.path for m in marked if m.author_id in hidden_authors]
+
+        q = select(Comment).where(in_root, *(or_(Comment.path < hp, Comment.path >= hp + 'g') for hp in hidden_paths))
+        if after_path is not None:
+            q = q.where(Comment.path > after_path)
+        page = list((await session.execute(q.order_by(Comment.path).limit(SUBTREE_PAGE_SIZE + 1).options(*_comment_options()))).scalars())
+
+    next_cursor = encode_subtree_cursor(root_id, page[SUBTREE_PAGE_SIZE - 1].id) if len(page) > SUBTREE_PAGE_SIZE else None
+    thread = build_thread(post, page[:SUBTREE_PAGE_SIZE], locked=ancestry[1], locked_paths={m.path for m in marked if m.is_locked},
+        parent_id=root_id, next_cursor=next_cursor)
+    for node in thread.nodes.values():
+        set_committed_value(node.comment, 'parent_post', post)
+    return thread
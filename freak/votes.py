@@ -0,0 +1,358 @@
+"""
+Write-coalescing buffer for votes.
+
+When a post gets many votes at once, writing each of them means everyone
+queues on its freak_post_stats row. With FREAK_VOTE_FLUSH_INTERVAL set,
+votes are kept in memory and written in batches instead, with the stats
+row of each post updated once per batch.
+
+Votes waiting in memory are also appended to a journal on disk, in
+FREAK_VOTE_JOURNAL_DIR, so that the votes of a worker that crashed are
+written by the next one to start.
+
+NEW 0.5.0
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+import fcntl
+import glob
+import logging
+import os
+import tempfile
+import time
+
+from sqlalchemy import delete, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+
+from . import app_config
+from .models import Post, PostStats, PostUpvote, cast_vote, db, hot_rank_of, rising_rank_of
+
+logger = logging.getLogger(__name__)
+
+## past this many pending votes, the buffer is flushed before taking more
+MAX_PENDING_VOTES = 10000
+
+async def write_votes(session, votes: dict[tuple[int, int], int]) -> dict[int, int]:
+    """
+    Write many votes at once, given as {(post_id, voter_id): vote}.
+    Votes on posts that no longer exist are dropped.
+
+    Returns the new score of every post involved.
+    """
+    post_ids = sorted({pid for pid, _ in votes})
+    existing = set((await session.execute(select(Post.id).where(Post.id.in_(post_ids)))).scalars())
+    keys = sorted(key for key in votes if key[0] in existing)
+    if not keys:
+        return {}
+
+    ## rows are locked in key order, so that concurrent flushes can't deadlock
+    old_votes = {(pid, uid): (-1 if is_downvote else 1) for pid, uid, is_downvote in await session.execute(
+        select(PostUpvote.c.post_id, PostUpvote.c.voter_id, PostUpvote.c.is_downvote)
+        .where(tuple_(PostUpvote.c.post_id, PostUpvote.c.voter_id).in_(keys))
+        .order_by(PostUpvote.c.post_id, PostUpvote.c.voter_id)
+        .with_for_update()
+    )}
+    changes = [(key, old_votes.get(key, 0), votes[key]) for key in keys if old_votes.get(key, 0) != votes[key]]
+
+    if casts := [dict(post_id=pid, voter_id=uid, is_downvote=vote < 0) for (pid, uid), _, vote in changes if vote]:
+        ins = pg_insert(PostUpvote).values(casts)
+        await session.execute(ins.on_conflict_do_update(
+            index_elements=[PostUpvote.c.post_id, PostUpvote.c.voter_id],
+            set_={'is_downvote': ins.excluded.is_downvote}
+        ))
+    if retracts := [key for key, _, vote in changes if not vote]:
+        await session.execute(delete(PostUpvote).where(tuple_(PostUpvote.c.post_id, PostUpvote.c.voter_id).in_(retracts)))
+
+    ## (score, upvotes, downvotes)
+    deltas: dict[int, list[int]] = defaultdict(lambda: [0, 0, 0])
+    for (pid, _), old_vote, vote in changes:
+        d = deltas[pid]
+        d[0] += vote - old_vote
+        d[1] += int(vote == 1) - int(old_vote == 1)
+        d[2] += int(vote == -1) - int(old_vote == -1)
+    for pid, (score_d, up_d, down_d) in sorted(deltas.items()):
+        new_score = PostStats.score + score_d
+        await session.execute(update(PostStats).where(PostStats.post_id == pid).values(
+            score = new_score,
+            upvote_count = PostStats.upvote_count + up_d,
+            downvote_count = PostStats.downvote_count + down_d,
+            hot_rank = hot_rank_of(new_score, PostStats.created_at),
+            rising_rank = rising_rank_of(new_score, PostStats.comment_count, PostStats.created_at)
+        ))
+
+    return {pid: score for pid, score in await session.execute(
+        select(PostStats.post_id, PostStats.score).where(PostStats.post_id.in_(existing))
+    )}
+
+async def write_votes_one_by_one(votes: dict[tuple[int, int], int]) -> dict[int, int]:
+    """
+    Fallback of write_votes(), with a transaction per vote. Votes that can't
+    be written (e.g. their voter was deleted meanwhile) are dropped, so that
+    they don't fail every batch after them.
+
+    Returns the new score of every post involved.
+    """
+    scores = {}
+    for (post_id, voter_id), vote in sorted(votes.items()):
+        try:
+            async with db as session:
+                score = await cast_vote(session, post_id, voter_id, vote)
+        except IntegrityError as e:
+            logger.warning(f'dropped vote of {voter_id} on {post_id}: {e.orig}')
+            continue
+        if score is not None:
+            scores[post_id] = score
+    return scores
+
+async def write_votes_safely(votes: dict[tuple[int, int], int]) -> dict[int, int]:
+    """
+    write_votes() in its own transaction, falling back to
+    write_votes_one_by_one() if any of them breaks a constraint.
+    """
+    try:
+        async with db as session:
+            scores = await write_votes(session, votes)
+            await session.commit()
+        return scores
+    except IntegrityError as e:
+        logger.warning(f'cannot write {len(votes)} votes at once, writing them one by one: {e.orig}')
+    return await write_votes_one_by_one(votes)
+
+class VoteJournal:
+    """
+    Append-only log of the votes waiting in a VoteBuffer.
+
+    Each worker appends to segments named <worker>.<n>.log, and holds a lock
+    on <worker>.lock while running, where <worker> is its pid and start time. Segments are deleted once their votes are
+    written. Segments whose lock is free belong to a worker that is gone,
+    and are picked up by orphans().
+
+    Lines are written through to the OS: they survive the worker,
+    not the machine (unless the directory is on a synced filesystem).
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.worker = f'{os.getpid()}-{time.time_ns()}'
+        self._lock_file = None
+        self._file = None
+        self._n = 0
+        ## closed segments whose votes are not written yet
+        self._closed: list[str] = []
+
+    def _segment(self, n: int) -> str:
+        return os.path.join(self.directory, f'{self.worker}.{n}.log')
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, f'{self.worker}.lock'), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._file = open(self._segment(self._n), 'a', buffering=1)
+
+    def append(self, post_id: int, voter_id: int, vote: int):
+        self._file.write(f'{post_id} {voter_id} {vote}\n')
+
+    def rotate(self) -> list[str]:
+        """
+        Start a new segment. Returns the segments holding the votes
+        written so far.
+        """
+        self._file.close()
+        self._closed.append(self._segment(self._n))
+        self._n += 1
+        self._file = open(self._segment(self._n), 'a', buffering=1)
+        return list(self._closed)
+
+    def discard(self, segments: list[str]):
+        """
+        Delete segments whose votes are written.
+        """
+        for path in segments:
+            os.unlink(path)
+            self._closed.remove(path)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        if not self._closed and not os.path.getsize(self._segment(self._n)):
+            os.unlink(self._segment(self._n))
+            os.unlink(self._lock_file.name)
+        self._lock_file.close()
+        self._file = self._lock_file = None
+
+    def orphans(self):
+        """
+        Yield (votes, done) for the segments of every worker that is gone.
+        Call done() once the votes are written, to delete the segments;
+        otherwise they are tried again at the next start.
+        """
+        for lock_path in glob.glob(os.path.join(self.directory, '*.lock')):
+            worker = os.path.basename(lock_path).partition('.')[0]
+            if worker == self.worker:
+                continue
+            lock_file = open(lock_path)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                ## still running
+                lock_file.close()
+                continue
+            segments = sorted(glob.glob(os.path.join(self.directory, f'{worker}.*.log')),
+                key=lambda p: int(os.path.basename(p).split('.')[1]))
+            votes = {}
+            for path in segments:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            post_id, voter_id, vote = map(int, line.split())
+                        except ValueError:
+                            ## cut short by the crash
+                            continue
+                        votes[post_id, voter_id] = vote
+            def done(segments=segments, lock_path=lock_path):
+                for path in segments:
+                    os.unlink(path)
+                os.unlink(lock_path)
+            try:
+                yield votes, done
+            finally:
+                lock_file.close()
+
+class VoteBuffer:
+    """
+    Votes accepted in memory, and written every FREAK_VOTE_FLUSH_INTERVAL
+    milliseconds by write_votes(). Only the last vote of a voter on a post
+    is kept.
+
+    Votes are written right away (with cast_vote()) when the buffer is not
+    running (disabled, or CLI). A full buffer is flushed first; if that
+    fails, the vote is written right away instead. A failed flush puts its votes back
+    for the next one, and the buffer is flushed on shutdown. Pending votes
+    are journaled (see VoteJournal): after a crash, the next worker to start
+    writes them.
+
+    NEW 0.5.0
+    """
+    def __init__(self):
+        self.pending: dict[tuple[int, int], int] = {}
+        ## post id -> sum of its pending votes
+        self.pending_scores: dict[int, int] = defaultdict(int)
+        ## post id -> score after the last flush
+        self.scores: dict[int, int] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self.journal: VoteJournal | None = None
+
+    async def cast(self, session, post_id: int, voter_id: int, vote: int) -> int | None:
+        """
+        Same as cast_vote(). While buffered, the returned score is an estimate
+        which takes pending votes as first votes.
+        """
+        if vote not in (-1, 0, 1):
+            raise ValueError(f'invalid vote: {vote!r}')
+        if self._task is None:
+            return await cast_vote(session, post_id, voter_id, vote)
+        if len(self.pending) >= MAX_PENDING_VOTES:
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'cannot flush votes: {e}')
+            if len(self.pending) >= MAX_PENDING_VOTES:
+                return await self._cast_now(session, post_id, voter_id, vote)
+        if post_id not in self.scores:
+            row = (await session.execute(select(Post.id, PostStats.score)
+                .outerjoin(PostStats, PostStats.post_id == Post.id).where(Post.id == post_id))).first()
+            if row is None:
+                return None
+            self.scores[post_id] = row[1] or 0
+        key = (post_id, voter_id)
+        self.journal.append(post_id, voter_id, vote)
+        self.pending_scores[post_id] += vote - self.pending.get(key, 0)
+        self.pending[key] = vote
+        return self.scores[post_id] + self.pending_scores[post_id]
+
+    async def _cast_now(self, session, post_id: int, voter_id: int, vote: int) -> int | None:
+        """
+        Write a vote around the buffer, dropping the pending vote of the same
+        voter, which would otherwise overwrite it at the next flush.
+        """
+        async with self._lock:
+            ## replayed after the older one, if the worker crashes
+            self.journal.append(post_id, voter_id, vote)
+            if (old := self.pending.pop((post_id, voter_id), None)) is not None:
+                self.pending_scores[post_id] -= old
+            score = await cast_vote(session, post_id, voter_id, vote)
+            if score is None:
+                return None
+            self.scores[post_id] = score
+            return score + self.pending_scores.get(post_id, 0)
+
+    async def flush(self):
+        async with self._lock:
+            batch, self.pending = self.pending, {}
+            batch_scores, self.pending_scores = self.pending_scores, defaultdict(int)
+            ## until written, estimates count them as part of the score
+            self.scores = {pid: self.scores.get(pid, 0) + d for pid, d in batch_scores.items()}
+            segments = self.journal.rotate() if self.journal else []
+            if not batch:
+                if self.journal:
+                    self.journal.discard(segments)
+                return
+            try:
+                scores = await write_votes_safely(batch)
+            except BaseException:
+                ## back to pending, unless the same voter voted again since
+                for pid, d in batch_scores.items():
+                    self.scores[pid] -= d
+                for key, vote in batch.items():
+                    if key not in self.pending:
+                        self.pending[key] = vote
+                        self.pending_scores[key[0]] += vote
+                raise
+            self.scores = scores
+            if self.journal:
+                self.journal.discard(segments)
+
+    async def replay(self):
+        """
+        Write the journaled votes of workers that did not shut down cleanly.
+        """
+        for votes, done in self.journal.orphans():
+            await write_votes_safely(votes)
+            done()
+            logger.info(f'wrote {len(votes)} votes left by a previous worker')
+
+    async def _run(self):
+        try:
+            await self.replay()
+        except Exception as e:
+            logger.error(f'cannot write journaled votes: {e}')
+        while True:
+            await asyncio.sleep(app_config.vote_flush_interval / 1000)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'cannot flush votes: {e}')
+
+    def start(self):
+        if self._task is None and app_config.vote_flush_interval > 0:
+            self.journal = VoteJournal(app_config.vote_journal_dir or os.path.join(tempfile.gettempdir(), 'freak-votes'))
+            self.journal.open()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'cannot flush votes: {e}; {len(self.pending)} votes left in the journal')
+            self.journal.close()
+            self.journal = None
+
+vote_buffer = VoteBuffer()
@@ -16,7 +16,6 @@ from .. import UserLoader
 from ..models import REPORT_REASONS, db, User
 from ..utils import age_and_days, get_request_form
 from sqlalchemy import select, insert
-from werkzeug.security import generate_password_hash
 
 current_user: UserLoader
 
@@ -24,7 +23,8 @@ logger = logging.getLogger(__name__)
 
 bp = Blueprint('accounts', __name__)
 
-from ..accounts import LoginStatus, check_login
+from ..accounts import LoginStatus, check_login, forget_principal, hash_password
+from ..names import user_names
 
 
 @bp.get('/login')
@@ -45,7 +45,7 @@ async def post_login():
     async with db as session:
         user = (await session.execute(user_q)).scalar()
 
-        match check_login(user, password):
+        match await check_login(user, password):
             case LoginStatus.SUCCESS:
                 remember_for = int(form.get('remember', 0))
                 if remember_for > 0:
@@ -63,6 +63,8 @@ async def post_login():
 
 @bp.route('/logout')
 async def logout():
+    if current_user:
+        await forget_principal(current_user.id)
     logout_user()
     await flash('Logged out. Come back soon~')
     return redirect(request.args.get('next','/'))
@@ -103,7 +105,7 @@ async def validate_register_form() -> dict:
 
     if form['password'] != form['confirm_password']:
         raise ValueError('Passwords do not match.')
-    f['passhash'] = generate_password_hash(form['password'])
+    f['passhash'] = await hash_password(form['password'])
 
     f['email'] = form['email'] or None
 
@@ -132,7 +134,9 @@ async def register_post():
     try:
         async with db as session:
             await session.execute(insert(User).values(**user_data))
-        
+            await session.commit()
+        user_names.add(user_data['username'])
+
         await flash('Account created successfully. You can now log in.')
         return redirect(request.args.get('next', '/'))
     except Exception as e:
@@ -169,7 +173,8 @@ async def settings():
                     changes, user.color_theme = True, comp_color_theme
             if changes:
                 session.add(user)
-                session.commit()
+                await session.commit()
+                await forget_principal(user.id)
             await flash('Changes saved!')
         
     return await render_template('usersettings.html')
@@ -18,6 +18,9 @@ logger = logging.getLogger(__name__)
 from freak import UserLoader, app_config
 from freak.utils import get_request_form
 
+from ..accounts import forget_principal
+from ..cache import cache
+from ..pagecache import purge_pages
 from ..models import REPORT_REASON_STRINGS, REPORT_REASONS, REPORT_TARGET_COMMENT, REPORT_TARGET_POST, REPORT_UPDATE_COMPLETE, REPORT_UPDATE_ON_HOLD, REPORT_UPDATE_REJECTED, Comment, Post, PostReport, User, UserStrike, db
 
 bp = Blueprint('admin', __name__)
@@ -69,7 +72,11 @@ def colorized_account_status_string(u: User):
         base += ' <span class="faint">{1}</span>'
     return Markup(base).format(t1, t2 + t3)
 
-async def remove_content(target, reason_code: int):
+async def remove_content(target, reason_code: int) -> dict:
+    """
+    Mark target as removed. Returns the arguments of purge_pages() for
+    the pages showing it, to be purged once the removal is committed.
+    """
     async with db as session:
         if isinstance(target, Post):
             target.removed_at = datetime.datetime.now()
@@ -81,6 +88,12 @@ async def remove_content(target, reason_code: int):
             target.removed_reason = reason_code
         session.add(target)
 
+    if isinstance(target, Post):
+        return dict(guild=target.guild and target.guild.name, user=target.author and target.author.username, post=target.id)
+    elif isinstance(target, Comment):
+        return dict(post=target.parent_post_id)
+    return {}
+
 def get_author(target) -> User | None:
     if isinstance(target, (Post, Comment)):
         return target.author
@@ -101,18 +114,19 @@ REPORT_ACTIONS = {}
 async def accept_report(target, source: PostReport, session: AsyncSession):
     if source.is_critical():
         warnings.warn('attempted remove on a critical report case, striking instead', UserWarning)
-        return await strike_report(target, source)
+        return await strike_report(target, source, session)
 
-    await remove_content(target, source.reason_code)
+    pages = await remove_content(target, source.reason_code)
 
     source.update_status = REPORT_UPDATE_COMPLETE
     session.add(source)
     await session.commit()
+    await purge_pages(**pages)
 
 
 @additem(REPORT_ACTIONS, '2')
 async def strike_report(target, source: PostReport, session: AsyncSession):
-    await remove_content(target, source.reason_code)
+    pages = await remove_content(target, source.reason_code)
 
     author = get_author(target)
     if author:
@@ -132,6 +146,10 @@ async def strike_report(target, source: PostReport, session: AsyncSession):
     source.update_status = REPORT_UPDATE_COMPLETE
     session.add(source)
     await session.commit()
+    await purge_pages(**pages)
+    if author:
+        await forget_principal(author.id)
+        await cache.purge(f'strikes:{author.id}')
 
 
 @additem(REPORT_ACTIONS, '0')
@@ -230,6 +248,8 @@ async def user_detail(id: int):
                 u.banned_reason = REPORT_REASONS.get(form.get('reason'), 0)
             else:
                 abort(400)
+            await session.commit()
+            await forget_principal(u.id)
         strikes = (await session.execute(select(UserStrike).where(UserStrike.user_id == id).order_by(UserStrike.id.desc()))).scalars()
     return await render_template('admin/admin_user_detail.html', u=u,
     report_reasons=REPORT_REASON_STRINGS, account_status_string=colorized_account_status_string, strikes=strikes)
@@ -8,7 +8,10 @@ from sqlalchemy import insert, select
 
 from freak import UserLoader
 from freak.utils import get_request_form
-from ..models import User, db, Guild, Post
+from ..models import User, db, Guild, Post, post_created
+from ..names import guild_names
+from ..pagecache import purge_pages
+from ..rendering import html_values
 
 current_user: UserLoader
 
@@ -42,10 +45,10 @@ async def create():
                 if guild is None:
                     await flash(f'Guild +{gname} not found or inaccessible')
                     return await create_savepoint('', title, text, privacy)
-                if guild.has_exiled(user):
+                if await guild.has_exiled(user):
                     await flash(f'You are banned from +{gname}')
                     return await create_savepoint('', title, text, privacy)
-                if not guild.allows_posting(user):
+                if not await guild.allows_posting(user):
                     await flash(f'You can\'t post on +{gname}')
                     return await create_savepoint('', title, text, privacy)
             else:
@@ -57,14 +60,18 @@ async def create():
                     created_at = datetime.datetime.now(),
                     privacy = privacy,
                     title = title,
-                    text_content = text
+                    text_content = text,
+                    **await html_values(Post, text)
                 ).returning(Post.id))).scalar()
-                
-                session.commit()
+                await post_created(session, new_post_id)
+
+                await session.commit()
+                await purge_pages(guild=guild and guild.name, user=user.username)
                 await flash(f'Published on {guild.handle() if guild else user.handle()}')
                 return redirect(url_for('detail.post_detail', id=new_post_id))
             except Exception as e:
                 sys.excepthook(*sys.exc_info())
+                await session.recover()
                 await flash('Unable to publish!')
     return await create_savepoint(target=request.args.get('on',''))
 
@@ -86,6 +93,7 @@ async def createguild():
                     name = c_name,
                     display_name = form.get('display_name', c_name),
                     description = form['description'],
+                    **await html_values(Guild, form['description']),
                     owner_id = current_user.id
                 ).returning(Guild))).scalar()
 
@@ -93,6 +101,7 @@ async def createguild():
                     raise RuntimeError('no returning')
 
                 await session.commit()
+                guild_names.add(new_guild.name)
                 return redirect(new_guild.url())
         except Exception:
             sys.excepthook(*sys.exc_info())
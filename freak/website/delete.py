@@ -9,6 +9,7 @@ from freak import UserLoader
 
 
 from ..models import Post, db, User
+from ..pagecache import purge_pages
 current_user: UserLoader
 
 bp = Blueprint('delete', __name__)
@@ -28,7 +29,9 @@ async def delete_post(id: int):
         pt = p.topic_or_user()
         
         if request.method == 'POST':
-            session.execute(delete(Post).where(Post.id == id, Post.author_id == current_user.id))
+            await session.execute(delete(Post).where(Post.id == id, Post.author_id == current_user.id))
+            await session.commit()
+            await purge_pages(guild=p.guild and p.guild.name, user=p.author.username, post=p.id)
             await flash('Your post has been deleted')
             return redirect(pt.url()), 303
     
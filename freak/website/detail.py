@@ -1,7 +1,6 @@
 
 from __future__ import annotations
 
-from typing import Iterable
 from quart import Blueprint, abort, flash, request, redirect, render_template, url_for
 from quart_auth import current_user
 from sqlalchemy import insert, select
@@ -10,12 +9,15 @@ from suou import Snowflake
 from freak import UserLoader
 
 from ..utils import get_request_form, is_b32l
-from ..models import Comment, Guild, db, User, Post
-from ..algorithms import new_comments, user_timeline
+from ..models import MAX_COMMENT_DEPTH, POST_DETAIL, Comment, Guild, comment_created, comment_path_ids, db, User, Post
+from ..algorithms import timeline_page, user_timeline
+from ..pagecache import cache_pages, purge_pages
+from ..rendering import html_values
+from ..threads import CommentThread, load_thread_page
 
 current_user: UserLoader
 
-bp = Blueprint('detail', __name__)
+bp = cache_pages(Blueprint('detail', __name__))
 
 @bp.route('/@<username>')
 async def user_profile(username):
@@ -25,8 +27,7 @@ async def user_profile(username):
         if user is None:
             abort(404)
 
-        posts = await db.paginate(user_timeline(user))
-        print(posts.pages)
+        posts = await timeline_page(user_timeline(user))
 
         return await render_template('userfeed.html', l=posts, user=user)
 
@@ -52,11 +53,11 @@ async def user_profile_s(username):
 async def single_post_post_hook(p: Post):
     if p.guild is not None:
         gu = p.guild
-        if gu.has_exiled(current_user.user):
+        if await gu.has_exiled(current_user.user):
             await flash(f'You have been banned from {gu.handle()}')
             return
 
-        if not gu.allows_posting(current_user.user):
+        if not await gu.allows_posting(current_user.user):
             await flash(f'You can\'t post in {gu.handle()}')
             return
 
@@ -65,20 +66,32 @@ async def single_post_post_hook(p: Post):
         return
 
     form = await get_request_form()
-    if 'reply_to' in form:
-        reply_to_id = form['reply_to']
+    if 'text' in form:
+        reply_to_id = form.get('reply_to')
         text = form['text']
 
         async with db as session:
-            reply_to_p = (await session.execute(select(Post).where(Post.id == int(Snowflake.from_b32l(reply_to_id))))).scalar() if reply_to_id else None
-
-            session.execute(insert(Comment).values(
+            parent: Comment | None = None
+            if reply_to_id:
+                parent = (await session.execute(select(Comment).where(Comment.id == Snowflake.from_b32l(reply_to_id), Comment.parent_post_id == p.id))).scalar()
+                if parent is None:
+                    abort(400)
+                if await parent.is_parent_locked():
+                    await flash(f'You can\'t reply to locked comments')
+                    return
+                if parent.path and len(comment_path_ids(parent.path)) >= MAX_COMMENT_DEPTH:
+                    await flash(f'This thread is too deep to reply to')
+                    return
+            new_comment_id: int = (await session.execute(insert(Comment).values(
                 author_id = current_user.id,
                 parent_post_id = p.id,
-                parent_comment_id = reply_to_p,
-                text_content = text
-            ))
-            session.commit()
+                parent_comment_id = parent.id if parent else None,
+                text_content = text,
+                **await html_values(Comment, text)
+            ).returning(Comment.id))).scalar()
+            await comment_created(session, new_comment_id)
+            await session.commit()
+            await purge_pages(post=p.id)
             await flash('Comment published')
             return redirect(p.url()), 303
     abort(501)
@@ -93,46 +106,52 @@ async def post_detail(id: int):
     else:
         abort(404)
 
-async def comments_of(p: Post) -> Iterable[Comment]:
-    ## TODO add sort argument
-    pp = await db.paginate(new_comments(p))
-    print(pp.pages)
-    return pp
+async def comments_of(p: Post) -> CommentThread:
+    try:
+        return await load_thread_page(p, request.args.get('cursor'))
+    except ValueError:
+        abort(400, 'Invalid cursor')
 
 
 @bp.route('/@<username>/comments/<b32l:id>/', methods=['GET', 'POST'])
 @bp.route('/@<username>/comments/<b32l:id>/<slug:slug>', methods=['GET', 'POST'])
 async def user_post_detail(username: str, id: int, slug: str = ''):
     async with db as session:
-        post: Post | None = (await session.execute(select(Post).join(User, User.id == Post.author_id).where(Post.id == id, User.username == username))).scalar()
+        post: Post | None = (await session.execute(select(Post).join(User, User.id == Post.author_id).where(Post.id == id, User.username == username).options(*POST_DETAIL))).scalar()
 
-        if post is None or (post.author and await post.author.has_blocked(current_user.user)) or (post.is_removed and post.author != current_user.user):
+        if post is None or post.author_id in current_user.block_set.blocked_by or (post.is_removed and post.author != current_user.user):
             abort(404)
 
         if post.slug and slug != post.slug:
             return redirect(post.url()), 302
 
         if request.method == 'POST':
-            single_post_post_hook(post)
+            if (resp := await single_post_post_hook(post)) is not None:
+                return resp
+
+        counts = (await Post.feed_counts([post.id], current_user.user))[post.id]
 
-        return await render_template('singlepost.html', p=post, comments=await comments_of(post))
+        return await render_template('singlepost.html', p=post, counts=counts, comments=await comments_of(post))
 
 @bp.route('/+<gname>/comments/<b32l:id>/', methods=['GET', 'POST'])
 @bp.route('/+<gname>/comments/<b32l:id>/<slug:slug>', methods=['GET', 'POST'])
 async def guild_post_detail(gname, id, slug=''):
     async with db as session:
-        post: Post | None = (await session.execute(select(Post).join(Guild).where(Post.id == id, Guild.name == gname))).scalar()
+        post: Post | None = (await session.execute(select(Post).join(Guild).where(Post.id == id, Guild.name == gname).options(*POST_DETAIL))).scalar()
 
-        if post is None or (post.author and await post.author.has_blocked(current_user.user)) or (post.is_removed and post.author != current_user.user):
+        if post is None or post.author_id in current_user.block_set.blocked_by or (post.is_removed and post.author != current_user.user):
             abort(404)
 
         if post.slug and slug != post.slug:
             return redirect(post.url()), 302
 
         if request.method == 'POST':
-            single_post_post_hook(post)
+            if (resp := await single_post_post_hook(post)) is not None:
+                return resp
+
+        counts = (await Post.feed_counts([post.id], current_user.user))[post.id]
 
-        return await render_template('singlepost.html', p=post, comments=await comments_of(post), current_guild = post.guild)
+        return await render_template('singlepost.html', p=post, counts=counts, comments=await comments_of(post), current_guild = post.guild)
 
 
 
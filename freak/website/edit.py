@@ -9,6 +9,8 @@ from sqlalchemy import select, update
 from freak.utils import get_request_form
 
 from ..models import Post, db
+from ..pagecache import purge_pages
+from ..rendering import html_values
 
 bp = Blueprint('edit', __name__)
 
@@ -30,10 +32,12 @@ async def edit_post(id):
 
             await session.execute(update(Post).where(Post.id == id).values(
                 text_content = text,
+                **await html_values(Post, text),
                 privacy = privacy,
                 updated_at = datetime.datetime.now()
             ))
             await session.commit()
+            await purge_pages(guild=p.guild and p.guild.name, user=p.author.username, post=p.id)
             await flash('Your changes have been saved')
             return redirect(p.url()), 303
     return await render_template('edit.html', p=p)
@@ -9,27 +9,26 @@ from sqlalchemy import and_, distinct, func, select
 from freak import UserLoader
 from freak.utils import get_request_form
 
+from ..pagecache import cache_pages
 from ..search import SearchQuery
 from ..models import Guild, Member, Post, User, db
-from ..algorithms import public_timeline, top_guilds_query, topic_timeline
+from ..algorithms import guild_leaderboard, public_timeline, search_page, timeline_page, topic_timeline
 
 current_user: UserLoader
 
-bp = Blueprint('frontpage', __name__)
+bp = cache_pages(Blueprint('frontpage', __name__))
 
 
 
 @bp.route('/')
 async def homepage():
-    async with db as session:
-        top_communities = [(x[0], x[1], x[2]) for x in 
-                (await session.execute(top_guilds_query().limit(10))).fetchall()]
+    top_communities = await guild_leaderboard.get(10)
 
     if current_user:
         # renders user's own timeline
         # TODO this is currently the public timeline.
 
-        return await render_template('feed.html', feed_type='foryou', l=await db.paginate(public_timeline()),
+        return await render_template('feed.html', feed_type='foryou', l=await timeline_page(public_timeline()),
             top_communities=top_communities)
     else:
         # Show a landing page to anonymous users.
@@ -38,7 +37,7 @@ async def homepage():
 
 @bp.route('/explore/')
 async def explore():
-    return render_template('feed.html', feed_type='explore', l=db.paginate(public_timeline()))
+    return await render_template('feed.html', feed_type='explore', l=await timeline_page(public_timeline()))
 
 
 @bp.route('/+<name>/')
@@ -49,7 +48,7 @@ async def guild_feed(name):
         if guild is None:
             abort(404)
 
-        posts = await db.paginate(topic_timeline(name))
+        posts = await timeline_page(topic_timeline(guild), topic_id=guild.id)
 
         return await render_template(
             'feed.html', feed_type='guild', feed_title=f'{guild.display_name} (+{guild.name})', l=posts, guild=guild,
@@ -65,13 +64,15 @@ async def search():
     if request.method == "POST":
         form = await get_request_form()
         q = form["q"]
-        if q:
-            results = db.paginate(SearchQuery(q).select(Post, [Post.title]).order_by(Post.created_at.desc()))
-        else:
-            results = None
-        return await render_template(
-                "search.html",
-                results=results,
-                q = q
-            )
-    return await render_template("search.html")
+    else:
+        ## further pages
+        q = request.args.get("q")
+    if q:
+        results = await search_page(SearchQuery(q), max(request.args.get('page', 1, type=int), 1))
+    else:
+        results = None
+    return await render_template(
+            "search.html",
+            results=results,
+            q = q
+        )
@@ -9,6 +9,7 @@ from .. import UserLoader
 from ..utils import get_request_form
 
 from ..models import db, User, Guild
+from ..rendering import html_values
 
 current_user: UserLoader
 
@@ -22,13 +23,14 @@ async def guild_settings(name: str):
     async with db as session:
         gu = (await session.execute(select(Guild).where(Guild.name == name))).scalar()
 
-        if not current_user.moderates(gu):
+        if gu is None:
+            abort(404)
+        if not await current_user.moderates(gu):
             abort(403)
 
         if request.method == 'POST':
             if current_user.is_administrator and form.get('transfer_owner') == current_user.username:
                 gu.owner_id = current_user.id
-                await session.add(gu)
                 await session.commit()
                 await flash(f'Claimed ownership of {gu.handle()}')
                 return await render_template('guildsettings.html', gu=gu)
@@ -44,6 +46,8 @@ async def guild_settings(name: str):
 
         if description and description != gu.description:
             changes, gu.description = True, description.strip()
+            for attr, value in (await html_values(Guild, gu.description)).items():
+                setattr(gu, attr, value)
         if display_name and display_name != gu.display_name:
             changes, gu.display_name = True, display_name.strip()
         if exile_name:
@@ -69,7 +73,7 @@ async def guild_settings(name: str):
                 await flash(f'User \'{moderator_name}\' not found')
             elif mu.is_disabled:
                 await flash('Suspended users can\'t be moderators')
-            elif mu.has_blocked(current_user.user):
+            elif mu.id in current_user.block_set.blocked_by:
                 await flash(f'User \'{moderator_name}\' not found')
             else:
                 mm = await gu.update_member(mu)
@@ -79,14 +83,12 @@ async def guild_settings(name: str):
                     await flash('Exiled users can\'t be moderators')
                 else:
                     mm.is_moderator = True
-                    await session.add(mm)
                     changes = True
 
 
         if changes:
-            session.add(gu)
-            session.commit()
+            await session.commit()
             await flash('Changes saved!')
     
-    return render_template('guildsettings.html', gu=gu)
+        return await render_template('guildsettings.html', gu=gu)
 
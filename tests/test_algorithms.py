@@ -0,0 +1,82 @@
+"""
+Tests of the timeline cursors of freak.algorithms.
+
+Run with: python3 -m unittest discover -s tests
+"""
+
+import datetime
+import unittest
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from werkzeug.exceptions import HTTPException
+
+from freak import app
+from freak.algorithms import decode_cursor, encode_cursor, public_timeline, timeline_page
+from freak.models import db
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        for sort, value in (
+            ('new', datetime.datetime(2025, 3, 14, 15, 9, 26, 535897)),
+            ('new', datetime.datetime(1969, 12, 31, 23, 59)),
+            ('hot', 1234.5678),
+            ('rising', -0.25),
+            ('top', 42),
+            ('top', -7),
+        ):
+            with self.subTest(sort=sort, value=value):
+                cursor = encode_cursor(value, 1 << 60, 3, sort)
+                self.assertEqual(decode_cursor(cursor, sort), (value, 1 << 60, 3))
+                self.assertIs(type(decode_cursor(cursor, sort)[0]), type(value))
+
+    def test_url_safe(self):
+        cursor = encode_cursor(-1.0, (1 << 63) - 1, 0xffff, 'hot')
+        self.assertRegex(cursor, r'^[A-Za-z0-9_-]+$')
+
+    def test_page_clamped(self):
+        self.assertEqual(decode_cursor(encode_cursor(1, 2, 1 << 20, 'top'), 'top')[2], 0xffff)
+
+    def test_invalid(self):
+        valid = encode_cursor(1, 2, 3, 'top')
+        for cursor in ('', '!!!!', 'eA', valid[:-2], valid + 'AAAA', 'x' + valid[1:]):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    decode_cursor(cursor, 'top')
+
+    def test_other_sort(self):
+        cursors = {
+            'new': encode_cursor(datetime.datetime(2025, 1, 1), 2, 3),
+            'hot': encode_cursor(1.5, 2, 3, 'hot'),
+            'top': encode_cursor(1, 2, 3, 'top'),
+            'rising': encode_cursor(1.5, 2, 3, 'rising'),
+        }
+        for sort in cursors:
+            for other, cursor in cursors.items():
+                if other != sort:
+                    with self.subTest(sort=sort, cursor_of=other):
+                        with self.assertRaises(ValueError):
+                            decode_cursor(cursor, sort)
+
+class TimelineCursorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        try:
+            async with db as session:
+                await session.execute(text('SELECT 1'))
+        except (OperationalError, OSError) as e:
+            self.skipTest(f'no database: {e}')
+
+    async def test_other_sort(self):
+        cursor = encode_cursor(datetime.datetime(2025, 1, 1), 1, 2)
+        async with app.test_request_context(f'/explore/?cursor={cursor}'):
+            self.assertEqual((await timeline_page(public_timeline())).page, 2)
+        ## a cursor of sort=new, replayed on another sort
+        for sort in ('hot', 'top', 'rising'):
+            with self.subTest(sort=sort):
+                async with app.test_request_context(f'/explore/?sort={sort}&cursor={cursor}'):
+                    with self.assertRaises(HTTPException) as cm:
+                        await timeline_page(public_timeline())
+                    self.assertEqual(cm.exception.code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
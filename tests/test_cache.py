@@ -0,0 +1,241 @@
+"""
+Tests of freak.cache. RedisCache runs against a small stand-in server,
+speaking just enough RESP for the commands it sends.
+
+Run with: python3 -m unittest discover -s tests
+"""
+
+import asyncio
+import time
+import unittest
+
+from freak.cache import CacheError, MemoryCache, RedisCache
+
+class FakeRedis:
+    """
+    In-process, single-database server for the commands used by RedisCache.
+    """
+    def __init__(self):
+        self.data: dict[bytes, bytes] = {}
+        self.sets: dict[bytes, set[bytes]] = {}
+        self.zsets: dict[bytes, dict[bytes, float]] = {}
+        self.expires: dict[bytes, float] = {}
+        self.connections = 0
+        self.commands: list[list[bytes]] = []
+        ## seconds to wait before each reply
+        self.delay = 0.0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _alive(self, key: bytes) -> bool:
+        if key in self.expires and self.expires[key] <= time.time():
+            del self.expires[key]
+            self.data.pop(key, None)
+            self.sets.pop(key, None)
+        return key in self.data or key in self.sets or key in self.zsets
+
+    def _range(self, key: bytes, start: int, stop: int) -> list[bytes]:
+        members = sorted(self.zsets.get(key, {}).items(), key=lambda m: (m[1], m[0]))
+        n = len(members)
+        start, stop = start + n if start < 0 else start, stop + n if stop < 0 else stop
+        return [m for m, _ in members[max(start, 0):stop + 1]]
+
+    def run(self, cmd: str, a: list[bytes]):
+        match cmd:
+            case 'AUTH' | 'SELECT':
+                return 'OK'
+            case 'MGET':
+                return [self.data.get(k) if self._alive(k) else None for k in a]
+            case 'SET':
+                self.data[a[0]] = a[1]
+                self.expires.pop(a[0], None)
+                if len(a) > 3 and a[2].upper() == b'EX':
+                    self.expires[a[0]] = time.time() + int(a[3])
+                return 'OK'
+            case 'DEL':
+                n = 0
+                for k in a:
+                    n += self._alive(k)
+                    self.data.pop(k, None)
+                    self.sets.pop(k, None)
+                    self.zsets.pop(k, None)
+                return n
+            case 'SADD':
+                self._alive(a[0])
+                s = self.sets.setdefault(a[0], set())
+                before = len(s)
+                s.update(a[1:])
+                return len(s) - before
+            case 'SMEMBERS':
+                return list(self.sets.get(a[0], ())) if self._alive(a[0]) else []
+            case 'EXPIRE':
+                return 1
+            case 'ZADD':
+                z = self.zsets.setdefault(a[0], {})
+                for score, member in zip(a[1::2], a[2::2]):
+                    z[member] = float(score)
+                return len(a) // 2
+            case 'ZREMRANGEBYSCORE':
+                z = self.zsets.get(a[0], {})
+                lo, hi = float(a[1]), float(a[2])
+                gone = [m for m, score in z.items() if lo <= score <= hi]
+                for m in gone:
+                    del z[m]
+                return len(gone)
+            case 'ZRANGE':
+                return self._range(a[0], int(a[1]), int(a[2]))
+            case 'ZREMRANGEBYRANK':
+                gone = self._range(a[0], int(a[1]), int(a[2]))
+                for m in gone:
+                    del self.zsets[a[0]][m]
+                return len(gone)
+            case 'ZREM':
+                z = self.zsets.get(a[0], {})
+                return sum(z.pop(m, None) is not None for m in a[1:])
+        return ValueError(f'ERR unknown command {cmd!r}')
+
+    @staticmethod
+    def encode(v) -> bytes:
+        if v is None:
+            return b'$-1\r\n'
+        if isinstance(v, ValueError):
+            return b'-' + str(v).encode() + b'\r\n'
+        if isinstance(v, int):
+            return b':%d\r\n' % v
+        if isinstance(v, bytes):
+            return b'$%d\r\n%s\r\n' % (len(v), v)
+        if isinstance(v, str):
+            return b'+' + v.encode() + b'\r\n'
+        return b'*%d\r\n' % len(v) + b''.join(map(FakeRedis.encode, v))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                n = int((await reader.readuntil(b'\r\n'))[1:-2])
+                args = []
+                for _ in range(n):
+                    size = int((await reader.readuntil(b'\r\n'))[1:-2])
+                    args.append((await reader.readexactly(size + 2))[:-2])
+                self.commands.append(args)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(self.encode(self.run(args[0].decode().upper(), args[1:])))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+class CacheTests:
+    """
+    Tests shared by all backends; self.cache is set by subclasses.
+    """
+    async def test_get_set(self):
+        self.assertIsNone(await self.cache.get('a'))
+        await self.cache.set('a', {'x': 1})
+        self.assertEqual(await self.cache.get('a'), {'x': 1})
+        await self.cache.set_many({'b': 2, 'c': None})
+        self.assertEqual(await self.cache.get_many(['a', 'b', 'c']), {'a': {'x': 1}, 'b': 2})
+
+    async def test_none_deletes(self):
+        await self.cache.set('a', 1)
+        await self.cache.set('a', None)
+        self.assertIsNone(await self.cache.get('a'))
+
+    async def test_delete(self):
+        await self.cache.set_many({'a': 1, 'b': 2})
+        await self.cache.delete('a')
+        self.assertEqual(await self.cache.get_many(['a', 'b']), {'b': 2})
+
+    async def test_purge(self):
+        await self.cache.set('a', 1, tags=['t1'])
+        await self.cache.set('b', 2, tags=['t1', 't2'])
+        await self.cache.set('c', 3, tags=['t2'])
+        await self.cache.set('d', 4)
+        await self.cache.purge('t1')
+        self.assertEqual(await self.cache.get_many('abcd'), {'c': 3, 'd': 4})
+
+class MemoryCacheTest(CacheTests, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = MemoryCache(3)
+
+    async def test_lru(self):
+        await self.cache.set_many({'a': 1, 'b': 2, 'c': 3})
+        await self.cache.get('a')
+        await self.cache.set('d', 4)
+        self.assertEqual(await self.cache.get_many('abcd'), {'a': 1, 'c': 3, 'd': 4})
+
+class RedisCacheTest(CacheTests, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeRedis()
+        await self.server.start()
+        self.cache = RedisCache(f'redis://:secret@127.0.0.1:{self.server.port}/2', prefix='test:')
+
+    async def asyncTearDown(self):
+        await self.cache.close()
+        await self.server.stop()
+
+    async def test_login(self):
+        await self.cache.get('a')
+        self.assertEqual(self.server.commands[:2], [[b'AUTH', b'secret'], [b'SELECT', b'2']])
+        self.assertEqual(self.server.commands[2], [b'MGET', b'test:a'])
+
+    async def test_ttl(self):
+        await self.cache.set('a', 1, ttl=60, tags=['t'])
+        set_command = next(c for c in self.server.commands if c[0] == b'SET')
+        self.assertEqual(set_command[3:], [b'EX', b'60'])
+        self.assertEqual(self.server.commands[-2:], [
+            [b'EXPIRE', b'test:tag:t', b'60', b'NX'],
+            [b'EXPIRE', b'test:tag:t', b'60', b'GT'],
+        ])
+
+    async def test_pool(self):
+        ## slow replies: concurrent reads must not wait for each other
+        self.server.delay = 0.1
+        await self.cache.set('a', 1)
+        start = time.monotonic()
+        results = await asyncio.gather(*(self.cache.get('a') for _ in range(4)))
+        self.assertEqual(results, [1] * 4)
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual(self.server.connections, 4)
+        ## and connections are reused
+        await asyncio.gather(*(self.cache.get('a') for _ in range(8)))
+        self.assertEqual(self.server.connections, 4)
+
+    async def test_error_reply(self):
+        with self.assertRaises(CacheError):
+            await self.cache.execute(('NOSUCHCOMMAND',))
+        ## the connection is dropped, the next one works
+        await self.cache.set('a', 1)
+        self.assertEqual(await self.cache.get('a'), 1)
+
+    async def test_server_down(self):
+        cache = RedisCache(f'redis://127.0.0.1:{self.server.port}')
+        await self.server.stop()
+        ## misses and dropped writes, not errors
+        await cache.set('a', 1)
+        self.assertIsNone(await cache.get('a'))
+        with self.assertRaisesRegex(CacheError, 'retrying later'):
+            await cache.execute(('MGET', 'a'))
+
+    async def test_bounded(self):
+        pages = RedisCache(f'redis://127.0.0.1:{self.server.port}', prefix='test:page:', max_entries=2)
+        await self.cache.set('principal', 1)
+        for i in range(5):
+            await pages.set(f'p{i}', i, ttl=60 + i, tags=['t'])
+        self.assertEqual(await pages.get_many([f'p{i}' for i in range(5)]), {'p3': 3, 'p4': 4})
+        ## other namespaces are left alone
+        self.assertEqual(await self.cache.get('principal'), 1)
+        await pages.purge('t')
+        self.assertEqual(self.server.zsets[b'test:page:index'], {})
+        await pages.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+EXPLAIN tests: the queries of timelines, feeds, threads, searches, vote
+counts and reports are served by the indexes made for them.
+
+Queries are captured while the real functions run (in a transaction that
+is rolled back), then explained with sequential scans disabled, so that
+the plan is the one a big table gets regardless of how small the test
+database is.
+
+Needs the database of DATABASE_URL, migrated; skipped if it can't be reached.
+"""
+
+import json
+import unittest
+
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import OperationalError
+
+from freak import app
+from freak.algorithms import private_timeline, public_timeline, search_ids, timeline_page, topic_timeline, user_timeline
+from freak.models import Comment, Guild, Post, PostStats, User, db
+from freak.search import SearchQuery
+from freak.threads import encode_subtree_cursor, encode_thread_cursor, load_thread_page
+
+def _index_names(plan) -> set[str]:
+    names = set()
+    if isinstance(plan, dict):
+        if 'Index Name' in plan:
+            names.add(plan['Index Name'])
+        for value in plan.values():
+            names |= _index_names(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            names |= _index_names(value)
+    return names
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        try:
+            async with db as session:
+                await session.execute(text('SELECT 1'))
+        except (OperationalError, OSError) as e:
+            self.skipTest(f'no database: {e}')
+
+class IndexTest(DatabaseTestCase):
+    async def indexes_used(self, path: str, func, *args, **kwargs) -> set[str]:
+        """
+        Names of the indexes in the plans of the queries func(*args, **kwargs)
+        runs, within a request to path.
+        """
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+                statements.append((statement, parameters))
+        async with app.test_request_context(path):
+            session = await db.begin_request()
+            try:
+                conn = await session.connection()
+                await conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+                event.listen(conn.sync_connection, 'before_cursor_execute', capture)
+                try:
+                    await func(*args, **kwargs)
+                finally:
+                    event.remove(conn.sync_connection, 'before_cursor_execute', capture)
+                names = set()
+                for statement, parameters in statements:
+                    plan = (await conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters)).scalar()
+                    names |= _index_names(plan if isinstance(plan, list) else json.loads(plan))
+            finally:
+                await db.end_request(commit=False)
+        return names
+
+    async def test_public_timeline(self):
+        self.assertIn('post_public_timeline', await self.indexes_used('/', lambda: timeline_page(public_timeline())))
+
+    async def test_guild_timeline(self):
+        gu = Guild(id=1, name='test')
+        self.assertIn('post_topic_timeline', await self.indexes_used('/', lambda: timeline_page(topic_timeline(gu), topic_id=gu.id)))
+
+    async def test_user_timeline(self):
+        self.assertIn('post_author_timeline', await self.indexes_used('/', lambda: timeline_page(user_timeline(User(id=1)))))
+
+    async def test_private_timeline(self):
+        ## posts of the guilds one is a member of
+        self.assertIn('post_topic_timeline', await self.indexes_used('/', lambda: timeline_page(private_timeline(User(id=1)))))
+
+    async def test_ranked_timelines(self):
+        gu = Guild(id=1, name='test')
+        for sort, index in [('hot', 'post_stats_hot'), ('rising', 'post_stats_rising'), ('top', 'post_stats_top')]:
+            with self.subTest(sort=sort):
+                self.assertIn(index, await self.indexes_used(f'/?sort={sort}', lambda: timeline_page(public_timeline())))
+        for sort, index in [('hot', 'post_stats_topic_hot'), ('top', 'post_stats_topic_top'), ('rising', 'post_stats_topic_created')]:
+            with self.subTest(sort=sort, guild=True):
+                self.assertIn(index, await self.indexes_used(f'/?sort={sort}', lambda: timeline_page(topic_timeline(gu), topic_id=gu.id)))
+
+    async def test_thread(self):
+        async with app.app_context():
+            async with db as session:
+                c = (await session.execute(select(Comment).where(Comment.parent_comment_id != None).limit(1))).scalar()
+                post = c and (await session.execute(select(Post).where(Post.id == c.parent_post_id))).scalar()
+        if c is None:
+            self.skipTest('no replies')
+        self.assertIn('comment_top_level', await self.indexes_used('/', load_thread_page, post))
+        self.assertIn('comment_thread', await self.indexes_used('/', load_thread_page, post, encode_thread_cursor(c.parent_comment_id)))
+
+    async def test_subtree(self):
+        async with app.app_context():
+            async with db as session:
+                c = (await session.execute(select(Comment).where(Comment.path != None).limit(1))).scalar()
+                post = c and (await session.execute(select(Post).where(Post.id == c.parent_post_id))).scalar()
+        if c is None:
+            self.skipTest('no comments')
+        self.assertIn('comment_path', await self.indexes_used('/', load_thread_page, post, encode_subtree_cursor(c.id)))
+
+    async def test_vote_tally(self):
+        async def reconcile():
+            async with db as session:
+                await PostStats.reconcile(session)
+        self.assertIn('post_upvote_tally', await self.indexes_used('/', reconcile))
+
+    async def test_comment_search(self):
+        sq = SearchQuery('type:comment "index test" -nothing')
+        self.assertIn('comment_search', await self.indexes_used('/', search_ids, sq))
+
+    async def test_report_count(self):
+        self.assertIn('postreport_target_status', await self.indexes_used('/', Comment(id=1).report_count))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""
+Tests of the ranks of freak.models, computed in SQL.
+
+Needs the database of DATABASE_URL; skipped if it can't be reached.
+"""
+
+import datetime
+import math
+import unittest
+
+from sqlalchemy import literal, select, text
+from sqlalchemy.exc import OperationalError
+
+from freak.models import HOT_DECAY, RANK_EPOCH, db, hot_rank_of
+
+class RankTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        try:
+            async with db as session:
+                await session.execute(text('SELECT 1'))
+        except (OperationalError, OSError) as e:
+            self.skipTest(f'no database: {e}')
+
+    async def test_hot_rank(self):
+        when = datetime.datetime(2024, 5, 1, 12, tzinfo=datetime.timezone.utc)
+        async with db as session:
+            for score in (-250, -1, 0, 1, 7, 12345):
+                with self.subTest(score=score):
+                    rank = (await session.execute(select(hot_rank_of(literal(score), literal(when))))).scalar()
+                    expected = math.copysign(math.log10(max(abs(score), 1)), score) + (when.timestamp() - RANK_EPOCH) / HOT_DECAY
+                    self.assertAlmostEqual(float(rank), expected, places=6)
+            ## ten times the score is worth HOT_DECAY seconds of age
+            older = await session.execute(select(
+                hot_rank_of(literal(100), literal(when - datetime.timedelta(seconds=HOT_DECAY))),
+                hot_rank_of(literal(10), literal(when))
+            ))
+            self.assertAlmostEqual(*map(float, older.one()), places=6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+"""
+Tests of the excerpts of freak.rendering.
+
+Run with: python3 -m unittest discover -s tests
+"""
+
+import unittest
+
+from freak.rendering import EXCERPT_SOURCE_LENGTH, excerpt_source
+
+class ExcerptSourceTest(unittest.TestCase):
+    def test_short(self):
+        text = 'One paragraph.\n\nAnother one.'
+        self.assertEqual(excerpt_source(text), text)
+        text = 'x' * EXCERPT_SOURCE_LENGTH
+        self.assertEqual(excerpt_source(text), text)
+
+    def test_whole_paragraphs(self):
+        first, second = 'a' * 400, 'b' * 400
+        text = f'{first}\n\n{second}\n\n' + 'c' * 1000
+        self.assertEqual(excerpt_source(text), f'{first}\n\n{second}')
+
+    def test_one_long_paragraph(self):
+        text = 'word ' * 1000
+        excerpt = excerpt_source(text)
+        self.assertLessEqual(len(excerpt), EXCERPT_SOURCE_LENGTH + 1)
+        self.assertTrue(excerpt.endswith('word…'))
+        self.assertTrue(text.startswith(excerpt[:-1]))
+
+    def test_no_spaces(self):
+        excerpt = excerpt_source('x' * 5000)
+        self.assertEqual(excerpt, 'x' * EXCERPT_SOURCE_LENGTH + '…')
+
+if __name__ == '__main__':
+    unittest.main()
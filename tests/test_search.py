@@ -0,0 +1,82 @@
+"""
+Tests of the search query syntax of freak.search.
+
+Run with: python3 -m unittest discover -s tests
+"""
+
+import datetime
+import unittest
+
+from freak.search import SearchQuery, snowflake_at
+
+class SearchQueryTest(unittest.TestCase):
+    def test_keywords(self):
+        q = SearchQuery('Cats  DOGS')
+        self.assertEqual(q.keywords, ['cats', 'dogs'])
+        self.assertEqual((q.phrases, q.excluded, q.guilds, q.users), ([], [], [], []))
+        self.assertEqual(q.kind, 'post')
+        self.assertTrue(q.has_text())
+
+    def test_phrases(self):
+        q = SearchQuery('"the  quick fox" -"lazy dog" -cat "unterminated  phrase')
+        self.assertEqual(q.phrases, ['the quick fox', 'unterminated phrase'])
+        self.assertEqual(q.excluded, ['lazy dog', 'cat'])
+        self.assertEqual(q.keywords, [])
+        ## empty terms are dropped
+        self.assertFalse(SearchQuery('""  -""').has_text())
+
+    def test_guilds_and_users(self):
+        q = SearchQuery('+Music @alice +art @ + word')
+        self.assertEqual(q.guilds, ['music', 'art'])
+        self.assertEqual(q.users, ['alice'])
+        self.assertEqual(q.keywords, ['@', '+', 'word'])
+
+    def test_dates(self):
+        q = SearchQuery('after:2024-01-31 before:2024-03-01 news')
+        self.assertEqual(q.after, datetime.date(2024, 1, 31))
+        self.assertEqual(q.before, datetime.date(2024, 3, 1))
+        self.assertEqual(q.keywords, ['news'])
+        ## malformed dates are plain keywords
+        q = SearchQuery('after:yesterday before:2024-13-01')
+        self.assertIsNone(q.after)
+        self.assertIsNone(q.before)
+        self.assertEqual(q.keywords, ['after:yesterday', 'before:2024-13-01'])
+
+    def test_kind(self):
+        self.assertEqual(SearchQuery('type:Comment x').kind, 'comment')
+        q = SearchQuery('type:guild')
+        self.assertEqual(q.kind, 'post')
+        self.assertEqual(q.keywords, ['type:guild'])
+
+    def test_iterable(self):
+        self.assertEqual(SearchQuery(['a b', '"c d"']).normalized(), SearchQuery('a b "c d"').normalized())
+
+    def test_normalized(self):
+        a = SearchQuery('Dog cat "big  fish" -mouse +zoo @bob after:2024-01-01')
+        b = SearchQuery('after:2024-01-01   @BOB +zoo -"mouse" cat "BIG fish" dog dog')
+        self.assertEqual(a.normalized(), b.normalized())
+        self.assertEqual(a.normalized(), 'type:post cat dog "big fish" -"mouse" +zoo @bob after:2024-01-01')
+        self.assertNotEqual(a.normalized(), SearchQuery('dog cat "big fish" -mouse +zoo @bob').normalized())
+        self.assertNotEqual(SearchQuery('dog').normalized(), SearchQuery('type:comment dog').normalized())
+
+class SnowflakeAtTest(unittest.TestCase):
+    EPOCH = 1577833200
+
+    def test_snowflake_at(self):
+        when = datetime.datetime(2024, 6, 1, 12, 30, 15, tzinfo=datetime.timezone.utc)
+        ms = (int(when.timestamp()) - self.EPOCH) * 1000
+        self.assertEqual(snowflake_at(when, self.EPOCH), ms << 22)
+        ## a second later is 1000 id ranges later
+        self.assertEqual(snowflake_at(when + datetime.timedelta(seconds=1), self.EPOCH), (ms + 1000) << 22)
+
+    def test_naive_is_utc(self):
+        when = datetime.datetime(2024, 6, 1, 12)
+        self.assertEqual(snowflake_at(when, self.EPOCH), snowflake_at(when.replace(tzinfo=datetime.timezone.utc), self.EPOCH))
+        cest = datetime.timezone(datetime.timedelta(hours=2))
+        self.assertEqual(snowflake_at(datetime.datetime(2024, 6, 1, 14, tzinfo=cest), self.EPOCH), snowflake_at(when, self.EPOCH))
+
+    def test_before_epoch(self):
+        self.assertEqual(snowflake_at(datetime.datetime(2000, 1, 1), self.EPOCH), 0)
+
+if __name__ == '__main__':
+    unittest.main()
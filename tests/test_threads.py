@@ -0,0 +1,154 @@
+"""
+Tests of comment paths, thread cursors, build_thread() and pages of
+freak.threads.
+
+Run with: python3 -m unittest discover -s tests
+"""
+
+import datetime
+import unittest
+
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import OperationalError
+
+from freak import app
+from freak.models import COMMENT_PATH_DIGITS, MAX_COMMENT_DEPTH, Comment, Post, comment_path_ids, db
+from freak.threads import (build_thread, decode_subtree_cursor, decode_thread_cursor,
+    encode_subtree_cursor, encode_thread_cursor, is_subtree_cursor, load_thread_page)
+
+def path(*ids: int) -> str:
+    return ''.join(f'{i:016x}' for i in ids)
+
+def comment(*ids: int, author_id: int = 1, is_locked: bool = False) -> Comment:
+    """
+    Comment ids[-1], reply to ids[-2] and so on.
+    """
+    return Comment(id=ids[-1], parent_comment_id=ids[-2] if len(ids) > 1 else None,
+        path=path(*ids), author_id=author_id, is_locked=is_locked)
+
+class CommentPathTest(unittest.TestCase):
+    def test_comment_path_ids(self):
+        self.assertEqual(comment_path_ids(path(7)), [7])
+        ids = [1, 0xffff_ffff, (1 << 63) - 1]
+        self.assertEqual(comment_path_ids(path(*ids)), ids)
+        self.assertEqual(comment_path_ids(''), [])
+
+    def test_order(self):
+        ## paths sort as their ids do, depth first
+        paths = [path(2), path(10), path(2, 3), path(2, 1), path(10, 1 << 40)]
+        self.assertEqual(sorted(paths), [path(2), path(2, 1), path(2, 3), path(10), path(10, 1 << 40)])
+
+    def test_max_depth(self):
+        ## index entries of the deepest paths fit in a btree page
+        self.assertLess(MAX_COMMENT_DEPTH * COMMENT_PATH_DIGITS, 2000)
+
+class ThreadCursorTest(unittest.TestCase):
+    def test_thread_cursor(self):
+        self.assertEqual(decode_thread_cursor(encode_thread_cursor(None)), (None, None))
+        self.assertEqual(decode_thread_cursor(encode_thread_cursor(5)), (5, None))
+        after = Comment(id=99, created_at=datetime.datetime(2025, 1, 2, 3, 4, 5, 678))
+        self.assertEqual(decode_thread_cursor(encode_thread_cursor(5, after)), (5, (after.created_at, 99)))
+        self.assertEqual(decode_thread_cursor(encode_thread_cursor(None, after)), (None, (after.created_at, 99)))
+
+    def test_subtree_cursor(self):
+        self.assertEqual(decode_subtree_cursor(encode_subtree_cursor(5)), (5, None))
+        self.assertEqual(decode_subtree_cursor(encode_subtree_cursor(5, 1 << 62)), (5, 1 << 62))
+
+    def test_kind(self):
+        self.assertTrue(is_subtree_cursor(encode_subtree_cursor(5, 6)))
+        self.assertFalse(is_subtree_cursor(encode_thread_cursor(5)))
+        with self.assertRaises(ValueError):
+            decode_subtree_cursor(encode_thread_cursor(5))
+        with self.assertRaises(ValueError):
+            decode_thread_cursor(encode_subtree_cursor(5))
+
+    def test_invalid(self):
+        for cursor in ('', 'A', '!!!!', encode_thread_cursor(5)[:-3]):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    decode_thread_cursor(cursor)
+                with self.assertRaises(ValueError):
+                    decode_subtree_cursor(cursor)
+
+class BuildThreadTest(unittest.TestCase):
+    post = Post(id=1)
+
+    def test_tree(self):
+        thread = build_thread(self.post, [
+            comment(1), comment(1, 2), comment(1, 2, 3), comment(1, 4), comment(5),
+        ])
+        self.assertEqual([n.id for n in thread], [1, 5])
+        self.assertEqual([n.id for n in thread[1].children], [2, 4])
+        self.assertEqual([(n.id, n.depth) for n in thread.walk()], [(1, 0), (2, 1), (3, 2), (4, 1), (5, 0)])
+        self.assertFalse(any(n.locked for n in thread.walk()))
+
+    def test_orphans(self):
+        ## a page of a subtree: parents are left out, depths come from paths
+        thread = build_thread(self.post, [comment(1, 2, 3), comment(1, 2, 3, 4), comment(1, 5), comment(1, 5, 6)])
+        self.assertEqual([(n.id, n.depth) for n in thread], [(3, 2), (5, 1)])
+        self.assertEqual([(n.id, n.depth) for n in thread.walk()], [(3, 2), (4, 3), (5, 1), (6, 2)])
+
+    def test_hidden_authors(self):
+        thread = build_thread(self.post, [
+            comment(1), comment(1, 2, author_id=9), comment(1, 2, 3), comment(1, 2, 3, 4), comment(1, 5),
+            comment(6, author_id=9), comment(6, 7),
+        ], hidden_authors={9})
+        self.assertEqual([n.id for n in thread.walk()], [1, 5])
+        self.assertNotIn(3, thread.nodes)
+
+    def test_locked(self):
+        thread = build_thread(self.post, [
+            comment(1), comment(1, 2, is_locked=True), comment(1, 2, 3), comment(1, 4), comment(5),
+        ])
+        self.assertEqual({n.id for n in thread.walk() if n.locked}, {2, 3})
+
+    def test_locked_from_above(self):
+        thread = build_thread(self.post, [comment(1, 2), comment(1, 2, 3)], locked=True)
+        self.assertTrue(all(n.locked for n in thread.walk()))
+
+    def test_locked_paths(self):
+        ## parents left out of the page are known to be locked by their path
+        thread = build_thread(self.post, [comment(1, 2, 3), comment(1, 2, 3, 4), comment(1, 5)],
+            locked_paths={path(1, 2)})
+        self.assertEqual({n.id for n in thread.walk() if n.locked}, {3, 4})
+
+class SubtreePageTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Needs the database of DATABASE_URL, with a comment having two replies
+    or more; skipped otherwise.
+    """
+    async def asyncSetUp(self):
+        try:
+            async with db as session:
+                parent_id = (await session.execute(select(Comment.parent_comment_id).where(Comment.path != None)
+                    .group_by(Comment.parent_comment_id).having(func.count() > 1).limit(1))).scalar()
+                if parent_id is None:
+                    self.skipTest('no comment with replies')
+                self.root = (await session.execute(select(Comment).where(Comment.id == parent_id))).scalar()
+                self.post = (await session.execute(select(Post).where(Post.id == self.root.parent_post_id))).scalar()
+                self.other = (await session.execute(select(Comment.id).where(
+                    Comment.parent_post_id == self.post.id, Comment.id != self.root.id, ~Comment.in_subtree(self.root.path)
+                ).limit(1))).scalar()
+        except (OperationalError, OSError) as e:
+            self.skipTest(f'no database: {e}')
+
+    async def load(self, after_id: int | None = None) -> list[int]:
+        async with app.test_request_context('/'):
+            thread = await load_thread_page(self.post, encode_subtree_cursor(self.root.id, after_id))
+        return [node.id for node in thread.walk()]
+
+    async def test_resume(self):
+        ids = await self.load()
+        self.assertGreater(len(ids), 1)
+        self.assertEqual(await self.load(ids[0]), ids[1:])
+
+    async def test_missing_after(self):
+        ## deleted since the previous page: not an empty page
+        with self.assertRaises(ValueError):
+            await self.load((1 << 63) - 1)
+        if self.other is not None:
+            with self.assertRaises(ValueError):
+                await self.load(self.other)
+
+if __name__ == '__main__':
+    unittest.main()